@@ -1,9 +1,13 @@
 import {
   type ApiKeyInfo,
+  currentScopeIntervals,
   DISTANT_FUTURE,
   type EntityType,
   type ExceededScope,
   entityTypeLookup,
+  groupSpendStatus,
+  hashApiKey,
+  hexDigest,
   type KeyLimitUpdate,
   type KeyStatus,
   KeysDb,
@@ -15,6 +19,7 @@ import {
   type Scope,
   type SpendScope,
   type SpendStatus,
+  type SpendStatusByEntity,
   scopeLookup,
 } from '@pydantic/ai-gateway'
 import { config } from './config'
@@ -176,21 +181,67 @@ WHERE entityType = ? ${entityIdClause}
 `,
       )
       .bind(...params)
-      .run<{
-        entityId: number
-        scope: 1 | 2 | 3 | 4
-        scopeInterval: number
-        spendingLimit: number | null
-        spend: number
-      }>()
-
-    return results.map(({ entityId, scope, scopeInterval, spendingLimit, spend }) => ({
-      entityId,
-      scope: reverseScopeLookup[scope],
-      scopeInterval: scopeInterval === DISTANT_FUTURE ? null : { date: intAsDate(scopeInterval), raw: scopeInterval },
-      limit: spendingLimit,
-      spend,
-    }))
+      .run<SpendRow>()
+
+    return results.map(spendStatusFromRow)
+  }
+
+  async spendStatusByEntity(minScopeInterval = 0): Promise<SpendStatusByEntity> {
+    // force the scopeInterval range to use the index so expired intervals are never read, rather than a full scan
+    // of the primary key to avoid sorting
+    const { results } = await this.db
+      .prepare(
+        `
+SELECT entityType, entityId, scope, scopeInterval, spendingLimit, spend
+FROM spend INDEXED BY idxSpendScopeInterval
+WHERE scopeInterval >= ?
+ORDER BY entityType, entityId, scope
+`,
+      )
+      .bind(minScopeInterval)
+      .run<SpendRow & { entityType: 1 | 2 | 3 }>()
+
+    const grouped: SpendStatusByEntity = { project: new Map(), user: new Map(), key: new Map() }
+    for (const row of results) {
+      groupSpendStatus(grouped[reverseEntityTypeLookup[row.entityType]], spendStatusFromRow(row))
+    }
+    return grouped
+  }
+
+  /**
+   * Delete daily and weekly spend rows for intervals that ended before `today`.
+   *
+   * Monthly rows already include all daily spend, so they are kept as history. If the monthly row for an expired
+   * day is missing, it's created from the sum of the daily rows first, so no spend history is lost.
+   *
+   * Returns the number of rows deleted.
+   */
+  async rollupSpend(today: number = currentScopeIntervals().day): Promise<number> {
+    const [, deleted] = await this.db.batch([
+      this.db
+        .prepare(
+          `
+INSERT OR IGNORE INTO spend (entityType, entityId, scope, scopeInterval, spendingLimit, spend)
+SELECT entityType, entityId, 3, ${END_OF_MONTH_SQL}, NULL, SUM(spend)
+FROM spend
+WHERE scopeInterval < ? AND scope = 1
+GROUP BY entityType, entityId, ${END_OF_MONTH_SQL}
+`,
+        )
+        .bind(today),
+      this.db.prepare(`DELETE FROM spend WHERE scopeInterval < ? AND scope IN (1, 2)`).bind(today),
+      // claims only have to outlive batch results, kept for 29 days by Anthropic and 30 days by OpenAI by default
+      this.db.prepare(`DELETE FROM batchSpend WHERE recordedAt < datetime('now', '-30 days')`),
+    ])
+    return deleted?.meta.changes ?? 0
+  }
+
+  async claimBatchSpend(batchId: string): Promise<boolean> {
+    const { meta } = await this.db
+      .prepare('INSERT INTO batchSpend (batchId) VALUES (?) ON CONFLICT DO NOTHING')
+      .bind(batchId)
+      .run()
+    return meta.changes > 0
   }
 
   protected updateSpend(
@@ -205,6 +256,28 @@ WHERE entityType = ? ${entityIdClause}
   }
 }
 
+interface SpendRow {
+  entityId: number
+  scope: 1 | 2 | 3 | 4
+  scopeInterval: number
+  spendingLimit: number | null
+  spend: number
+}
+
+function spendStatusFromRow({ entityId, scope, scopeInterval, spendingLimit, spend }: SpendRow): SpendStatus {
+  return {
+    entityId,
+    scope: reverseScopeLookup[scope],
+    scopeInterval: scopeInterval === DISTANT_FUTURE ? null : { date: intAsDate(scopeInterval), raw: scopeInterval },
+    limit: spendingLimit,
+    spend,
+  }
+}
+
+// the last day of the month containing the day `scopeInterval`, as days since 1970-01-01
+const END_OF_MONTH_SQL = `\
+CAST(strftime('%s', scopeInterval * 86400, 'unixepoch', 'start of month', '+1 month', '-1 day') AS INTEGER) / 86400`
+
 // Helper functions for date handling
 const MS_PER_DAY = 24 * 60 * 60 * 1000
 
@@ -216,7 +289,15 @@ export function intAsDate(days: number): Date {
   return new Date(days * MS_PER_DAY)
 }
 
+let configKeyDigests: Promise<string[]> | null = null
+
 export class ConfigDB extends KeysDbD1 {
+  listApiKeyDigests(): Promise<string[]> {
+    // the config holds keys rather than their digests, so they're hashed once per isolate
+    configKeyDigests ??= Promise.all(Object.keys(config.apiKeys).map(async (key) => hexDigest(await hashApiKey(key))))
+    return configKeyDigests
+  }
+
   async getApiKey(key: string): Promise<ApiKeyInfo | null> {
     const keyInfo = config.apiKeys[key]
     if (!keyInfo) {
@@ -16,13 +16,16 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
 
 import { env } from 'cloudflare:workers'
-import { type GatewayOptions, gatewayFetch, KVCacheAdapter } from '@pydantic/ai-gateway'
+import { ApiKeyFilter, type GatewayOptions, gatewayFetch, KVCacheAdapter } from '@pydantic/ai-gateway'
 import { instrument } from '@pydantic/logfire-cf-workers'
 import logfire from 'logfire'
 import { config } from './config'
 import { ConfigDB, hash, LimitDbD1 } from './db'
 import { status } from './status'
 
+// keys come from the config, so the filter of valid keys is cheap to build and rejects unknown keys without any I/O
+const apiKeyFilter = new ApiKeyFilter()
+
 const handler = {
   async fetch(request, env, ctx): Promise<Response> {
     const url = new URL(request.url)
@@ -40,6 +43,7 @@ const handler = {
       cache: new KVCacheAdapter(env.KV),
       kvVersion: await hash(JSON.stringify(config)),
       subFetch: fetch,
+      apiKeyFilter,
     }
     try {
       return await gatewayFetch(request, url, ctx, gatewayEnv)
@@ -49,6 +53,12 @@ const handler = {
       return new Response('Internal Server Error', { status: 500, headers: { 'content-type': 'text/plain' } })
     }
   },
+
+  async scheduled(_controller, env): Promise<void> {
+    // fold expired daily and weekly spend into monthly history so the spend table doesn't grow forever
+    const deleted = await new LimitDbD1(env.limitsDB).rollupSpend()
+    logfire.info('spend rollup complete', { deleted })
+  },
 } satisfies ExportedHandler<Env>
 
 export default instrument(handler, {
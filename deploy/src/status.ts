@@ -1,4 +1,4 @@
-import type { LimitDb, SpendStatus } from '@pydantic/ai-gateway'
+import { currentScopeIntervals, type LimitDb, type SpendStatus } from '@pydantic/ai-gateway'
 import { config } from './config'
 
 interface EntityStatus {
@@ -30,9 +30,10 @@ export async function status(request: Request, env: Env, limitdb: LimitDb): Prom
     return authResponse
   }
 
-  const projectStatus = await limitdb.spendStatus('project')
-  const userStatus = await limitdb.spendStatus('user')
-  const keyStatus = await limitdb.spendStatus('key')
+  // all intervals, including monthly history, unless `?current` asks for only the intervals that haven't ended,
+  // grouped by entity so each lookup below is constant time
+  const current = new URL(request.url).searchParams.has('current')
+  const spend = await limitdb.spendStatusByEntity(current ? currentScopeIntervals().day : 0)
 
   const data: Status = {
     projects: Object.entries(config.projects).map(([id, project]) => {
@@ -43,13 +44,13 @@ export async function status(request: Request, env: Env, limitdb: LimitDb): Prom
         spendingLimitDaily: project.spendingLimitDaily,
         spendingLimitWeekly: project.spendingLimitWeekly,
         spendingLimitMonthly: project.spendingLimitMonthly,
-        spend: projectStatus.filter((t) => t.entityId === projectId),
+        spend: spend.project.get(projectId) ?? [],
         users: Object.entries(project.users).map(([id, user]) => {
           const userId = Number(id)
           return {
             id: userId,
             name: user.name,
-            spend: userStatus.filter((t) => t.entityId === userId),
+            spend: spend.user.get(userId) ?? [],
             spendingLimitDaily: user.spendingLimitDaily,
             spendingLimitWeekly: user.spendingLimitWeekly,
             spendingLimitMonthly: user.spendingLimitMonthly,
@@ -60,7 +61,7 @@ export async function status(request: Request, env: Env, limitdb: LimitDb): Prom
     keys: Object.entries(config.apiKeys).map(([apiKey, keyInfo]) => ({
       id: keyInfo.id,
       name: `${apiKey.substring(0, 5)}...`,
-      spend: keyStatus.filter((t) => t.entityId === keyInfo.id),
+      spend: spend.key.get(keyInfo.id) ?? [],
       expires: keyInfo.expires,
       spendingLimitDaily: keyInfo.spendingLimitDaily,
       spendingLimitWeekly: keyInfo.spendingLimitWeekly,
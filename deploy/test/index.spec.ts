@@ -15,6 +15,7 @@ beforeAll(async () => {
 const RESET_SQL = `\
 DROP TABLE IF EXISTS spend;
 DROP TABLE IF EXISTS keyStatus;
+DROP TABLE IF EXISTS batchSpend;
 
 ${SQL}`
 
@@ -66,6 +67,22 @@ describe('deploy', () => {
     expect(await ok.text()).toMatchSnapshot('status-empty')
   })
 
+  it('status shows spend history unless only current intervals are requested', async () => {
+    // spend of project 1 for a month that has ended
+    await env.limitsDB
+      .prepare('INSERT INTO spend (entityType, entityId, scope, scopeInterval, spend) VALUES (1, 1, 3, 1, 5)')
+      .run()
+    const headers = { authorization: 'testing' }
+    type StatusData = { projects: { id: number; spend: { spend: number }[] }[] }
+    const projectSpend = async (url: string) => {
+      const data = await (await SELF.fetch(url, { headers })).json<StatusData>()
+      return data.projects.find(({ id }) => id === 1)!.spend.map(({ spend }) => spend)
+    }
+
+    expect(await projectSpend('https://example.com/status/')).toEqual([5])
+    expect(await projectSpend('https://example.com/status/?current')).toEqual([])
+  })
+
   it('should call openai via gateway', async () => {
     const otelBatch: string[] = []
     recordOtelBatch(otelBatch)
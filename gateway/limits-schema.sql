@@ -22,3 +22,11 @@ CREATE TABLE IF NOT EXISTS keyStatus (
   expiresAt TIMESTAMP
 );
 CREATE INDEX IF NOT EXISTS idxKeyStatusExpiresAt ON keyStatus (expiresAt);
+
+-- batches whose spend has been recorded, so it's recorded once however many times an ended batch is retrieved
+CREATE TABLE IF NOT EXISTS batchSpend (
+  -- provider id and batch id
+  batchId TEXT NOT NULL PRIMARY KEY,
+  recordedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idxBatchSpendRecordedAt ON batchSpend (recordedAt);
@@ -0,0 +1,93 @@
+/**
+ * Sticky routing within routing groups, so consecutive turns of a conversation reach the same provider and reuse its
+ * prompt cache.
+ */
+
+import { requestText } from './compression'
+
+/** Requests with the same value of this header are routed to the same provider. */
+export const AFFINITY_HEADER = 'x-affinity-key'
+// the system prompt and the first messages, which every later turn of the conversation repeats unchanged
+const PROMPT_MESSAGES = 2
+
+export interface RoutingAffinity {
+  key: string
+  source: 'header' | 'prompt'
+}
+
+/**
+ * The affinity key of a request from `caller`, either the `x-affinity-key` header, or a digest of the start of the
+ * conversation in the decoded body.
+ *
+ * Clients send the conversation so far on every turn, so the system prompt and the first `PROMPT_MESSAGES` messages
+ * are stable across the turns of a conversation, while conversations sharing a system prompt still spread across
+ * providers. `caller` is mixed in, so different keys sending the same prompt are routed independently. Returns null
+ * for bodies without messages.
+ */
+export async function routingAffinity(request: Request, caller: string): Promise<RoutingAffinity | null> {
+  const header = request.headers.get(AFFINITY_HEADER)
+  if (header) {
+    return { key: `${caller}:${header}`, source: 'header' }
+  }
+  const prompt = await promptStart(request)
+  if (!prompt) {
+    return null
+  }
+  const data = new TextEncoder().encode(`${caller}:${prompt}`)
+  const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', data))
+  const key = Array.from(digest, (byte) => byte.toString(16).padStart(2, '0')).join('')
+  return { key, source: 'prompt' }
+}
+
+/**
+ * The system prompt and first messages of an OpenAI, Anthropic, Google or Bedrock request body, serialized.
+ *
+ * Reads a clone, so the request stays readable. Returns null if the body can't be decoded or has no messages, the
+ * handler reports those errors.
+ */
+async function promptStart(request: Request): Promise<string | null> {
+  let body: unknown
+  try {
+    const text = await requestText(request.clone())
+    body = text === null ? null : JSON.parse(text)
+  } catch {
+    return null
+  }
+  if (typeof body !== 'object' || body === null) {
+    return null
+  }
+  const { messages, input, contents, system, instructions, systemInstruction } = body as Record<string, unknown>
+  const conversation = messages ?? contents ?? (typeof input === 'string' ? [input] : input)
+  if (!Array.isArray(conversation) || conversation.length === 0) {
+    return null
+  }
+  return JSON.stringify([system, instructions, systemInstruction, conversation.slice(0, PROMPT_MESSAGES)])
+}
+
+/**
+ * Order items by weighted rendezvous hashing of `affinityKey`, a deterministic alternative to `weightedRandomSample`.
+ *
+ * The same key always gives the same order. Across keys, an item comes first with probability proportional to its
+ * weight, and zero-weight items come last.
+ */
+export function affinitySample<T extends { key: string; weight: number }>(items: T[], affinityKey: string): T[] {
+  return items
+    .map((item) => {
+      // uniform in (0, 1)
+      const u = (hash32(`${affinityKey}:${item.key}`) + 0.5) / 2 ** 32
+      return { item, u, score: item.weight / -Math.log(u) }
+    })
+    .sort((a, b) => b.score - a.score || b.u - a.u)
+    .map(({ item }) => item)
+}
+
+/** FNV-1a, with the murmur3 finalizer so similar inputs give unrelated hashes. */
+function hash32(input: string): number {
+  let hash = 0x811c9dc5
+  for (let i = 0; i < input.length; i++) {
+    hash = Math.imul(hash ^ input.charCodeAt(i), 0x01000193)
+  }
+  hash = Math.imul(hash ^ (hash >>> 16), 0x85ebca6b)
+  hash = Math.imul(hash ^ (hash >>> 13), 0xc2b2ae35)
+  return (hash ^ (hash >>> 16)) >>> 0
+}
@@ -0,0 +1,129 @@
+import logfire from 'logfire'
+import type { KeysDb } from './db'
+import { runAfter } from './utils'
+
+export interface ApiKeyFilterOptions {
+  /** How often in milliseconds the filter is rebuilt from the keys DB, defaults to 60_000 */
+  refreshIntervalMs?: number
+  /** Target false positive rate of the filter, defaults to 0.001 */
+  falsePositiveRate?: number
+}
+
+const encoder = new TextEncoder()
+
+/** SHA-256 of an API key, used so unknown keys are never stored or held as given. */
+export async function hashApiKey(key: string): Promise<Uint8Array> {
+  return new Uint8Array(await crypto.subtle.digest('SHA-256', encoder.encode(key)))
+}
+
+export function hexDigest(digest: Uint8Array): string {
+  return Array.from(digest, (byte) => byte.toString(16).padStart(2, '0')).join('')
+}
+
+export function fromHexDigest(hex: string): Uint8Array {
+  return Uint8Array.from(hex.match(/../g) ?? [], (byte) => Number.parseInt(byte, 16))
+}
+
+/** A Bloom filter over SHA-256 digests, using double hashing on the first 8 bytes of the digest. */
+export class BloomFilter {
+  readonly bits: Uint8Array
+  readonly size: number
+  readonly hashCount: number
+
+  constructor(capacity: number, falsePositiveRate: number) {
+    const n = Math.max(capacity, 1)
+    this.size = Math.max(Math.ceil((-n * Math.log(falsePositiveRate)) / Math.LN2 ** 2), 8)
+    this.hashCount = Math.max(Math.round((this.size / n) * Math.LN2), 1)
+    this.bits = new Uint8Array(Math.ceil(this.size / 8))
+  }
+
+  add(digest: Uint8Array) {
+    for (const index of this.indexes(digest)) {
+      this.bits[index >>> 3]! |= 1 << (index & 7)
+    }
+  }
+
+  has(digest: Uint8Array): boolean {
+    for (const index of this.indexes(digest)) {
+      if ((this.bits[index >>> 3]! & (1 << (index & 7))) === 0) {
+        return false
+      }
+    }
+    return true
+  }
+
+  private *indexes(digest: Uint8Array): Generator<number> {
+    const view = new DataView(digest.buffer, digest.byteOffset, digest.byteLength)
+    const h1 = view.getUint32(0)
+    // nonzero, and `>>> 0` as `|` returns a signed integer
+    const h2 = (view.getUint32(4) | 1) >>> 0
+    for (let i = 0; i < this.hashCount; i++) {
+      yield (h1 + i * h2) % this.size
+    }
+  }
+}
+
+/**
+ * In-memory Bloom filter of the valid API keys, so requests with unknown keys are rejected without any I/O.
+ *
+ * The filter is built from `KeysDb.listApiKeyDigests()`, so the keys themselves are never read. It's built after
+ * the response is sent, and rebuilt every `refreshIntervalMs`, requests meanwhile use the stale filter, or query the
+ * keys DB before the first build. Keys passed to `setApiKeyCache` are added immediately, so a key created elsewhere is
+ * accepted by this isolate at most one refresh interval later. If the keys DB can't list its key digests, which is
+ * the `KeysDb` default, the filter accepts every key.
+ */
+export class ApiKeyFilter {
+  private readonly refreshIntervalMs: number
+  private readonly falsePositiveRate: number
+  private filter: BloomFilter | null = null
+  private builtAt = 0
+  private rebuilding: Promise<void> | null = null
+
+  constructor(options: ApiKeyFilterOptions = {}) {
+    this.refreshIntervalMs = options.refreshIntervalMs ?? 60_000
+    this.falsePositiveRate = options.falsePositiveRate ?? 0.001
+  }
+
+  /** Whether the key with this digest may exist, `false` means it certainly doesn't. */
+  mightExist(digest: Uint8Array, keysDb: KeysDb, ctx: ExecutionContext): Promise<boolean> {
+    const stale = this.builtAt === 0 || Date.now() - this.builtAt > this.refreshIntervalMs
+    if (stale && this.rebuilding === null) {
+      runAfter(ctx, 'rebuildApiKeyFilter', this.refresh(keysDb))
+    }
+    // until the first build is done, every key might exist, so requests fall through to the keys DB
+    return Promise.resolve(this.filter?.has(digest) ?? true)
+  }
+
+  add(digest: Uint8Array) {
+    this.filter?.add(digest)
+  }
+
+  private refresh(keysDb: KeysDb): Promise<void> {
+    // concurrent requests share one rebuild
+    this.rebuilding ??= this.rebuild(keysDb).finally(() => {
+      this.rebuilding = null
+    })
+    return this.rebuilding
+  }
+
+  private async rebuild(keysDb: KeysDb) {
+    try {
+      const digests = await keysDb.listApiKeyDigests()
+      if (digests === null) {
+        this.filter = null
+      } else {
+        // leave room for keys added before the next rebuild
+        const filter = new BloomFilter(digests.length * 2, this.falsePositiveRate)
+        for (const digest of digests) {
+          filter.add(fromHexDigest(digest))
+        }
+        this.filter = filter
+      }
+    } catch (error) {
+      // fail open, the keys DB is still the source of truth
+      logfire.reportError('Error rebuilding API key filter', error as Error)
+      this.filter = null
+    }
+    this.builtAt = Date.now()
+  }
+}
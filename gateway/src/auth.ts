@@ -1,9 +1,16 @@
 import type { GatewayOptions } from '.'
+import { hashApiKey, hexDigest } from './apiKeyFilter'
 import type { RateLimiter } from './rateLimiter'
 import type { ApiKeyInfo } from './types'
 import { runAfter, textResponse } from './utils'
 
 const CACHE_TTL = 86400 * 30
+// short, so a new key is soon accepted by isolates where `setApiKeyCache` isn't called for it
+const UNKNOWN_KEY_TTL_MS = 60_000
+const MAX_UNKNOWN_KEYS = 10_000
+// digests of keys recently found unknown by this isolate, with when they expire, held in memory rather than in KV, so
+// a scanner trying many keys doesn't cause a KV write for each
+const unknownKeys = new Map<string, number>()
 
 export async function apiKeyAuth(
   request: Request,
@@ -23,7 +30,8 @@ export async function apiKeyAuth(
 
   const cacheKey = apiKeyCacheKey(key, options.kvVersion)
   const cacheResult = await options.cache.getWithMetadata<ApiKeyInfo, string>(cacheKey, { type: 'json' })
-  let rateLimiterStarted = false
+  // the cached key info the limiter was started with, if the key has to be re-validated
+  let startedWith: ApiKeyInfo | null = null
 
   // if we have a cached api key, use that
   if (cacheResult?.value) {
@@ -41,12 +49,30 @@ export async function apiKeyAuth(
     if (projectState === null || projectState === cacheResult.metadata) {
       return apiKeyInfo
     }
-    rateLimiterStarted = true
+    startedWith = apiKeyInfo
   }
 
-  const apiKeyInfo = await options.keysDb.getApiKey(key)
+  const digest = await hashApiKey(key)
+  const hexKeyDigest = hexDigest(digest)
+  // unless the key was cached, reject unknown keys without querying the keys DB, e.g. from a scanner
+  if (!startedWith) {
+    if (options.apiKeyFilter && !(await options.apiKeyFilter.mightExist(digest, options.keysDb, ctx))) {
+      return textResponse(401, 'Unauthorized - Key not found')
+    }
+    if (isUnknownKey(hexKeyDigest)) {
+      return textResponse(401, 'Unauthorized - Key not found')
+    }
+  }
+
+  let apiKeyInfo: ApiKeyInfo | null
+  try {
+    apiKeyInfo = await options.keysDb.getApiKey(key)
+  } catch (error) {
+    releaseSlots(ctx, rateLimiter, startedWith)
+    throw error
+  }
   if (apiKeyInfo) {
-    if (!rateLimiterStarted) {
+    if (!startedWith) {
       const limiterResult = await rateLimiter.requestStart(apiKeyInfo)
       const limiterResponse = processLimiterResult(limiterResult)
       if (limiterResponse) {
@@ -56,14 +82,21 @@ export async function apiKeyAuth(
     runAfter(ctx, 'setApiKeyCache', setApiKeyCache(apiKeyInfo, options))
     return apiKeyInfo
   }
+  // the key is no longer valid, the caller only finishes the limiter for keys it's given
+  releaseSlots(ctx, rateLimiter, startedWith)
+  addUnknownKey(hexKeyDigest)
   return textResponse(401, 'Unauthorized - Key not found')
 }
 
 export async function setApiKeyCache(
   apiKey: ApiKeyInfo,
-  options: Pick<GatewayOptions, 'cache' | 'kvVersion'>,
+  options: Pick<GatewayOptions, 'cache' | 'kvVersion' | 'apiKeyFilter'>,
   expirationTtl?: number,
 ) {
+  const digest = await hashApiKey(apiKey.key)
+  options.apiKeyFilter?.add(digest)
+  // the key may have just been created, so forget that it was unknown
+  unknownKeys.delete(hexDigest(digest))
   const projectState = await options.cache.get(projectStateCacheKey(apiKey.project, options.kvVersion))
 
   await options.cache.put(apiKeyCacheKey(apiKey.key, options.kvVersion), JSON.stringify(apiKey), {
@@ -120,6 +153,32 @@ function getHeaderKey(request: Request, headerName: string): string | null {
 const apiKeyCacheKey = (key: string, kvVersion: string) => `apiKeyAuth:${kvVersion}:${key}`
 const projectStateCacheKey = (project: number, kvVersion: string) => `projectState:${kvVersion}:${project}`
 
+function isUnknownKey(digest: string): boolean {
+  const expires = unknownKeys.get(digest)
+  if (expires === undefined) {
+    return false
+  }
+  if (expires > Date.now()) {
+    return true
+  }
+  unknownKeys.delete(digest)
+  return false
+}
+
+function addUnknownKey(digest: string) {
+  if (unknownKeys.size >= MAX_UNKNOWN_KEYS) {
+    // a Map iterates in insertion order, so this forgets the oldest key
+    unknownKeys.delete(unknownKeys.keys().next().value!)
+  }
+  unknownKeys.set(digest, Date.now() + UNKNOWN_KEY_TTL_MS)
+}
+
+function releaseSlots(ctx: ExecutionContext, rateLimiter: RateLimiter, startedWith: ApiKeyInfo | null) {
+  if (startedWith) {
+    runAfter(ctx, 'rateLimiter.requestFinish', rateLimiter.requestFinish(startedWith))
+  }
+}
+
 function processLimiterResult(limiterResult: string | null) {
   if (typeof limiterResult === 'string') {
     return textResponse(429, limiterResult)
@@ -0,0 +1,114 @@
+import { calcPrice, extractUsage, type Usage, type Provider as UsageProvider } from '@pydantic/genai-prices'
+import logfire from 'logfire'
+
+/** Both OpenAI and Anthropic bill batch requests at half the price of synchronous requests. */
+export const BATCH_DISCOUNT = 0.5
+
+// the API flavor used to extract usage from an OpenAI result body, by the body's `object`
+const OPENAI_FLAVORS: Record<string, string> = {
+  'chat.completion': 'chat',
+  response: 'responses',
+  list: 'embeddings',
+}
+
+/**
+ * Extracts usage and cost from a batch results file as it streams through, one JSONL line at a time.
+ *
+ * Handles OpenAI output files, where each line is `{"custom_id", "response": {"status_code", "body"}}`, and Anthropic
+ * results, where each line is `{"custom_id", "result": {"type": "succeeded", "message"}}`. Failed requests aren't
+ * billed, so they're counted but not priced.
+ */
+export class BatchResults {
+  readonly usage: Usage = {}
+  cost = 0
+  results = 0
+  succeeded = 0
+  /** models of succeeded results that couldn't be priced */
+  readonly unpriced = new Set<string>()
+
+  private readonly usageProvider: UsageProvider
+  private readonly replaceModel: (model: string) => string
+  private readonly decoder = new TextDecoder()
+  private buffer = ''
+
+  constructor(usageProvider: UsageProvider, replaceModel: (model: string) => string = (model) => model) {
+    this.usageProvider = usageProvider
+    this.replaceModel = replaceModel
+  }
+
+  feed(chunk: Uint8Array) {
+    this.buffer += this.decoder.decode(chunk, { stream: true })
+    const lines = this.buffer.split('\n')
+    // the last line may be incomplete
+    this.buffer = lines.pop()!
+    for (const line of lines) {
+      this.addLine(line)
+    }
+  }
+
+  /** Process the last line, which may not end with a newline. */
+  end() {
+    this.addLine(this.buffer + this.decoder.decode())
+    this.buffer = ''
+  }
+
+  private addLine(line: string) {
+    if (!line.trim()) {
+      return
+    }
+    this.results++
+    let result: unknown
+    try {
+      result = JSON.parse(line)
+    } catch (error) {
+      logfire.reportError('Error parsing batch result', error as Error)
+      return
+    }
+    const response = successfulResponse(result)
+    if (!response) {
+      return
+    }
+    this.succeeded++
+
+    let model: string | null = null
+    try {
+      const extracted = extractUsage(this.usageProvider, response.body, response.apiFlavor)
+      model = extracted.model ? this.replaceModel(extracted.model) : null
+      const price = model ? calcPrice(extracted.usage, model, { provider: this.usageProvider }) : undefined
+      if (price) {
+        this.cost += price.total_price * BATCH_DISCOUNT
+        addUsage(this.usage, extracted.usage)
+        return
+      }
+    } catch (error) {
+      logfire.reportError('Error extracting usage from batch result', error as Error)
+    }
+    this.unpriced.add(model ?? 'unknown')
+  }
+}
+
+function successfulResponse(result: unknown): { body: object; apiFlavor: string } | null {
+  if (!isMapping(result)) {
+    return null
+  }
+  const { response, result: anthropicResult } = result
+  if (isMapping(response) && response.status_code === 200 && isMapping(response.body)) {
+    return { body: response.body, apiFlavor: OPENAI_FLAVORS[String(response.body.object)] ?? 'chat' }
+  }
+  if (isMapping(anthropicResult) && anthropicResult.type === 'succeeded' && isMapping(anthropicResult.message)) {
+    return { body: anthropicResult.message, apiFlavor: 'default' }
+  }
+  return null
+}
+
+function addUsage(total: Usage, usage: Usage) {
+  for (const [key, value] of Object.entries(usage) as [keyof Usage, unknown][]) {
+    if (typeof value === 'number') {
+      total[key] = (total[key] ?? 0) + value
+    }
+  }
+}
+
+function isMapping(v: unknown): v is Record<string, unknown> {
+  return v !== null && !Array.isArray(v) && typeof v === 'object'
+}
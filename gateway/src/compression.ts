@@ -0,0 +1,90 @@
+/**
+ * Encodings requested from providers, the Workers runtime transparently decodes these in `fetch`, so usage is always
+ * extracted from decoded bytes as they stream past.
+ */
+export const UPSTREAM_ACCEPT_ENCODING = 'br, gzip'
+
+// Encodings the runtime applies to outgoing responses when set in `content-encoding`, in order of preference
+const RESPONSE_ENCODINGS = ['br', 'gzip'] as const
+type ResponseEncoding = (typeof RESPONSE_ENCODINGS)[number]
+
+// Request encodings we can decode, `deflate` in HTTP is the zlib format which matches `DecompressionStream`
+const REQUEST_ENCODINGS = ['gzip', 'deflate'] as const
+
+/** Responses smaller than this aren't worth compressing */
+const MIN_COMPRESS_SIZE = 1024
+
+/**
+ * Decompressed request bodies larger than this are rejected, well above any prompt a model accepts and well below the
+ * Worker's memory limit, which a small compressed body could otherwise exhaust.
+ */
+export const MAX_DECOMPRESSED_SIZE = 32 * 1024 * 1024
+
+export class RequestTooLarge extends Error {
+  constructor(maxSize: number) {
+    super(`decompressed request body exceeds ${maxSize} bytes`)
+  }
+}
+
+/**
+ * Read the request body as text, decompressing it according to `content-encoding`.
+ *
+ * Returns null if the encoding isn't supported, throws `RequestTooLarge` if the decompressed body exceeds `maxSize`.
+ */
+export async function requestText(request: Request, maxSize = MAX_DECOMPRESSED_SIZE): Promise<string | null> {
+  const encoding = request.headers.get('content-encoding')?.trim().toLowerCase()
+  if (!encoding || encoding === 'identity') {
+    return await request.text()
+  }
+  const format = REQUEST_ENCODINGS.find((e) => e === encoding)
+  if (!format) {
+    return null
+  }
+  if (!request.body) {
+    return ''
+  }
+  const reader = request.body.pipeThrough(new DecompressionStream(format)).getReader()
+  const decoder = new TextDecoder()
+  let text = ''
+  let size = 0
+  for (;;) {
+    const { done, value } = await reader.read()
+    if (done) {
+      return text + decoder.decode()
+    }
+    size += value.byteLength
+    if (size > maxSize) {
+      await reader.cancel()
+      throw new RequestTooLarge(maxSize)
+    }
+    text += decoder.decode(value, { stream: true })
+  }
+}
+
+/**
+ * Choose an encoding for a response body based on the client's `accept-encoding` header.
+ *
+ * Setting the result as `content-encoding` makes the runtime compress the body as it's sent.
+ */
+export function responseEncoding(acceptEncoding: string | null, bodyLength: number): ResponseEncoding | null {
+  if (!acceptEncoding || bodyLength < MIN_COMPRESS_SIZE) {
+    return null
+  }
+  const accepted = new Map<string, number>()
+  for (const item of acceptEncoding.split(',')) {
+    const [name, ...params] = item.split(';').map((part) => part.trim().toLowerCase())
+    const q = params.find((param) => param.startsWith('q='))
+    accepted.set(name!, q ? Number(q.slice(2)) : 1)
+  }
+
+  let best: ResponseEncoding | null = null
+  let bestQ = 0
+  for (const encoding of RESPONSE_ENCODINGS) {
+    const q = accepted.get(encoding) ?? accepted.get('*') ?? 0
+    if (q > bestQ) {
+      best = encoding
+      bestQ = q
+    }
+  }
+  return best
+}
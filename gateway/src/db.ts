@@ -3,6 +3,15 @@ import type { ApiKeyInfo, KeyStatus } from './types'
 export abstract class KeysDb {
   abstract getApiKey(key: string): Promise<ApiKeyInfo | null>
 
+  /**
+   * Hex SHA-256 digests (see `hashApiKey`) of all keys `getApiKey` accepts, as clients send them, used to build the
+   * `ApiKeyFilter` from stored hashes rather than the keys themselves.
+   * Returns null if the digests can't be listed, in which case the filter accepts every key.
+   */
+  listApiKeyDigests(): Promise<string[] | null> {
+    return Promise.resolve(null)
+  }
+
   abstract disableKey(id: number, reason: string, newStatus: KeyStatus, expirationTtl?: number): Promise<void>
 }
 
@@ -50,6 +59,11 @@ export interface SpendStatus {
   spend: number
 }
 
+export type SpendStatusByEntity = Record<EntityType, Map<number, SpendStatus[]>>
+
+// batches claimed by `LimitDb.claimBatchSpend`'s default implementation
+const claimedBatches = new Set<string>()
+
 export abstract class LimitDb {
   // increment spends and return IDs of any scopes that have exceeded the spending limit
   abstract incrementSpend(spendScopes: SpendScope[], spend: number): Promise<ExceededScope[]>
@@ -61,6 +75,88 @@ export abstract class LimitDb {
   abstract updateKeyLimits(keyId: number, update: KeyLimitUpdate): Promise<void>
 
   abstract spendStatus(entityType: EntityType, entityId?: number): Promise<SpendStatus[]>
+
+  /**
+   * Mark the spend of a batch as recorded, returns false if it already was.
+   *
+   * Implementations should override this with a strongly consistent insert-if-absent, so a batch retrieved
+   * concurrently from several isolates has its spend recorded once, this default only remembers the batches claimed
+   * in this isolate.
+   */
+  claimBatchSpend(batchId: string): Promise<boolean> {
+    if (claimedBatches.has(batchId)) {
+      return Promise.resolve(false)
+    }
+    claimedBatches.add(batchId)
+    return Promise.resolve(true)
+  }
+
+  /**
+   * Spend of all entities grouped by entity type and ID, only including intervals ending on or after
+   * `minScopeInterval` (days since 1970-01-01).
+   *
+   * Implementations should override this to fetch all entities in one query.
+   */
+  async spendStatusByEntity(minScopeInterval = 0): Promise<SpendStatusByEntity> {
+    const grouped: SpendStatusByEntity = { project: new Map(), user: new Map(), key: new Map() }
+    for (const entityType of ['project', 'user', 'key'] as const) {
+      for (const status of await this.spendStatus(entityType)) {
+        if (status.scopeInterval === null || status.scopeInterval.raw >= minScopeInterval) {
+          groupSpendStatus(grouped[entityType], status)
+        }
+      }
+    }
+    return grouped
+  }
+}
+
+export function groupSpendStatus(group: Map<number, SpendStatus[]>, status: SpendStatus) {
+  const entitySpend = group.get(status.entityId)
+  if (entitySpend) {
+    entitySpend.push(status)
+  } else {
+    group.set(status.entityId, [status])
+  }
+}
+
+/** The spend scopes a request's spend is added to, with the key's limits. */
+export function spendScopes(apiKey: ApiKeyInfo): SpendScope[] {
+  const { day, eow, eom } = currentScopeIntervals()
+
+  const {
+    id: keyId,
+    project,
+    user,
+    keySpendingLimitDaily: keyDaily,
+    keySpendingLimitWeekly: keyWeekly,
+    keySpendingLimitMonthly: keyMonthly,
+    keySpendingLimitTotal: keyTotal,
+    projectSpendingLimitDaily: projectDaily,
+    projectSpendingLimitWeekly: projectWeekly,
+    projectSpendingLimitMonthly: projectMonthly,
+    userSpendingLimitDaily: userDaily,
+    userSpendingLimitWeekly: userWeekly,
+    userSpendingLimitMonthly: userMonthly,
+  } = apiKey
+
+  const intervalSpends: SpendScope[] = [
+    { entityId: keyId, entityType: 'key', scope: 'daily', scopeInterval: day, limit: keyDaily },
+    { entityId: keyId, entityType: 'key', scope: 'weekly', scopeInterval: eow, limit: keyWeekly },
+    { entityId: keyId, entityType: 'key', scope: 'monthly', scopeInterval: eom, limit: keyMonthly },
+    { entityId: keyId, entityType: 'key', scope: 'total', limit: keyTotal },
+    { entityId: project, entityType: 'project', scope: 'daily', scopeInterval: day, limit: projectDaily },
+    { entityId: project, entityType: 'project', scope: 'weekly', scopeInterval: eow, limit: projectWeekly },
+    { entityId: project, entityType: 'project', scope: 'monthly', scopeInterval: eom, limit: projectMonthly },
+  ]
+
+  if (user != null) {
+    intervalSpends.push(
+      { entityId: user, entityType: 'user', scope: 'daily', scopeInterval: day, limit: userDaily },
+      { entityId: user, entityType: 'user', scope: 'weekly', scopeInterval: eow, limit: userWeekly },
+      { entityId: user, entityType: 'user', scope: 'monthly', scopeInterval: eom, limit: userMonthly },
+    )
+  }
+  return intervalSpends
 }
 
 // Helper functions for date/time handling
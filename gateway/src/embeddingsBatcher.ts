@@ -0,0 +1,258 @@
+import logfire from 'logfire'
+import type { CreateEmbeddingResponse, Embedding, EmbeddingCreateParams } from 'openai/resources/embeddings'
+
+export interface EmbeddingsBatcherOptions {
+  /** Maximum number of inputs merged into a single upstream request, defaults to 2048 (the OpenAI limit) */
+  maxBatchSize?: number
+  /**
+   * Maximum input tokens merged into a single upstream request, defaults to 300,000 (the OpenAI limit).
+   * Text inputs are counted as their UTF-8 length, which is never less than their number of tokens.
+   */
+  maxBatchTokens?: number
+  /** Maximum time in milliseconds the first request of a batch waits for others to join, defaults to 10 */
+  maxWaitMs?: number
+}
+
+export interface BatchedEmbeddingsRequest {
+  url: string
+  /** Requests are only merged if they use the same upstream credentials and headers */
+  credentials: string
+  headers: Headers
+  requestBody: EmbeddingCreateParams
+  fetch: (url: string, init: RequestInit) => Promise<Response>
+}
+
+type EmbeddingInput = string | number[]
+
+// headers that differ between requests without changing what's sent upstream, e.g. tracing and SDK telemetry,
+// all other headers must match for requests to be merged
+const PER_REQUEST_HEADERS = new Set(['content-length', 'traceparent', 'tracestate', 'baggage', 'x-request-id'])
+const PER_REQUEST_HEADER_PREFIXES = ['cf-', 'x-forwarded-', 'x-stainless-']
+
+/**
+ * An upstream response as plain data, the `Response` is built by each caller, as I/O objects like a `Response`
+ * can't be used outside the request that created them.
+ */
+interface BatchResult {
+  status: number
+  headers: [string, string][]
+  body: string
+}
+
+interface PendingCall {
+  inputs: EmbeddingInput[]
+  /** null if the merged request failed with another caller's fetch, so this call is sent on its own */
+  resolve: (result: BatchResult | null) => void
+  reject: (error: unknown) => void
+}
+
+interface PendingBatch {
+  request: BatchedEmbeddingsRequest
+  calls: PendingCall[]
+  size: number
+  tokens: number
+  timer: ReturnType<typeof setTimeout>
+}
+
+/**
+ * Merges concurrent embeddings requests to the same provider and model into a single upstream call.
+ *
+ * Only requests with the same credentials and headers are merged, up to the provider's limits on inputs and tokens
+ * per request. The merged request is sent with the first caller's fetch; if that fails, e.g. because the first
+ * caller's request was cancelled, the other callers send their own requests.
+ *
+ * Each caller receives a response containing only its own embeddings, with `usage` set to its share of the
+ * upstream usage, so usage extraction and spend recording work exactly as they do for unbatched requests.
+ *
+ * Token inputs are attributed exactly, text inputs are attributed proportionally to their length.
+ */
+export class EmbeddingsBatcher {
+  private readonly maxBatchSize: number
+  private readonly maxBatchTokens: number
+  private readonly maxWaitMs: number
+  private readonly pending = new Map<string, PendingBatch>()
+
+  constructor(options: EmbeddingsBatcherOptions = {}) {
+    this.maxBatchSize = options.maxBatchSize ?? 2048
+    this.maxBatchTokens = options.maxBatchTokens ?? 300_000
+    this.maxWaitMs = options.maxWaitMs ?? 10
+  }
+
+  async fetch(request: BatchedEmbeddingsRequest): Promise<Response> {
+    const { input, ...params } = request.requestBody
+    const inputs = normalizeInput(input)
+    const tokens = inputs ? inputTokens(inputs) : 0
+    // inputs that can't be merged, e.g. empty or larger than a batch, are sent on their own
+    if (inputs === null || inputs.length === 0 || inputs.length > this.maxBatchSize || tokens > this.maxBatchTokens) {
+      return await sendAlone(request)
+    }
+
+    // text and token inputs can't be mixed in one request
+    const inputKind = typeof inputs[0] === 'string' ? 'text' : 'tokens'
+    const headers = [...request.headers].filter(([name]) => !isPerRequestHeader(name))
+    const batchKey = JSON.stringify([request.url, request.credentials, headers, inputKind, sortedEntries(params)])
+
+    let batch = this.pending.get(batchKey)
+    if (batch && (batch.size + inputs.length > this.maxBatchSize || batch.tokens + tokens > this.maxBatchTokens)) {
+      this.flush(batchKey)
+      batch = undefined
+    }
+    if (!batch) {
+      const timer = setTimeout(() => this.flush(batchKey), this.maxWaitMs)
+      batch = { request, calls: [], size: 0, tokens: 0, timer }
+      this.pending.set(batchKey, batch)
+    }
+
+    const currentBatch = batch
+    const result = await new Promise<BatchResult | null>((resolve, reject) => {
+      currentBatch.calls.push({ inputs, resolve, reject })
+      currentBatch.size += inputs.length
+      currentBatch.tokens += tokens
+      if (currentBatch.size >= this.maxBatchSize || currentBatch.tokens >= this.maxBatchTokens) {
+        this.flush(batchKey)
+      }
+    })
+    if (result === null) {
+      return await sendAlone(request)
+    }
+    return new Response(result.body, { status: result.status, headers: result.headers })
+  }
+
+  private flush(batchKey: string) {
+    const batch = this.pending.get(batchKey)
+    if (!batch) return
+    this.pending.delete(batchKey)
+    clearTimeout(batch.timer)
+    this.send(batch).catch((error: unknown) => {
+      logfire.reportError('Error sending embeddings batch', error as Error)
+      for (const { reject } of batch.calls) {
+        reject(error)
+      }
+    })
+  }
+
+  private async send({ request, calls }: PendingBatch): Promise<void> {
+    const headers = new Headers(request.headers)
+    headers.delete('content-length')
+    const body = JSON.stringify({ ...request.requestBody, input: calls.flatMap(({ inputs }) => inputs) })
+
+    let response: Response
+    let responseBody: CreateEmbeddingResponse
+    try {
+      response = await request.fetch(request.url, { method: 'POST', headers, body })
+      if (!response.ok) {
+        const errorText = await response.text()
+        for (const { resolve } of calls) {
+          resolve({ status: response.status, headers: [...response.headers], body: errorText })
+        }
+        return
+      }
+      responseBody = await response.json()
+    } catch (error) {
+      // the fetch belongs to the first caller, the others may still succeed on their own
+      const [first, ...others] = calls
+      first?.reject(error)
+      for (const { resolve } of others) {
+        resolve(null)
+      }
+      return
+    }
+
+    const responseHeaders = new Headers(response.headers)
+    responseHeaders.delete('content-length')
+    responseHeaders.delete('content-encoding')
+    const headerEntries = [...responseHeaders]
+
+    const promptTokens = splitTokens(responseBody.usage.prompt_tokens, calls.map(({ inputs }) => inputs))
+
+    // map each input of the merged request back to the call it came from
+    const callOffsets: number[] = []
+    const callIndex: number[] = []
+    calls.forEach(({ inputs }, i) => {
+      callOffsets.push(callIndex.length)
+      for (let j = 0; j < inputs.length; j++) {
+        callIndex.push(i)
+      }
+    })
+    const callData: Embedding[][] = calls.map(() => [])
+    for (const embedding of responseBody.data) {
+      const i = callIndex[embedding.index]
+      if (i !== undefined) {
+        callData[i]!.push({ ...embedding, index: embedding.index - callOffsets[i]! })
+      }
+    }
+
+    calls.forEach(({ resolve }, i) => {
+      const tokens = promptTokens[i]!
+      const callBody: CreateEmbeddingResponse = {
+        ...responseBody,
+        data: callData[i]!,
+        usage: { prompt_tokens: tokens, total_tokens: tokens },
+      }
+      resolve({ status: response.status, headers: headerEntries, body: JSON.stringify(callBody) })
+    })
+  }
+}
+
+function isPerRequestHeader(name: string): boolean {
+  return PER_REQUEST_HEADERS.has(name) || PER_REQUEST_HEADER_PREFIXES.some((prefix) => name.startsWith(prefix))
+}
+
+function sendAlone(request: BatchedEmbeddingsRequest): Promise<Response> {
+  const body = JSON.stringify(request.requestBody)
+  return request.fetch(request.url, { method: 'POST', headers: request.headers, body })
+}
+
+/** An upper bound of the tokens in `inputs`, as each token covers at least one byte of UTF-8 text. */
+function inputTokens(inputs: EmbeddingInput[]): number {
+  const encoder = new TextEncoder()
+  return inputs.reduce(
+    (sum, input) => sum + (typeof input === 'string' ? encoder.encode(input).length : input.length),
+    0,
+  )
+}
+
+/** Normalize the `input` field to a list of inputs, or null if it has an unexpected shape. */
+function normalizeInput(input: EmbeddingCreateParams['input']): EmbeddingInput[] | null {
+  if (typeof input === 'string') {
+    return [input]
+  }
+  if (!Array.isArray(input)) {
+    return null
+  }
+  if (input.every((item) => typeof item === 'string')) {
+    return input as string[]
+  }
+  if (input.every((item) => typeof item === 'number')) {
+    return [input as number[]]
+  }
+  if (input.every((item) => Array.isArray(item))) {
+    return input as number[][]
+  }
+  return null
+}
+
+function sortedEntries(params: object): [string, unknown][] {
+  return Object.entries(params).sort(([a], [b]) => a.localeCompare(b))
+}
+
+/**
+ * Split the upstream token count between callers.
+ *
+ * Token inputs are counted exactly, text inputs are weighted by character length. Rounding uses the largest
+ * remainder method so the parts always add up to `total`.
+ */
+function splitTokens(total: number, callInputs: EmbeddingInput[][]): number[] {
+  const weights = callInputs.map((inputs) => inputs.reduce((sum, input) => sum + Math.max(input.length, 1), 0))
+  const totalWeight = weights.reduce((sum, weight) => sum + weight, 0)
+  const exact = weights.map((weight) => (total * weight) / totalWeight)
+  const parts = exact.map(Math.floor)
+  let remainder = total - parts.reduce((sum, part) => sum + part, 0)
+  const byRemainder = exact.map((value, i) => [value - Math.floor(value), i] as const).sort(([a], [b]) => b - a)
+  for (const [, i] of byRemainder) {
+    if (remainder <= 0) break
+    parts[i]!++
+    remainder--
+  }
+  return parts
+}
@@ -1,10 +1,14 @@
+import type { Usage } from '@pydantic/genai-prices'
 import logfire from 'logfire'
 import { type GatewayOptions, noopLimiter } from '.'
+import { affinitySample, type RoutingAffinity, routingAffinity } from './affinity'
 import { apiKeyAuth, setApiKeyCache } from './auth'
-import { currentScopeIntervals, type ExceededScope, endOfMonth, endOfWeek, type SpendScope } from './db'
+import { responseEncoding } from './compression'
+import { type ExceededScope, endOfMonth, endOfWeek, spendScopes } from './db'
 import { type HandlerResponse, RequestHandler } from './handler'
 import { OtelTrace } from './otel'
 import { genAiOtelAttributes } from './otel/attributes'
+import { ServerTiming } from './timing'
 import type { ApiKeyInfo, ProviderProxy } from './types'
 import { runAfter, textResponse } from './utils'
 
@@ -30,15 +34,33 @@ export async function gateway(
   }
 
   const rateLimiter = options.rateLimiter ?? noopLimiter
-  const authResult = await apiKeyAuth(request, ctx, options, rateLimiter)
+  const timing = new ServerTiming()
+  // the limiter is finished with the key info it was started with, which may be a stale cached copy
+  let limitedKeyInfo: ApiKeyInfo | null = null
+  // `auth` includes looking up the key in the cache or KeysDb, `ratelimit` runs concurrently with the cache lookup
+  const authResult = await timing.time('auth', () =>
+    apiKeyAuth(request, ctx, options, {
+      requestStart: (keyInfo) => {
+        limitedKeyInfo = keyInfo
+        return timing.time('ratelimit', () => rateLimiter.requestStart(keyInfo))
+      },
+      requestFinish: (keyInfo) => rateLimiter.requestFinish(keyInfo),
+    }),
+  )
   if (authResult instanceof Response) {
-    return authResult
+    return options.serverTiming ? timing.withHeader(authResult) : authResult
   }
   const apiKeyInfo = authResult
+  // resolves once the response has been sent, streamed responses hold their concurrency slots until then
+  let responseSent: Promise<unknown> = Promise.resolve()
   try {
-    return await gatewayWithLimiter(request, restOfPath, route, apiKeyInfo, ctx, options)
+    const response = await gatewayWithLimiter(request, restOfPath, route, apiKeyInfo, ctx, options, timing, (sent) => {
+      responseSent = sent
+    })
+    return options.serverTiming ? timing.withHeader(response) : response
   } finally {
-    runAfter(ctx, 'options.rateLimiter.requestFinish', rateLimiter.requestFinish())
+    const finish = () => rateLimiter.requestFinish(limitedKeyInfo ?? apiKeyInfo)
+    runAfter(ctx, 'options.rateLimiter.requestFinish', responseSent.then(finish, finish))
   }
 }
 
@@ -95,6 +117,7 @@ export const getProviderProxies = (
   route: string,
   providerProxyMapping: Record<string, ProviderProxy>,
   routingGroups: ApiKeyInfo['routingGroups'],
+  affinityKey?: string,
 ): ProviderProxy[] | { status: number; message: string } => {
   // If there is a routingGroup with the same route as a provider, prefer the routingGroup
   const routingGroup = routingGroups?.[route]
@@ -129,10 +152,17 @@ export const getProviderProxies = (
   const sortedPriorities = Array.from(priorityGroups.keys()).sort((a, b) => b - a)
 
   // Step 3: Flatten the full list of items so that higher-priority items come before lower-priority items,
-  // but the randomized within-priority-group order is preserved
+  // but the randomized within-priority-group order is preserved, with affinity choosing the first item
   const orderedItems: typeof normalizedItems = []
-  for (const priority of sortedPriorities) {
-    const group = priorityGroups.get(priority)!
+  for (const [index, priority] of sortedPriorities.entries()) {
+    let group = priorityGroups.get(priority)!
+    if (affinityKey && index === 0) {
+      // only the first choice is sticky, fallbacks keep the weighted random order so that a failing provider's
+      // conversations are spread over the others by weight
+      const [first, ...rest] = affinitySample(group, affinityKey)
+      orderedItems.push(first!)
+      group = rest
+    }
     orderedItems.push(...weightedRandomSample(group))
   }
 
@@ -155,6 +185,8 @@ export async function gatewayWithLimiter(
   apiKeyInfo: ApiKeyInfo,
   ctx: ExecutionContext,
   options: GatewayOptions,
+  timing: ServerTiming = new ServerTiming(),
+  onStream?: (streamComplete: Promise<unknown>) => void,
 ): Promise<Response> {
   const { org, user, project } = apiKeyInfo
   logfire.info('request received', { org, user, project, route, restOfPath })
@@ -167,7 +199,10 @@ export async function gatewayWithLimiter(
   const providerProxyMapping: Record<string, ProviderProxy> = Object.fromEntries(
     apiKeyInfo.providers.map((p) => [p.key, p]),
   )
-  const providerProxies = getProviderProxies(route, providerProxyMapping, routingGroups)
+  // route the same conversation to the same provider, to reuse its prompt cache
+  const affinity =
+    options.routingAffinity && routingGroups?.[route] ? await routingAffinity(request, String(apiKeyInfo.id)) : null
+  const providerProxies = getProviderProxies(route, providerProxyMapping, routingGroups, affinity?.key)
   if (!Array.isArray(providerProxies)) {
     return textResponse(providerProxies.status, providerProxies.message)
   }
@@ -175,12 +210,17 @@ export async function gatewayWithLimiter(
   const otel = new OtelTrace(request, apiKeyInfo.otelSettings, options)
 
   let result: HandlerResponse | null = null
+  let servedBy: ProviderProxy | null = null
 
-  for (const providerProxy of providerProxies) {
+  for (const [index, providerProxy] of providerProxies.entries()) {
     const otelSpan = otel.startSpan()
+    servedBy = providerProxy
 
+    // Cloning tees the body, and the unread branch buffers it in full, so the last attempt uses the original request
+    // to let uploads to whitelisted endpoints stream through without being held in memory.
+    const isLast = index === providerProxies.length - 1
     const handler = new RequestHandler({
-      request: request.clone(),
+      request: isLast ? request : request.clone(),
       providerProxy,
       ctx,
       gatewayOptions: options,
@@ -188,6 +228,7 @@ export async function gatewayWithLimiter(
       restOfPath,
       otelSpan,
       middlewares: options.proxyMiddlewares,
+      timing: timing.forAttempt(index),
     })
 
     try {
@@ -231,11 +272,16 @@ export async function gatewayWithLimiter(
     response = result.response
   } else if ('responseStream' in result) {
     const { successStatus: status, responseHeaders: headers, responseStream, onStreamComplete } = result
+    onStream?.(onStreamComplete)
     runAfter(
       ctx,
       'recordSpend',
       (async () => {
         const complete = await onStreamComplete
+        if ('usage' in complete && complete.usage) {
+          logRoutingGroupUsage(route, routingGroups, servedBy, affinity, complete.usage)
+          await recordUsage(apiKeyInfo, complete.usage, options)
+        }
         if ('cost' in complete && complete.cost) {
           await recordSpend(apiKeyInfo, complete.cost, options)
         } else if ('error' in complete) {
@@ -257,11 +303,22 @@ export async function gatewayWithLimiter(
     const { requestModel } = result
     response = textResponse(404, `PAIG does not support the model \`${requestModel}\` yet. We're working on it!`)
   } else if ('successStatus' in result) {
-    const { successStatus: status, responseHeaders: headers, responseBody, cost } = result
+    const { successStatus: status, responseHeaders: headers, responseBody, cost, usage } = result
+    logRoutingGroupUsage(route, routingGroups, servedBy, affinity, usage)
+    runAfter(ctx, 'recordUsage', recordUsage(apiKeyInfo, usage, options))
     runAfter(ctx, 'recordSpend', recordSpend(apiKeyInfo, cost, options))
+    // streamed responses aren't compressed, so that events aren't held back in the compressor's buffer
+    const encoding = responseEncoding(request.headers.get('accept-encoding'), responseBody.length)
+    // the encoding depends on `accept-encoding`, so caches mustn't serve it to clients that didn't send the same
+    if (!headers.get('vary')?.toLowerCase().includes('accept-encoding')) {
+      headers.append('vary', 'Accept-Encoding')
+    }
+    if (encoding) {
+      headers.set('content-encoding', encoding)
+    }
     response = new Response(responseBody, { status, headers })
   } else if ('error' in result) {
-    const { error, disableKey } = result
+    const { error, disableKey, status = 400 } = result
     if (disableKey) {
       // We need to pass `context` instead of `apiKeyInfo` because "apiKey" triggers the scrubbing.
       const { key: _key, ...context } = apiKeyInfo
@@ -269,7 +326,7 @@ export async function gatewayWithLimiter(
       runAfter(ctx, 'blockApiKey', blockApiKey(apiKeyInfo, options, 'Invalid request'))
       response = textResponse(400, `${error}, API key disabled`)
     } else {
-      response = textResponse(400, error)
+      response = textResponse(status, error)
     }
   } else {
     const { unexpectedStatus, responseHeaders, responseBody } = result
@@ -300,44 +357,37 @@ export async function disableApiKey(
   await options.keysDb.disableKey(apiKey.id, reason, newStatus, expirationTtl)
 }
 
-async function recordSpend(apiKey: ApiKeyInfo, spend: number, options: GatewayOptions): Promise<void> {
-  const { day, eow, eom } = currentScopeIntervals()
-
-  const {
-    id: keyId,
-    project,
-    user,
-    keySpendingLimitDaily: keyDaily,
-    keySpendingLimitWeekly: keyWeekly,
-    keySpendingLimitMonthly: keyMonthly,
-    keySpendingLimitTotal: keyTotal,
-    projectSpendingLimitDaily: projectDaily,
-    projectSpendingLimitWeekly: projectWeekly,
-    projectSpendingLimitMonthly: projectMonthly,
-    userSpendingLimitDaily: userDaily,
-    userSpendingLimitWeekly: userWeekly,
-    userSpendingLimitMonthly: userMonthly,
-  } = apiKey
-
-  const intervalSpends: SpendScope[] = [
-    { entityId: keyId, entityType: 'key', scope: 'daily', scopeInterval: day, limit: keyDaily },
-    { entityId: keyId, entityType: 'key', scope: 'weekly', scopeInterval: eow, limit: keyWeekly },
-    { entityId: keyId, entityType: 'key', scope: 'monthly', scopeInterval: eom, limit: keyMonthly },
-    { entityId: keyId, entityType: 'key', scope: 'total', limit: keyTotal },
-    { entityId: project, entityType: 'project', scope: 'daily', scopeInterval: day, limit: projectDaily },
-    { entityId: project, entityType: 'project', scope: 'weekly', scopeInterval: eow, limit: projectWeekly },
-    { entityId: project, entityType: 'project', scope: 'monthly', scopeInterval: eom, limit: projectMonthly },
-  ]
-
-  if (user != null) {
-    intervalSpends.push(
-      { entityId: user, entityType: 'user', scope: 'daily', scopeInterval: day, limit: userDaily },
-      { entityId: user, entityType: 'user', scope: 'weekly', scopeInterval: eow, limit: userWeekly },
-      { entityId: user, entityType: 'user', scope: 'monthly', scopeInterval: eom, limit: userMonthly },
-    )
+/** Log prompt cache usage per routing group, to compare cache hit rates with and without affinity. */
+function logRoutingGroupUsage(
+  route: string,
+  routingGroups: ApiKeyInfo['routingGroups'],
+  servedBy: ProviderProxy | null,
+  affinity: RoutingAffinity | null,
+  usage: Usage,
+) {
+  if (!routingGroups?.[route]) {
+    return
   }
+  const inputTokens = usage.input_tokens ?? 0
+  const cacheReadTokens = usage.cache_read_tokens ?? 0
+  logfire.info('routing group usage', {
+    routingGroup: route,
+    providerId: servedBy?.providerId,
+    baseUrl: servedBy?.baseUrl,
+    affinity: affinity?.source ?? 'none',
+    inputTokens,
+    cacheReadTokens,
+    cacheHitRate: inputTokens ? cacheReadTokens / inputTokens : 0,
+  })
+}
 
-  const scopesExceeded = await options.limitDb.incrementSpend(intervalSpends, spend)
+async function recordUsage(apiKey: ApiKeyInfo, usage: Usage, options: GatewayOptions): Promise<void> {
+  const tokens = (usage.input_tokens ?? 0) + (usage.output_tokens ?? 0)
+  await options.rateLimiter?.recordUsage?.(apiKey, tokens)
+}
+
+async function recordSpend(apiKey: ApiKeyInfo, spend: number, options: GatewayOptions): Promise<void> {
+  const scopesExceeded = await options.limitDb.incrementSpend(spendScopes(apiKey), spend)
 
   if (scopesExceeded.length) {
     await disableApiKey(
@@ -2,10 +2,13 @@ import { calcPrice, extractUsage, type Usage, type Provider as UsageProvider } f
 import { EventStreamCodec } from '@smithy/eventstream-codec'
 import { createParser, type EventSourceMessage } from 'eventsource-parser'
 import logfire from 'logfire'
+import type { EmbeddingCreateParams } from 'openai/resources/embeddings'
 import { match } from 'ts-pattern'
 import type { ApiKeyInfo, GatewayOptions, ProviderProxy } from '.'
 import type { ModelAPI } from './api'
-import type { BaseAPI } from './api/base'
+import { BatchResults } from './batch'
+import { RequestTooLarge, requestText, UPSTREAM_ACCEPT_ENCODING } from './compression'
+import { spendScopes } from './db'
 import type { OtelSpan } from './otel'
 import { attributesFromRequest, attributesFromResponse, type GenAIAttributes } from './otel/attributes'
 import { AnthropicProvider } from './providers/anthropic'
@@ -18,6 +21,7 @@ import { HuggingFaceProvider } from './providers/huggingface'
 import { OpenAIProvider } from './providers/openai'
 import { OVHcloudProvider } from './providers/ovhcloud'
 import { TestProvider } from './providers/test'
+import { ServerTiming } from './timing'
 import { runAfter } from './utils'
 
 interface RequestHandlerOptions {
@@ -29,6 +33,7 @@ interface RequestHandlerOptions {
   apiKeyInfo: ApiKeyInfo
   restOfPath: string
   middlewares?: Middleware[]
+  timing?: ServerTiming
 }
 
 export class RequestHandler {
@@ -41,6 +46,7 @@ export class RequestHandler {
   readonly otelSpan: OtelSpan
   readonly apiKeyInfo: ApiKeyInfo
   readonly restOfPath: string
+  readonly timing: ServerTiming
 
   constructor(options: RequestHandlerOptions) {
     this.request = options.request
@@ -51,6 +57,7 @@ export class RequestHandler {
     this.apiKeyInfo = options.apiKeyInfo
     this.restOfPath = options.restOfPath
     this.middlewares = options.middlewares ?? []
+    this.timing = options.timing ?? new ServerTiming()
 
     this.provider = RequestHandler.getProvider({
       restOfPath: this.restOfPath,
@@ -113,15 +120,34 @@ export class RequestHandler {
       return authError
     }
 
+    // batches are checked first, as their endpoints are whitelisted
+    const method = this.request.method
+    if (this.provider.isBatchCreation(method)) {
+      // a batch's spend is only recorded once it has ended, so check the limits against the recorded spend now, the
+      // key's status isn't updated when e.g. another key of its project uses up the project's limit
+      const exceeded = await this.gatewayOptions.limitDb.incrementSpend(spendScopes(this.apiKeyInfo), 0)
+      if (exceeded.length) {
+        return { error: 'Unauthorized - Key limit-exceeded', status: 403 }
+      }
+    }
+    const batchId = this.provider.retrievedBatchId(method)
+    if (batchId) {
+      return await this.handleBatchRetrieval(requestHeaders, batchId)
+    }
+
     // Check if this is a whitelisted endpoint (bypass usage tracking)
     if (this.provider.isWhitelistedEndpoint()) {
       return await this.handleWhitelistedEndpoint(requestHeaders)
     }
 
     // Extract request info (generic parsing)
-    const extracted = await this.extractRequestInfo(this.request)
+    const extracted = await this.timing.time('parse', () => this.extractRequestInfo(this.request))
     if ('error' in extracted) return extracted
 
+    // the body is sent decoded, and only request encodings the runtime can decode in the response
+    requestHeaders.delete('content-encoding')
+    requestHeaders.set('accept-encoding', UPSTREAM_ACCEPT_ENCODING)
+
     // Get request model from original extracted data
     const requestModel = this.provider.getRequestModel(extracted)
 
@@ -131,7 +157,6 @@ export class RequestHandler {
 
     const url = this.provider.url(prepared, requestModel)
 
-    const method = this.request.method
     const { requestBodyText, requestBodyData } = prepared
 
     // Validate that it's possible to calculate the price for the request model
@@ -143,14 +168,32 @@ export class RequestHandler {
       }
     }
 
-    const response = await this.fetch(url, { method, headers: requestHeaders, body: requestBodyText })
+    const { embeddingsBatcher } = this.gatewayOptions
+    const upstreamStart = performance.now()
+    let response: Response
+    if (embeddingsBatcher && this.provider.apiFlavor === 'embeddings') {
+      response = await embeddingsBatcher.fetch({
+        url,
+        credentials: this.providerProxy.credentials,
+        headers: requestHeaders,
+        requestBody: requestBodyData as EmbeddingCreateParams,
+        fetch: (batchUrl, init) => this.fetch(batchUrl, init),
+      })
+    } else {
+      response = await this.fetch(url, { method, headers: requestHeaders, body: requestBodyText })
+    }
+    this.timing.add('upstream-ttfb', performance.now() - upstreamStart)
 
     const responseHeaders = new Headers(response.headers)
     this.provider.filterResponseHeaders(responseHeaders)
+    // the runtime has already decoded the body, and the response to the client is encoded separately
+    responseHeaders.delete('content-encoding')
+    responseHeaders.delete('content-length')
 
     if (!response.ok) {
       // CAUTION: can we be charged in any way for failed requests?
       const responseBody = await response.text()
+      this.timing.add('upstream', performance.now() - upstreamStart)
       this.otelSpan.end(
         `chat ${requestModel ?? 'unknown-model'}, unexpected response: {http.response.status_code}`,
         {
@@ -175,10 +218,14 @@ export class RequestHandler {
 
     const isStreaming = this.isStreaming(responseHeaders, requestBodyData)
     if (isStreaming) {
+      // the `upstream` and `usage` phases end after the headers are sent, so they aren't timed, see `ServerTiming`
       return this.dispatchStreaming(extracted, response, responseHeaders, modelAPI, requestModel)
     }
 
-    const processResponse = await this.extractUsage(response, extracted)
+    const bodyText = await response.text()
+    this.timing.add('upstream', performance.now() - upstreamStart)
+
+    const processResponse = this.timing.timeSync('usage', () => this.extractUsage(bodyText, extracted))
     if ('error' in processResponse) {
       return { ...processResponse, disableKey: this.disableKey(), requestModel }
     }
@@ -211,7 +258,18 @@ export class RequestHandler {
   }
 
   private async extractRequestInfo(request: Request): Promise<ExtractedInfo | ErrorResponse> {
-    const requestBodyText = await request.text()
+    let requestBodyText: string | null
+    try {
+      requestBodyText = await requestText(request)
+    } catch (error) {
+      if (error instanceof RequestTooLarge) {
+        return { error: error.message, status: 413 }
+      }
+      return { error: 'invalid compressed request body' }
+    }
+    if (requestBodyText === null) {
+      return { error: `unsupported request content-encoding \`${request.headers.get('content-encoding')}\`` }
+    }
     let requestBodyData: JsonData
     try {
       requestBodyData = JSON.parse(requestBodyText) as JsonData
@@ -246,13 +304,113 @@ export class RequestHandler {
     return { response }
   }
 
+  /**
+   * Pass a retrieved batch through, and once it has ended, record its spend from its results.
+   *
+   * The results are downloaded here rather than when the client downloads them, which it may never do, and the spend
+   * of each batch is recorded once, however often it's retrieved.
+   */
+  private async handleBatchRetrieval(headers: Headers, batchId: string): Promise<HandlerResponse> {
+    const url = this.provider.url({ requestBodyText: '', requestBodyData: {} })
+    headers.delete('content-encoding')
+    headers.set('accept-encoding', UPSTREAM_ACCEPT_ENCODING)
+    const response = await this.fetch(url, { method: this.request.method, headers })
+    const spanAttributes = { ...attributesFromRequest(this.request), ...attributesFromResponse(response) }
+
+    const usageProvider = this.usageProvider()
+    if (!response.ok || !usageProvider) {
+      this.otelSpan.end(`${this.request.method} ${this.restOfPath}`, spanAttributes, {
+        level: response.ok ? 'info' : 'warn',
+      })
+      return { response }
+    }
+    // batches are small JSON objects, so reading one to find out whether it has ended is cheap
+    const responseBody = await response.text()
+    let resultsUrl: string | null = null
+    try {
+      resultsUrl = this.provider.batchResultsUrl(JSON.parse(responseBody))
+    } catch (error) {
+      logfire.reportError('Error parsing batch', error as Error, { batchId })
+    }
+
+    const responseHeaders = new Headers(response.headers)
+    this.provider.filterResponseHeaders(responseHeaders)
+    // the runtime has already decoded the body
+    responseHeaders.delete('content-encoding')
+    responseHeaders.delete('content-length')
+
+    const settled = resultsUrl ? this.settleBatch(headers, batchId, resultsUrl, usageProvider) : Promise.resolve(null)
+    const onSettled = (async () => {
+      let results: Awaited<typeof settled> = null
+      try {
+        results = await settled
+      } finally {
+        this.otelSpan.end(
+          results ? 'batch results {batch_id}' : `${this.request.method} ${this.restOfPath}`,
+          results ? { ...spanAttributes, ...results.attributes } : spanAttributes,
+          { level: 'info' },
+        )
+      }
+      return results?.spend ?? {}
+    })()
+    this.runAfter('settle-batch', onSettled)
+
+    return {
+      requestBody: '',
+      successStatus: response.status,
+      responseHeaders,
+      responseStream: new Response(responseBody).body!,
+      onStreamComplete: onSettled.catch((error: unknown) => ({ error: error as Error, disableKey: false })),
+    }
+  }
+
+  /** Download the results of an ended batch, and return their spend, unless it was already recorded. */
+  private async settleBatch(headers: Headers, batchId: string, resultsUrl: string, usageProvider: UsageProvider) {
+    // claimed before downloading, so polling an ended batch only downloads its results once
+    if (!(await this.gatewayOptions.limitDb.claimBatchSpend(`${this.providerId()}:${batchId}`))) {
+      return null
+    }
+    const response = await this.fetch(resultsUrl, { method: 'GET', headers })
+    if (!response.ok || !response.body) {
+      throw new Error(`Unable to download results of batch ${batchId}, status ${response.status}`)
+    }
+
+    const results = new BatchResults(usageProvider, (model) => this.provider.replaceModel(model))
+    const reader = response.body.getReader()
+    for (;;) {
+      const { done, value } = await reader.read()
+      if (done) {
+        break
+      }
+      results.feed(value)
+    }
+    results.end()
+    if (results.unpriced.size) {
+      // the priced results are still recorded, only the unpriced ones are missing from the spend
+      const models = [...results.unpriced].join(', ')
+      const error = new Error(`Unable to calculate cost of batch results for ${models}`)
+      logfire.reportError('Unable to calculate cost of batch results', error, { batchId, models })
+    }
+
+    const { cost, usage } = results
+    const attributes = {
+      batch_id: batchId,
+      'pydantic_ai_gateway.batch.results': results.results,
+      'pydantic_ai_gateway.batch.succeeded': results.succeeded,
+      'pydantic_ai_gateway.batch.cost': cost,
+      'gen_ai.usage.input_tokens': usage.input_tokens,
+      'gen_ai.usage.cache_read_tokens': usage.cache_read_tokens,
+      'gen_ai.usage.output_tokens': usage.output_tokens,
+    }
+    return { attributes, spend: { cost, usage } }
+  }
+
   private usageProvider(): UsageProvider | undefined {
     const provider = this.provider.usageProvider()
     return provider
   }
 
-  private async extractUsage(response: Response, extracted?: ExtractedInfo): Promise<ProcessResponse | ErrorResponse> {
-    const bodyText = await response.text()
+  private extractUsage(bodyText: string, extracted?: ExtractedInfo): ProcessResponse | ErrorResponse {
     try {
       const responseBody = JSON.parse(bodyText) as unknown as JsonData
       const usageProvider = this.usageProvider()
@@ -322,18 +480,21 @@ export class RequestHandler {
     // @ts-expect-error: requestBodyData is a JsonData, but the `processRequest` receives the proper type.
     modelAPI.processRequest(requestBodyData)
 
-    // Start consuming BOTH streams immediately to prevent tee() from buffering
-    const [responseStream, processingStream] = response.body.tee()
-
-    let events: AsyncIterable<JsonData>
+    let parse: ChunkParser
     if (responseHeaders.get('content-type')?.toLowerCase().startsWith('application/vnd.amazon.eventstream')) {
-      events = this.parseAmazonEventStream(processingStream)
+      parse = amazonEventStreamParser()
     } else {
-      events = this.parseSSE(processingStream)
+      parse = sseParser()
     }
 
-    // @ts-expect-error: TODO(Marcelo): Fix this type error.
-    const extractionPromise = this.processChunks(modelAPI, events, provider)
+    const { responseStream, streamDone } = this.usageExtractingStream(response.body, (chunk) => {
+      for (const event of parse(chunk)) {
+        // @ts-expect-error: TODO(Marcelo): Fix this type error.
+        modelAPI.processChunk(event)
+      }
+    })
+
+    const extractionPromise = streamDone.then(() => this.calculateStreamCost(modelAPI, provider))
 
     // Track completion but don't wait for it before returning
     this.runAfter('extract-stream', extractionPromise)
@@ -365,15 +526,71 @@ export class RequestHandler {
     }
   }
 
-  private async processChunks<T>(
-    modelAPI: BaseAPI<unknown, unknown, T>,
-    events: AsyncIterable<T>,
-    usageProvider: UsageProvider,
-  ): Promise<{ cost?: number } | { error: Error; disableKey: boolean }> {
-    for await (const chunk of events) {
-      modelAPI.processChunk(chunk)
+  /**
+   * Wrap the upstream body in a stream that hands each chunk to `onChunk` as it passes through to the client.
+   *
+   * Chunks are only read from upstream when the client pulls, so at most one chunk is held in memory and
+   * backpressure propagates to the provider. If the client cancels, the rest of the upstream body is drained
+   * through `onChunk` (and discarded) so usage is still accounted for. Errors thrown by `onChunk` are reported, once
+   * per stream, and don't interrupt the stream.
+   * @returns The stream to send to the client, and a promise that resolves once the upstream body is exhausted.
+   */
+  private usageExtractingStream(
+    body: ReadableStream<Uint8Array>,
+    onChunk: (chunk: Uint8Array) => void,
+  ): { responseStream: ReadableStream<Uint8Array>; streamDone: Promise<void> } {
+    const reader = body.getReader()
+    let finish: (error?: unknown) => void = () => {}
+    const streamDone = new Promise<void>((resolve, reject) => {
+      finish = (error) => (error === undefined ? resolve() : reject(error))
+    })
+    let extractError = false
+    const extract = (chunk: Uint8Array) => {
+      try {
+        onChunk(chunk)
+      } catch (error) {
+        if (!extractError) {
+          extractError = true
+          logfire.reportError('Error extracting usage from stream chunk', error as Error)
+        }
+      }
     }
 
+    const responseStream = new ReadableStream<Uint8Array>({
+      async pull(controller) {
+        try {
+          const { done, value } = await reader.read()
+          if (done) {
+            controller.close()
+            finish()
+            return
+          }
+          extract(value)
+          controller.enqueue(value)
+        } catch (error) {
+          controller.error(error)
+          finish(error)
+        }
+      },
+      async cancel() {
+        try {
+          for (let result = await reader.read(); !result.done; result = await reader.read()) {
+            extract(result.value)
+          }
+          finish()
+        } catch (error) {
+          finish(error)
+        }
+      },
+    })
+
+    return { responseStream, streamDone }
+  }
+
+  private calculateStreamCost(
+    modelAPI: ModelAPI,
+    usageProvider: UsageProvider,
+  ): { cost?: number; usage?: Usage } | { error: Error; disableKey: boolean } {
     const provider = this.usageProvider()
     const { usage, responseModel } = modelAPI.extractedResponse
 
@@ -383,7 +600,7 @@ export class RequestHandler {
 
     const price = calcPrice(usage, responseModel, { provider })
     if (price) {
-      return { cost: price.total_price }
+      return { cost: price.total_price, usage }
     } else {
       return {
         error: new Error(`Unable to calculate cost for model ${responseModel} and provider ${usageProvider.name}`),
@@ -391,62 +608,65 @@ export class RequestHandler {
       }
     }
   }
+}
 
-  private async *parseSSE(stream: ReadableStream<Uint8Array>): AsyncIterable<JsonData> {
-    const decoder = new TextDecoder()
-    const events: JsonData[] = []
-
-    const parser = createParser({
-      onEvent: (event: EventSourceMessage) => {
-        if (event.data === '[DONE]') return
-        try {
-          events.push(JSON.parse(event.data))
-        } catch (error) {
-          logfire.reportError('Error parsing SSE event', error as Error)
-        }
-      },
-    })
+/** Incrementally parses a byte stream, returning the events completed by each chunk. */
+type ChunkParser = (chunk: Uint8Array) => JsonData[]
 
-    for await (const chunk of stream) {
-      parser.feed(decoder.decode(chunk, { stream: true }))
+function sseParser(): ChunkParser {
+  const decoder = new TextDecoder()
+  let events: JsonData[] = []
 
-      // Yield all parsed events from this chunk
-      while (events.length > 0) {
-        yield events.shift()!
+  const parser = createParser({
+    onEvent: (event: EventSourceMessage) => {
+      if (event.data === '[DONE]') return
+      try {
+        events.push(JSON.parse(event.data))
+      } catch (error) {
+        logfire.reportError('Error parsing SSE event', error as Error)
       }
-    }
+    },
+  })
+
+  return (chunk) => {
+    parser.feed(decoder.decode(chunk, { stream: true }))
+    const parsed = events
+    events = []
+    return parsed
   }
+}
 
-  private async *parseAmazonEventStream(stream: ReadableStream<Uint8Array>): AsyncIterable<JsonData> {
-    const encoder = new TextEncoder()
-    const codec = new EventStreamCodec((str) => str, encoder.encode)
-    const decoder = new TextDecoder()
-    let buffer = new Uint8Array(0)
-
-    for await (const chunk of stream) {
-      // Append incoming chunk to buffer since messages can span multiple network chunks
-      const combined = new Uint8Array(buffer.length + chunk.length)
-      combined.set(buffer, 0)
-      combined.set(chunk, buffer.length)
-      buffer = combined
+function amazonEventStreamParser(): ChunkParser {
+  const encoder = new TextEncoder()
+  const codec = new EventStreamCodec((str) => str, encoder.encode)
+  const decoder = new TextDecoder()
+  let buffer = new Uint8Array(0)
 
-      // Extract complete messages from buffer (eventstream format: 4-byte length prefix + message data)
-      while (buffer.length >= 4) {
-        const messageLength = new DataView(buffer.buffer, buffer.byteOffset).getUint32(0, false)
-        if (buffer.length < messageLength) break
+  return (chunk) => {
+    // Append incoming chunk to buffer since messages can span multiple network chunks
+    const combined = new Uint8Array(buffer.length + chunk.length)
+    combined.set(buffer, 0)
+    combined.set(chunk, buffer.length)
+    buffer = combined
 
-        try {
-          const message = codec.decode(buffer.subarray(0, messageLength))
-          if (message.body?.length > 0) {
-            yield JSON.parse(decoder.decode(message.body))
-          }
-          buffer = buffer.subarray(messageLength)
-        } catch (error) {
-          logfire.reportError('Error parsing Amazon EventStream', error as Error)
-          break
+    const events: JsonData[] = []
+    // Extract complete messages from buffer (eventstream format: 4-byte length prefix + message data)
+    while (buffer.length >= 4) {
+      const messageLength = new DataView(buffer.buffer, buffer.byteOffset).getUint32(0, false)
+      if (buffer.length < messageLength) break
+
+      try {
+        const message = codec.decode(buffer.subarray(0, messageLength))
+        if (message.body?.length > 0) {
+          events.push(JSON.parse(decoder.decode(message.body)))
         }
+        buffer = buffer.subarray(messageLength)
+      } catch (error) {
+        logfire.reportError('Error parsing Amazon EventStream', error as Error)
+        break
       }
     }
+    return events
   }
 }
 
@@ -492,7 +712,7 @@ export interface StreamResponse {
   responseHeaders: Headers
   responseStream: ReadableStream
   otelAttributes?: GenAIAttributes
-  onStreamComplete: Promise<{ cost?: number } | { error: Error; disableKey: boolean }>
+  onStreamComplete: Promise<{ cost?: number; usage?: Usage } | { error: Error; disableKey: boolean }>
 }
 
 export interface ErrorResponse {
@@ -500,6 +720,8 @@ export interface ErrorResponse {
   // if true we should disable the key immediately since it appears to be incurring cost we can't measure
   disableKey?: boolean
   requestModel?: string
+  // HTTP status of the response, 400 if unset
+  status?: number
 }
 
 export interface ModelNotFoundResponse {
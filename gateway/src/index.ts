@@ -15,8 +15,10 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
 import logfire from 'logfire'
+import type { ApiKeyFilter } from './apiKeyFilter'
 import type { CacheAdapter } from './cache'
 import type { KeysDb, LimitDb } from './db'
+import type { EmbeddingsBatcher } from './embeddingsBatcher'
 import { gateway } from './gateway'
 import type { Middleware, Next } from './handler'
 import type { RateLimiter } from './rateLimiter'
@@ -26,10 +28,13 @@ import { ctHeader, response405, runAfter, textResponse } from './utils'
 
 export { changeProjectState as setProjectState, deleteApiKeyCache, setApiKeyCache } from './auth'
 export type { Middleware, Next }
+export { ApiKeyFilter, type ApiKeyFilterOptions, hashApiKey, hexDigest } from './apiKeyFilter'
 export * from './cache'
 export * from './db'
+export * from './embeddingsBatcher'
 export type { RequestHandler } from './handler'
 export * from './rateLimiter'
+export * from './redisRateLimiter'
 export * from './types'
 
 export interface GatewayOptions {
@@ -44,6 +49,18 @@ export interface GatewayOptions {
   proxyPrefixLength?: number
   /** proxyMiddlewares: perform actions before and after the request is made to the providers */
   proxyMiddlewares?: Middleware[]
+  /** embeddingsBatcher: if set, concurrent embeddings requests to the same provider and model are merged upstream */
+  embeddingsBatcher?: EmbeddingsBatcher
+  /** serverTiming: if true, responses include a `Server-Timing` header with the duration of each request phase */
+  serverTiming?: boolean
+  /** apiKeyFilter: if set, keys not in this in-memory Bloom filter of valid keys are rejected without any I/O */
+  apiKeyFilter?: ApiKeyFilter
+  /**
+   * routingAffinity: if true, requests from a key with the same `x-affinity-key` header, or else the same system
+   * prompt and first messages, are routed to the same provider of a routing group, falling back to the others in the
+   * usual weighted random order if it fails
+   */
+  routingAffinity?: boolean
 }
 
 export async function gatewayFetch(
@@ -48,7 +48,28 @@ export class AnthropicProvider extends BaseProvider {
   isWhitelistedEndpoint(): boolean {
     // If there is a query string, drop the query string from the path
     const path = this.restOfPath.split('?')[0]
-    // These endpoints are whitelisted (no usage tracking)
-    return path === 'v1/messages/count_tokens' || path === 'v1/files'
+    // These endpoints are whitelisted (no usage tracking), a batch's usage is recorded when it's retrieved once ended
+    return (
+      path === 'v1/messages/count_tokens' ||
+      path === 'v1/files' ||
+      /^v1\/messages\/batches(\/[^/]+(\/cancel|\/results)?)?$/.test(path!)
+    )
+  }
+
+  isBatchCreation(method: string): boolean {
+    return method === 'POST' && this.restOfPath.split('?')[0] === 'v1/messages/batches'
+  }
+
+  retrievedBatchId(method: string): string | null {
+    const match = /^v1\/messages\/batches\/([^/]+)$/.exec(this.restOfPath.split('?')[0]!)
+    return method === 'GET' && match ? match[1]! : null
+  }
+
+  batchResultsUrl(batch: unknown): string | null {
+    const { id, processing_status: status } = batch as { id?: unknown; processing_status?: unknown }
+    // `results_url` points at api.anthropic.com, rather than the configured base URL
+    return status === 'ended' && typeof id === 'string'
+      ? `${this.providerProxy.baseUrl}/v1/messages/batches/${id}/results`
+      : null
   }
 }
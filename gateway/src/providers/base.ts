@@ -62,6 +62,27 @@ export abstract class BaseProvider {
     return false
   }
 
+  /**
+   * Whether this request creates a batch. A batch's spend is only recorded once it has ended, so spending limits are
+   * checked before it's created.
+   */
+  isBatchCreation(_method: string): boolean {
+    return false
+  }
+
+  /**
+   * If this request retrieves a batch, the ID of the batch, otherwise null.
+   * Once a retrieved batch has ended, its spend is recorded from its results, see `batchResultsUrl`.
+   */
+  retrievedBatchId(_method: string): string | null {
+    return null
+  }
+
+  /** URL to download the results of `batch`, as returned when retrieving it, or null if it hasn't ended yet. */
+  batchResultsUrl(_batch: unknown): string | null {
+    return null
+  }
+
   isBuiltin(): boolean {
     return this.providerProxy.isBuiltIn ?? false
   }
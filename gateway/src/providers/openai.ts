@@ -5,6 +5,8 @@ import { ResponsesAPI } from '../api/responses'
 import type { ErrorResponse } from '../handler'
 import { BaseProvider, type ExtractedInfo } from './base'
 
+const ENDED_BATCH_STATUSES = new Set(['completed', 'expired', 'cancelled'])
+
 export class OpenAIProvider extends BaseProvider {
   getRequestModel(extracted: ExtractedInfo): string | undefined {
     const { requestBodyData } = extracted
@@ -80,4 +82,28 @@ export class OpenAIProvider extends BaseProvider {
     headers.delete('openai-organization')
     headers.delete('openai-project')
   }
+
+  isWhitelistedEndpoint(): boolean {
+    const path = this.restOfPath.split('?')[0]!
+    // Batch jobs and files, usage is recorded when a batch is retrieved after it has ended
+    return /^(batches(\/[^/]+(\/cancel)?)?|files(\/[^/]+(\/content)?)?)$/.test(path)
+  }
+
+  isBatchCreation(method: string): boolean {
+    return method === 'POST' && this.restOfPath.split('?')[0] === 'batches'
+  }
+
+  retrievedBatchId(method: string): string | null {
+    const match = /^batches\/([^/]+)$/.exec(this.restOfPath.split('?')[0]!)
+    return method === 'GET' && match ? match[1]! : null
+  }
+
+  batchResultsUrl(batch: unknown): string | null {
+    const { status, output_file_id: outputFileId } = batch as { status?: unknown; output_file_id?: unknown }
+    // the requests that completed before a batch expired or was cancelled are billed too
+    if (typeof status === 'string' && ENDED_BATCH_STATUSES.has(status) && typeof outputFileId === 'string') {
+      return `${this.providerProxy.baseUrl}/files/${outputFileId}/content`
+    }
+    return null
+  }
 }
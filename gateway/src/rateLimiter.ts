@@ -7,16 +7,25 @@ export interface RateLimiter {
   requestStart(keyInfo: ApiKeyInfo): Promise<string | null>
 
   /**
-   * Called after a gateway proxy request completes whether it was successful or not.
+   * Called after a gateway proxy request completes whether it was successful or not, once a streamed response has
+   * been sent or the client disconnected.
+   *
+   * `keyInfo` is the object passed to `requestStart` for the same request, so per-request state can be keyed by it.
    */
-  requestFinish(): Promise<void>
+  requestFinish(keyInfo: ApiKeyInfo): Promise<void>
+
+  /**
+   * Optional, called with the number of tokens (input + output) used once a request's usage is known,
+   * e.g. to enforce token budgets.
+   */
+  recordUsage?(keyInfo: ApiKeyInfo, tokens: number): Promise<void>
 }
 
 export const noopLimiter: RateLimiter = {
   requestStart(_: ApiKeyInfo): Promise<string | null> {
     return Promise.resolve(null)
   },
-  requestFinish(): Promise<void> {
+  requestFinish(_: ApiKeyInfo): Promise<void> {
     return Promise.resolve()
   },
 }
@@ -0,0 +1,330 @@
+import type { RedisClient } from './cache'
+import type { RateLimiter } from './rateLimiter'
+import type { ApiKeyInfo } from './types'
+
+/**
+ * Redis client interface required by `RedisRateLimiter`, the `RedisClient` used by `RedisCacheAdapter`
+ * plus support for running Lua scripts.
+ */
+export interface RedisScriptClient extends RedisClient {
+  eval(script: string, keys: string[], args: (string | number)[]): Promise<unknown>
+}
+
+export interface RateLimits {
+  /** maximum number of requests per minute for each API key */
+  keyRequestsPerMinute?: number
+  /** maximum number of requests per minute for each project */
+  projectRequestsPerMinute?: number
+  /** maximum number of in-flight requests for each API key */
+  keyConcurrentRequests?: number
+  /** maximum number of in-flight requests for each project */
+  projectConcurrentRequests?: number
+  /** maximum number of tokens (input + output) per minute for each API key */
+  keyTokensPerMinute?: number
+  /** maximum number of tokens (input + output) per minute for each project */
+  projectTokensPerMinute?: number
+}
+
+export interface RedisRateLimiterOptions {
+  redis: RedisScriptClient
+  /** either fixed limits, or a function to derive the limits from the API key, e.g. from `orgLimit` */
+  limits: RateLimits | ((keyInfo: ApiKeyInfo) => RateLimits)
+  /** prefix for all keys stored in Redis, defaults to `rateLimit` */
+  prefix?: string
+  /**
+   * Fraction of each per-minute limit reserved by this isolate in one Redis call and then served from memory,
+   * defaults to 0.05. Set to 0 to check every request against Redis, this limiter then also ignores leases other
+   * limiters sharing `localCache` hold.
+   */
+  localLeaseFraction?: number
+  /** Local cache shared between requests, defaults to one cache per isolate */
+  localCache?: RateLimitLocalCache
+  /** TTL in seconds of concurrency counters so slots can't leak if a worker dies mid-request, defaults to 600 */
+  concurrencyTtl?: number
+}
+
+type CheckKind = 'rate' | 'concurrency' | 'tokens'
+
+interface Check {
+  kind: CheckKind
+  key: string
+  limit: number
+  message: string
+}
+
+const checkMessages: Record<CheckKind, string> = {
+  rate: 'too many requests per minute',
+  concurrency: 'too many concurrent requests',
+  tokens: 'token budget per minute used up',
+}
+
+const WINDOW_SECONDS = 60
+
+// Apply all checks atomically, if any check fails, the ones before it are rolled back.
+// ARGV has 4 values per key: kind, limit and two kind-specific arguments:
+// * rate: number of requests to reserve, window TTL - returns the number of requests reserved
+// * concurrency: counter TTL - returns 1
+// * tokens: unused - returns tokens used so far in the window
+// returns {1, result per check} on success, or {0, index of the failed check}
+const START_SCRIPT = `\
+local results = {}
+for i, key in ipairs(KEYS) do
+  local base = (i - 1) * 4
+  local kind = ARGV[base + 1]
+  local limit = tonumber(ARGV[base + 2])
+  local a = tonumber(ARGV[base + 3])
+  local b = tonumber(ARGV[base + 4])
+  local ok = true
+  if kind == 'rate' then
+    local v = redis.call('INCRBY', key, a)
+    if v == a then redis.call('EXPIRE', key, b) end
+    local granted = math.min(a, limit - (v - a))
+    if granted <= 0 then
+      redis.call('DECRBY', key, a)
+      ok = false
+    else
+      if granted < a then redis.call('DECRBY', key, a - granted) end
+      results[i] = granted
+    end
+  elseif kind == 'concurrency' then
+    local v = redis.call('INCR', key)
+    redis.call('EXPIRE', key, a)
+    if v > limit then
+      redis.call('DECR', key)
+      ok = false
+    else
+      results[i] = 1
+    end
+  else
+    local v = tonumber(redis.call('GET', key) or '0')
+    if v >= limit then ok = false else results[i] = v end
+  end
+  if not ok then
+    for j = 1, i - 1 do
+      local previous = ARGV[(j - 1) * 4 + 1]
+      if previous == 'rate' then
+        redis.call('DECRBY', KEYS[j], results[j])
+      elseif previous == 'concurrency' then
+        redis.call('DECR', KEYS[j])
+      end
+    end
+    return {0, i}
+  end
+end
+return {1, unpack(results)}`
+
+const FINISH_SCRIPT = `\
+for _, key in ipairs(KEYS) do
+  if tonumber(redis.call('GET', key) or '0') > 0 then redis.call('DECR', key) end
+end`
+
+// ARGV: tokens, window TTL - returns the new token count for each key
+const USAGE_SCRIPT = `\
+local results = {}
+for i, key in ipairs(KEYS) do
+  results[i] = redis.call('INCRBY', key, ARGV[1])
+  if results[i] == tonumber(ARGV[1]) then redis.call('EXPIRE', key, ARGV[2]) end
+end
+return results`
+
+/**
+ * In-memory state shared by all `RedisRateLimiter`s in an isolate.
+ *
+ * Holds request reservations ("leases") taken from Redis, and the last known token usage for each key,
+ * so most requests can be admitted without a Redis round-trip. Everything is dropped when the minute window changes.
+ */
+export class RateLimitLocalCache {
+  private window = -1
+  private readonly leases = new Map<string, number>()
+  private readonly tokens = new Map<string, number>()
+
+  takeLease(key: string, window: number): boolean {
+    this.setWindow(window)
+    const remaining = this.leases.get(key) ?? 0
+    if (remaining > 0) {
+      this.leases.set(key, remaining - 1)
+      return true
+    }
+    return false
+  }
+
+  addLease(key: string, window: number, count: number) {
+    this.setWindow(window)
+    if (count > 0) {
+      this.leases.set(key, (this.leases.get(key) ?? 0) + count)
+    }
+  }
+
+  tokensUsed(key: string, window: number): number | undefined {
+    this.setWindow(window)
+    return this.tokens.get(key)
+  }
+
+  setTokensUsed(key: string, window: number, tokens: number) {
+    this.setWindow(window)
+    this.tokens.set(key, tokens)
+  }
+
+  private setWindow(window: number) {
+    if (window !== this.window) {
+      this.window = window
+      this.leases.clear()
+      this.tokens.clear()
+    }
+  }
+}
+
+const isolateCache = new RateLimitLocalCache()
+
+/**
+ * Distributed rate limiter backed by Redis.
+ *
+ * Supports per-key and per-project request rates, concurrent request caps and token budgets, all using fixed
+ * one-minute windows. All checks for a request are applied in a single atomic Lua script. All keys of a project
+ * share a hash tag, so the script's keys are in one slot on Redis Cluster.
+ *
+ * `requestFinish` releases the concurrency slots `requestStart` took for the same `keyInfo`, so one limiter can be
+ * shared by all requests.
+ */
+export class RedisRateLimiter implements RateLimiter {
+  private readonly redis: RedisScriptClient
+  private readonly limits: RedisRateLimiterOptions['limits']
+  private readonly prefix: string
+  private readonly localLeaseFraction: number
+  private readonly localCache: RateLimitLocalCache
+  private readonly concurrencyTtl: number
+  private readonly concurrencyKeys = new WeakMap<ApiKeyInfo, string[]>()
+
+  constructor(options: RedisRateLimiterOptions) {
+    this.redis = options.redis
+    this.limits = options.limits
+    this.prefix = options.prefix ?? 'rateLimit'
+    this.localLeaseFraction = options.localLeaseFraction ?? 0.05
+    this.localCache = options.localCache ?? isolateCache
+    this.concurrencyTtl = options.concurrencyTtl ?? 600
+  }
+
+  async requestStart(keyInfo: ApiKeyInfo): Promise<string | null> {
+    const window = currentWindow()
+    const leased: string[] = []
+    const checks = this.checks(keyInfo, window).filter((check) => {
+      const admitted = this.admitLocally(check, window)
+      if (admitted && check.kind === 'rate') {
+        leased.push(check.key)
+      }
+      return !admitted
+    })
+    if (checks.length === 0) {
+      return null
+    }
+    // if the request isn't admitted, the leases it took can serve other requests, unless the window has moved on
+    const returnLeases = () => {
+      if (currentWindow() === window) {
+        leased.forEach((key) => this.localCache.addLease(key, window, 1))
+      }
+    }
+
+    const args: (string | number)[] = []
+    for (const { kind, limit } of checks) {
+      if (kind === 'rate') {
+        args.push(kind, limit, this.leaseSize(limit), WINDOW_SECONDS)
+      } else if (kind === 'concurrency') {
+        args.push(kind, limit, this.concurrencyTtl, 0)
+      } else {
+        args.push(kind, limit, 0, 0)
+      }
+    }
+    const keys = checks.map(({ key }) => key)
+    let reply: number[]
+    try {
+      reply = (await this.redis.eval(START_SCRIPT, keys, args)) as number[]
+    } catch (error) {
+      returnLeases()
+      throw error
+    }
+    const [ok, ...results] = reply
+
+    if (!ok) {
+      returnLeases()
+      const failed = checks[results[0]! - 1]
+      return failed?.message ?? 'Rate limit exceeded'
+    }
+
+    const concurrencyKeys: string[] = []
+    checks.forEach(({ kind, key }, i) => {
+      const result = results[i]!
+      if (kind === 'rate') {
+        // one of the reserved requests is used by this request
+        this.localCache.addLease(key, window, result - 1)
+      } else if (kind === 'concurrency') {
+        concurrencyKeys.push(key)
+      } else {
+        this.localCache.setTokensUsed(key, window, result)
+      }
+    })
+    if (concurrencyKeys.length) {
+      this.concurrencyKeys.set(keyInfo, concurrencyKeys)
+    }
+    return null
+  }
+
+  async requestFinish(keyInfo: ApiKeyInfo): Promise<void> {
+    const keys = this.concurrencyKeys.get(keyInfo)
+    if (keys) {
+      this.concurrencyKeys.delete(keyInfo)
+      await this.redis.eval(FINISH_SCRIPT, keys, [])
+    }
+  }
+
+  async recordUsage(keyInfo: ApiKeyInfo, tokens: number): Promise<void> {
+    const window = currentWindow()
+    const keys = this.checks(keyInfo, window)
+      .filter(({ kind }) => kind === 'tokens')
+      .map(({ key }) => key)
+    if (keys.length === 0 || tokens <= 0) {
+      return
+    }
+    const results = (await this.redis.eval(USAGE_SCRIPT, keys, [Math.ceil(tokens), WINDOW_SECONDS])) as number[]
+    keys.forEach((key, i) => this.localCache.setTokensUsed(key, window, results[i]!))
+  }
+
+  private checks(keyInfo: ApiKeyInfo, window: number): Check[] {
+    const limits = typeof this.limits === 'function' ? this.limits(keyInfo) : this.limits
+    const checks: Check[] = []
+    const add = (kind: CheckKind, entityType: 'key' | 'project', limit: number | undefined) => {
+      if (limit === undefined) return
+      const entityId = entityType === 'key' ? keyInfo.id : keyInfo.project
+      // concurrency counters are not tied to a window
+      const suffix = kind === 'concurrency' ? '' : `:${window}`
+      // the hash tag keeps the keys of a request in one Redis Cluster slot, as required by EVAL
+      const key = `${this.prefix}:{${keyInfo.project}}:${kind}:${entityType}:${entityId}${suffix}`
+      checks.push({ kind, key, limit, message: `Rate limit exceeded - ${checkMessages[kind]} for this ${entityType}` })
+    }
+    add('rate', 'key', limits.keyRequestsPerMinute)
+    add('rate', 'project', limits.projectRequestsPerMinute)
+    add('concurrency', 'key', limits.keyConcurrentRequests)
+    add('concurrency', 'project', limits.projectConcurrentRequests)
+    add('tokens', 'key', limits.keyTokensPerMinute)
+    add('tokens', 'project', limits.projectTokensPerMinute)
+    return checks
+  }
+
+  private admitLocally({ kind, key, limit }: Check, window: number): boolean {
+    if (kind === 'rate') {
+      return this.localLeaseFraction > 0 && this.localCache.takeLease(key, window)
+    } else if (kind === 'tokens' && this.localLeaseFraction > 0) {
+      // tokens used by other isolates aren't visible here, so leave the same headroom as for request leases
+      const used = this.localCache.tokensUsed(key, window)
+      return used !== undefined && used < limit * (1 - this.localLeaseFraction)
+    }
+    return false
+  }
+
+  private leaseSize(limit: number): number {
+    return Math.max(1, Math.floor(limit * this.localLeaseFraction))
+  }
+}
+
+function currentWindow(): number {
+  return Math.floor(Date.now() / (WINDOW_SECONDS * 1000))
+}
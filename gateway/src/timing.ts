@@ -0,0 +1,56 @@
+/**
+ * Collects the duration of each phase of a request, to be returned in a `Server-Timing` header.
+ *
+ * Note that in Cloudflare Workers, timers only advance while waiting for I/O, so phases that are purely
+ * CPU-bound (e.g. parsing) report their I/O time only, which is usually 0.
+ *
+ * Streamed responses only report the phases up to `upstream-ttfb`: the header is sent with the first byte, before the
+ * `upstream` and `usage` phases have finished, and Workers can't send `Server-Timing` as a trailer.
+ */
+export class ServerTiming {
+  constructor(
+    private readonly metrics: string[] = [],
+    private readonly suffix = '',
+  ) {}
+
+  /**
+   * Timing of the attempt with provider `index` of a routing group, sharing this header, with metric names suffixed
+   * by the index on fallback, e.g. `upstream-1`, so each attempt's phases can be told apart.
+   */
+  forAttempt(index: number): ServerTiming {
+    return new ServerTiming(this.metrics, index ? `-${index}` : '')
+  }
+
+  add(name: string, duration: number) {
+    this.metrics.push(`${name}${this.suffix};dur=${duration.toFixed(1)}`)
+  }
+
+  async time<T>(name: string, fn: () => Promise<T>): Promise<T> {
+    const start = performance.now()
+    try {
+      return await fn()
+    } finally {
+      this.add(name, performance.now() - start)
+    }
+  }
+
+  timeSync<T>(name: string, fn: () => T): T {
+    const start = performance.now()
+    try {
+      return fn()
+    } finally {
+      this.add(name, performance.now() - start)
+    }
+  }
+
+  headerValue(): string {
+    return this.metrics.join(', ')
+  }
+
+  /** Return a copy of `response` with the `Server-Timing` header set */
+  withHeader(response: Response): Response {
+    const headers = new Headers(response.headers)
+    headers.append('server-timing', this.headerValue())
+    return new Response(response.body, { status: response.status, statusText: response.statusText, headers })
+  }
+}
@@ -2,13 +2,17 @@
 import { createExecutionContext, env, waitOnExecutionContext } from 'cloudflare:test'
 import { type KeysDb, noopLimiter } from '@pydantic/ai-gateway'
 import { describe, expect } from 'vitest'
-import { apiKeyAuth, changeProjectState } from '../src/auth'
+import { ApiKeyFilter, BloomFilter, hashApiKey } from '../src/apiKeyFilter'
+import { apiKeyAuth, changeProjectState, setApiKeyCache } from '../src/auth'
 import type { ApiKeyInfo, KeyStatus } from '../src/types'
 import { test } from './setup'
 import { buildGatewayEnv, IDS } from './worker'
 
 class CountingKeysDb implements KeysDb {
   callCount = 0
+  listCount = 0
+  // resolved before listing key digests, to hold a filter rebuild
+  listDelay: Promise<void> = Promise.resolve()
   private wrapped: KeysDb
 
   constructor(wrapped: KeysDb) {
@@ -20,6 +24,12 @@ class CountingKeysDb implements KeysDb {
     return this.wrapped.getApiKey(key)
   }
 
+  async listApiKeyDigests(): Promise<string[] | null> {
+    this.listCount++
+    await this.listDelay
+    return this.wrapped.listApiKeyDigests()
+  }
+
   async disableKey(id: number, reason: string, newStatus: KeyStatus, expirationTtl?: number): Promise<void> {
     return this.wrapped.disableKey(id, reason, newStatus, expirationTtl)
   }
@@ -108,4 +118,128 @@ describe('apiKeyAuth cache invalidation', () => {
 
     expect(countingDb.callCount).toBe(2)
   })
+
+  test('releases the limiter when a cached key is no longer valid', async () => {
+    const ctx = createExecutionContext()
+    const options = buildGatewayEnv(env, [], fetch)
+    const request = new Request('https://example.com', { headers: { Authorization: 'healthy' } })
+
+    await apiKeyAuth(request, ctx, options, noopLimiter)
+    await waitOnExecutionContext(ctx)
+    await changeProjectState(IDS.projectDefault, options)
+
+    // the key was deleted, the cached copy is re-validated against the DB after the limiter started
+    const revokedDb = new CountingKeysDb(options.keysDb)
+    revokedDb.getApiKey = async () => null
+    const started: ApiKeyInfo[] = []
+    const finished: ApiKeyInfo[] = []
+    const limiter = {
+      requestStart: async (keyInfo: ApiKeyInfo) => {
+        started.push(keyInfo)
+        return null
+      },
+      requestFinish: async (keyInfo: ApiKeyInfo) => {
+        finished.push(keyInfo)
+      },
+    }
+    const ctx2 = createExecutionContext()
+    const result = await apiKeyAuth(request, ctx2, { ...options, keysDb: revokedDb }, limiter)
+    await waitOnExecutionContext(ctx2)
+
+    expect((result as Response).status).toBe(401)
+    expect(started).toHaveLength(1)
+    expect(finished).toEqual(started)
+  })
+})
+
+describe('apiKeyAuth unknown keys', () => {
+  test('caches unknown keys until the key is created', async () => {
+    const baseOptions = buildGatewayEnv(env, [], fetch)
+    const countingDb = new CountingKeysDb(baseOptions.keysDb)
+    const options = { ...baseOptions, keysDb: countingDb }
+
+    const request = new Request('https://example.com', { headers: { Authorization: 'unknown' } })
+    for (let i = 0; i < 3; i++) {
+      const ctx = createExecutionContext()
+      const result = await apiKeyAuth(request, ctx, options, noopLimiter)
+      expect((result as Response).status).toBe(401)
+      await waitOnExecutionContext(ctx)
+    }
+    // only the first request queried the keys DB, and the unknown key is held in memory rather than written to KV
+    expect(countingDb.callCount).toBe(1)
+    expect((await env.KV.list()).keys).toEqual([])
+
+    const healthy = (await countingDb.getApiKey('healthy'))!
+    await setApiKeyCache({ ...healthy, key: 'unknown' }, options)
+
+    const apiKey = await apiKeyAuth(request, createExecutionContext(), options, noopLimiter)
+    expect((apiKey as ApiKeyInfo).key).toBe('unknown')
+  })
+
+  test('rejects keys missing from the filter without I/O', async () => {
+    const baseOptions = buildGatewayEnv(env, [], fetch)
+    const countingDb = new CountingKeysDb(baseOptions.keysDb)
+    const options = { ...baseOptions, keysDb: countingDb, apiKeyFilter: new ApiKeyFilter() }
+
+    // the filter is built after the response, until then keys are looked up in the keys DB
+    const ctx = createExecutionContext()
+    const first = new Request('https://example.com', { headers: { Authorization: 'paig_first' } })
+    expect(((await apiKeyAuth(first, ctx, options, noopLimiter)) as Response).status).toBe(401)
+    expect(countingDb.callCount).toBe(1)
+    await waitOnExecutionContext(ctx)
+    expect(countingDb.listCount).toBe(1)
+
+    const garbage = new Request('https://example.com', { headers: { Authorization: 'paig_garbage' } })
+    const result = await apiKeyAuth(garbage, createExecutionContext(), options, noopLimiter)
+    expect((result as Response).status).toBe(401)
+    expect(countingDb.callCount).toBe(1)
+
+    const healthy = new Request('https://example.com', { headers: { Authorization: 'paig_healthy' } })
+    const apiKey = await apiKeyAuth(healthy, createExecutionContext(), options, noopLimiter)
+    expect((apiKey as ApiKeyInfo).key).toBe('paig_healthy')
+    expect(countingDb.callCount).toBe(2)
+
+    // keys created after the filter was built are added to it
+    await setApiKeyCache({ ...(apiKey as ApiKeyInfo), key: 'paig_garbage' }, options)
+    const created = await apiKeyAuth(garbage, createExecutionContext(), options, noopLimiter)
+    expect((created as ApiKeyInfo).key).toBe('paig_garbage')
+  })
+
+  test('rebuilds the filter after the response, using the stale filter meanwhile', async () => {
+    const countingDb = new CountingKeysDb(buildGatewayEnv(env, [], fetch).keysDb)
+    const filter = new ApiKeyFilter({ refreshIntervalMs: 0 })
+    const garbage = await hashApiKey('paig_garbage')
+    // the first build runs after the response, meanwhile every key might exist
+    const first = createExecutionContext()
+    expect(await filter.mightExist(garbage, countingDb, first)).toBe(true)
+    await waitOnExecutionContext(first)
+    expect(countingDb.listCount).toBe(1)
+
+    let release = () => {}
+    countingDb.listDelay = new Promise((resolve) => {
+      release = resolve
+    })
+    const ctx = createExecutionContext()
+    // answered with the stale filter while the rebuild is held
+    expect(await filter.mightExist(garbage, countingDb, ctx)).toBe(false)
+    expect(await filter.mightExist(await hashApiKey('paig_healthy'), countingDb, ctx)).toBe(true)
+    // concurrent requests share one rebuild
+    expect(countingDb.listCount).toBe(2)
+    release()
+    await waitOnExecutionContext(ctx)
+  })
+})
+
+describe('BloomFilter', () => {
+  test('has no false negatives', async () => {
+    const filter = new BloomFilter(1000, 0.001)
+    const digests = await Promise.all(Array.from({ length: 1000 }, (_, i) => hashApiKey(`key-${i}`)))
+    for (const digest of digests) {
+      filter.add(digest)
+    }
+    expect(digests.every((digest) => filter.has(digest))).toBe(true)
+
+    const others = await Promise.all(Array.from({ length: 1000 }, (_, i) => hashApiKey(`other-${i}`)))
+    expect(others.filter((digest) => filter.has(digest)).length).toBeLessThan(10)
+  })
 })
@@ -0,0 +1,29 @@
+import { bench, describe } from 'vitest'
+import { requestText } from '../src/compression'
+
+/**
+ * Cost of decoding compressed request bodies, on a prompt holding every recorded cassette, ~150KB of real provider
+ * requests and responses, which compress like real prompts rather than like repeated filler text.
+ * Run with `npm run bench --workspace=gateway`, and see `proxy_vcr.overhead` for end-to-end bytes and latency.
+ */
+const cassettes = import.meta.glob<string>('../../proxy-vcr/proxy_vcr/cassettes/*.yaml', {
+  query: '?raw',
+  import: 'default',
+  eager: true,
+})
+const body = JSON.stringify({
+  model: 'gpt-5',
+  messages: Object.values(cassettes).map((content, i) => ({ role: i % 2 ? 'assistant' : 'user', content })),
+})
+const gzipped = await new Response(new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'))).arrayBuffer()
+
+describe(`request body of ${body.length} bytes, ${gzipped.byteLength} bytes gzipped`, () => {
+  bench('identity', async () => {
+    await requestText(new Request('https://example.com', { method: 'POST', body }))
+  })
+
+  bench('gzip', async () => {
+    const headers = { 'content-encoding': 'gzip' }
+    await requestText(new Request('https://example.com', { method: 'POST', body: gzipped, headers }))
+  })
+})
@@ -0,0 +1,224 @@
+import { createExecutionContext, env, waitOnExecutionContext } from 'cloudflare:test'
+import { gatewayFetch } from '@pydantic/ai-gateway'
+import type { EmbeddingCreateParams } from 'openai/resources/embeddings'
+import { describe, expect, it } from 'vitest'
+import { type BatchedEmbeddingsRequest, EmbeddingsBatcher } from '../src/embeddingsBatcher'
+import { buildGatewayEnv } from './worker'
+
+interface UpstreamCall {
+  url: string
+  body: EmbeddingCreateParams
+}
+
+function fakeUpstream(status = 200) {
+  const calls: UpstreamCall[] = []
+  const fetch = (url: string, init: RequestInit): Promise<Response> => {
+    const body = JSON.parse(init.body as string) as EmbeddingCreateParams
+    calls.push({ url, body })
+    if (status !== 200) {
+      return Promise.resolve(new Response('upstream error', { status }))
+    }
+    const inputs = body.input as string[]
+    const promptTokens = inputs.reduce((sum, input) => sum + input.length, 0)
+    const data = inputs.map((input, index) => ({ object: 'embedding', index, embedding: [input.length, index] }))
+    const responseBody = {
+      object: 'list',
+      data,
+      model: body.model,
+      usage: { prompt_tokens: promptTokens, total_tokens: promptTokens },
+    }
+    return Promise.resolve(Response.json(responseBody))
+  }
+  return { calls, fetch }
+}
+
+function request(
+  fetch: BatchedEmbeddingsRequest['fetch'],
+  requestBody: EmbeddingCreateParams,
+  credentials = 'key',
+  headers: HeadersInit = {},
+): BatchedEmbeddingsRequest {
+  const url = 'https://api.openai.com/v1/embeddings'
+  return { url, credentials, headers: new Headers(headers), requestBody, fetch }
+}
+
+describe('EmbeddingsBatcher', () => {
+  it('should merge concurrent requests and split the results back', async () => {
+    const batcher = new EmbeddingsBatcher({ maxWaitMs: 5 })
+    const upstream = fakeUpstream()
+
+    const [r1, r2] = await Promise.all([
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: ['a', 'bbb'] })),
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'cccccc' })),
+    ])
+
+    expect(upstream.calls).toHaveLength(1)
+    expect(upstream.calls[0]!.body.input).toEqual(['a', 'bbb', 'cccccc'])
+
+    const body1 = await r1.json()
+    const body2 = await r2.json()
+    expect(body1).toEqual({
+      object: 'list',
+      data: [
+        { object: 'embedding', index: 0, embedding: [1, 0] },
+        { object: 'embedding', index: 1, embedding: [3, 1] },
+      ],
+      model: 'text-embedding-3-small',
+      usage: { prompt_tokens: 4, total_tokens: 4 },
+    })
+    expect(body2).toEqual({
+      object: 'list',
+      data: [{ object: 'embedding', index: 0, embedding: [6, 2] }],
+      model: 'text-embedding-3-small',
+      usage: { prompt_tokens: 6, total_tokens: 6 },
+    })
+  })
+
+  it('should not merge requests for different models or credentials', async () => {
+    const batcher = new EmbeddingsBatcher({ maxWaitMs: 5 })
+    const upstream = fakeUpstream()
+
+    await Promise.all([
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'a' })),
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-large', input: 'b' })),
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'c' }, 'other-key')),
+    ])
+
+    expect(upstream.calls).toHaveLength(3)
+  })
+
+  it('should only merge requests with the same upstream headers', async () => {
+    const batcher = new EmbeddingsBatcher({ maxWaitMs: 5 })
+    const upstream = fakeUpstream()
+    const model = 'text-embedding-3-small'
+
+    const embed = (input: string, headers: HeadersInit) =>
+      batcher.fetch(request(upstream.fetch, { model, input }, 'key', headers))
+
+    await Promise.all([
+      embed('a', { 'openai-project': 'a', traceparent: '1' }),
+      embed('b', { 'openai-project': 'a', traceparent: '2' }),
+      embed('c', { 'openai-project': 'b' }),
+    ])
+
+    // trace headers differ per request, so don't prevent merging
+    expect(upstream.calls.map(({ body }) => body.input)).toEqual([['a', 'b'], ['c']])
+  })
+
+  it('should flush before the batch exceeds the token limit', async () => {
+    const batcher = new EmbeddingsBatcher({ maxBatchTokens: 10, maxWaitMs: 1000 })
+    const upstream = fakeUpstream()
+    const model = 'text-embedding-3-small'
+
+    await Promise.all([
+      batcher.fetch(request(upstream.fetch, { model, input: 'aaaa' })),
+      batcher.fetch(request(upstream.fetch, { model, input: 'bbbb' })),
+      batcher.fetch(request(upstream.fetch, { model, input: 'cccc' })),
+      batcher.fetch(request(upstream.fetch, { model, input: ['d'.repeat(20)] })),
+    ])
+
+    // too large to merge, so sent straight away
+    expect(upstream.calls.map(({ body }) => body.input)).toEqual([['aaaa', 'bbbb'], ['d'.repeat(20)], ['cccc']])
+  })
+
+  it('should send the other requests on their own if the first caller fails', async () => {
+    const batcher = new EmbeddingsBatcher({ maxWaitMs: 5 })
+    const upstream = fakeUpstream()
+    const cancelled = () => Promise.reject(new Error('request cancelled'))
+    const model = 'text-embedding-3-small'
+
+    const [first, second] = await Promise.allSettled([
+      batcher.fetch(request(cancelled, { model, input: 'a' })),
+      batcher.fetch(request(upstream.fetch, { model, input: ['b'] })),
+    ])
+
+    expect(first.status).toBe('rejected')
+    expect(second.status).toBe('fulfilled')
+    expect(upstream.calls.map(({ body }) => body.input)).toEqual([['b']])
+  })
+
+  it('should flush when the batch is full', async () => {
+    const batcher = new EmbeddingsBatcher({ maxBatchSize: 2, maxWaitMs: 1000 })
+    const upstream = fakeUpstream()
+
+    const responses = await Promise.all([
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'a' })),
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'b' })),
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: ['c', 'd'] })),
+    ])
+
+    expect(upstream.calls.map(({ body }) => body.input)).toEqual([
+      ['a', 'b'],
+      ['c', 'd'],
+    ])
+    expect(responses.map(({ status }) => status)).toEqual([200, 200, 200])
+  })
+
+  it('should attribute usage so the parts add up to the upstream total', async () => {
+    const batcher = new EmbeddingsBatcher({ maxWaitMs: 5 })
+    const upstream = fakeUpstream()
+    const fetch = async (url: string, init: RequestInit): Promise<Response> => {
+      const response = await upstream.fetch(url, init)
+      const body = await response.json<{ usage: { prompt_tokens: number } }>()
+      return Response.json({ ...body, usage: { prompt_tokens: 10, total_tokens: 10 } })
+    }
+
+    const responses = await Promise.all(
+      ['a', 'b', 'c'].map((input) => batcher.fetch(request(fetch, { model: 'text-embedding-3-small', input }))),
+    )
+    const tokens = await Promise.all(
+      responses.map(async (r) => (await r.json<{ usage: { prompt_tokens: number } }>()).usage.prompt_tokens),
+    )
+    expect(tokens.reduce((sum, t) => sum + t, 0)).toBe(10)
+  })
+
+  it('should forward upstream errors to every caller', async () => {
+    const batcher = new EmbeddingsBatcher({ maxWaitMs: 5 })
+    const upstream = fakeUpstream(429)
+
+    const responses = await Promise.all([
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'a' })),
+      batcher.fetch(request(upstream.fetch, { model: 'text-embedding-3-small', input: 'b' })),
+    ])
+
+    expect(upstream.calls).toHaveLength(1)
+    expect(responses.map(({ status }) => status)).toEqual([429, 429])
+    expect(await responses[1]!.text()).toBe('upstream error')
+  })
+})
+
+describe('EmbeddingsBatcher in the gateway', () => {
+  it('should merge concurrent gateway requests and return each its own embeddings', async () => {
+    const upstream = fakeUpstream()
+    // other requests, e.g. to export spans, are accepted without being recorded
+    const subFetch = (url: RequestInfo | URL, init?: RequestInit) =>
+      url.toString().endsWith('/embeddings') ? upstream.fetch(url.toString(), init!) : Promise.resolve(new Response())
+    const embeddingsBatcher = new EmbeddingsBatcher({ maxWaitMs: 50 })
+    const options = { ...buildGatewayEnv(env, [], subFetch), embeddingsBatcher }
+
+    const embed = async (input: string[]) => {
+      const ctx = createExecutionContext()
+      const request = new Request<unknown, IncomingRequestCfProperties>('https://example.com/openai/embeddings', {
+        method: 'POST',
+        headers: { Authorization: 'healthy' },
+        body: JSON.stringify({ model: 'text-embedding-3-small', input }),
+      })
+      const response = await gatewayFetch(request, new URL(request.url), ctx, options)
+      const body = await response.json<{ data: { index: number; embedding: number[] }[] }>()
+      await waitOnExecutionContext(ctx)
+      return { status: response.status, body }
+    }
+
+    const [first, second] = await Promise.all([embed(['a', 'bb']), embed(['ccc'])])
+
+    expect(upstream.calls).toHaveLength(1)
+    expect(upstream.calls[0]!.body.input).toEqual(['a', 'bb', 'ccc'])
+    expect(first.status).toBe(200)
+    expect(first.body.data.map(({ index, embedding }) => [index, embedding[0]])).toEqual([
+      [0, 1],
+      [1, 2],
+    ])
+    expect(second.status).toBe(200)
+    expect(second.body.data.map(({ index, embedding }) => [index, embedding[0]])).toEqual([[0, 3]])
+  })
+})
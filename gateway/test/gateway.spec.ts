@@ -2,7 +2,9 @@ import { createExecutionContext, env, waitOnExecutionContext } from 'cloudflare:
 import { gatewayFetch, type Middleware, type Next, type SpendStatus } from '@pydantic/ai-gateway'
 import OpenAI from 'openai'
 import { describe, expect, it } from 'vitest'
+import { MAX_DECOMPRESSED_SIZE, responseEncoding } from '../src/compression'
 import type { HandlerResponse, RequestHandler } from '../src/handler'
+import { ServerTiming } from '../src/timing'
 import { LimitDbD1 } from './db'
 import { test } from './setup'
 import { buildGatewayEnv, type DisableEvent, IDS } from './worker'
@@ -179,6 +181,51 @@ describe('LimitDbD1', () => {
     `)
     }
   })
+
+  it('rolls up expired spend intervals', async () => {
+    const db = new LimitDbD1(env.limitsDB)
+    // 2025-01-10, 2025-01-11, Sunday 2025-01-12 and 2025-01-31
+    const januarySpend = (day: number) => [
+      { entityId: 1, entityType: 'key', scope: 'daily', scopeInterval: day },
+      { entityId: 1, entityType: 'key', scope: 'weekly', scopeInterval: 20100 },
+      { entityId: 1, entityType: 'key', scope: 'monthly', scopeInterval: 20119 },
+    ] as const
+    await db.incrementSpend([...januarySpend(20098)], 1)
+    await db.incrementSpend([...januarySpend(20099)], 2)
+    // 2025-02-10, Sunday 2025-02-16 and 2025-02-28
+    await db.incrementSpend(
+      [
+        { entityId: 1, entityType: 'key', scope: 'daily', scopeInterval: 20129 },
+        { entityId: 1, entityType: 'key', scope: 'weekly', scopeInterval: 20135 },
+        { entityId: 1, entityType: 'key', scope: 'monthly', scopeInterval: 20147 },
+      ],
+      4,
+    )
+    // daily spend without a monthly row
+    await db.incrementSpend([{ entityId: 2, entityType: 'user', scope: 'daily', scopeInterval: 20098 }], 5)
+
+    expect(await db.rollupSpend(20129)).toBe(4)
+
+    const { results } = await env.limitsDB
+      .prepare('SELECT entityType, entityId, scope, scopeInterval, spend FROM spend ORDER BY entityType, scopeInterval')
+      .run()
+    expect(results).toEqual([
+      { entityType: 2, entityId: 2, scope: 3, scopeInterval: 20119, spend: 5 },
+      { entityType: 3, entityId: 1, scope: 3, scopeInterval: 20119, spend: 3 },
+      { entityType: 3, entityId: 1, scope: 1, scopeInterval: 20129, spend: 4 },
+      { entityType: 3, entityId: 1, scope: 2, scopeInterval: 20135, spend: 4 },
+      { entityType: 3, entityId: 1, scope: 3, scopeInterval: 20147, spend: 4 },
+    ])
+
+    const status = await db.spendStatusByEntity(20129)
+    expect(status.project.size).toBe(0)
+    expect(status.user.size).toBe(0)
+    expect(status.key.get(1)?.map(({ scope, spend }) => ({ scope, spend }))).toEqual([
+      { scope: 'daily', spend: 4 },
+      { scope: 'weekly', spend: 4 },
+      { scope: 'monthly', spend: 4 },
+    ])
+  })
 })
 
 function mockFetchFactory(
@@ -255,6 +302,101 @@ describe('custom middleware', () => {
   })
 })
 
+describe('server timing', () => {
+  it('should include a Server-Timing header when enabled', async () => {
+    const ctx = createExecutionContext()
+    const request = new Request<unknown, IncomingRequestCfProperties>('https://example.com/test/gpt-5', {
+      method: 'POST',
+      headers: { Authorization: 'healthy' },
+      body: JSON.stringify({ model: 'gpt-5', messages: [{ role: 'user', content: 'Hello' }] }),
+    })
+
+    const gatewayEnv = { ...buildGatewayEnv(env, [], fetch), serverTiming: true }
+    const response = await gatewayFetch(request, new URL(request.url), ctx, gatewayEnv)
+    await waitOnExecutionContext(ctx)
+
+    expect(response.status).toBe(200)
+    const phases = response.headers
+      .get('server-timing')
+      ?.split(', ')
+      .map((metric) => metric.split(';')[0])
+    expect(phases).toEqual(['ratelimit', 'auth', 'parse', 'upstream-ttfb', 'upstream', 'usage'])
+  })
+
+  it('should suffix the metrics of fallback attempts', () => {
+    const timing = new ServerTiming()
+    timing.add('auth', 1)
+    timing.forAttempt(0).add('upstream', 2)
+    timing.forAttempt(1).add('upstream', 3)
+    expect(timing.headerValue()).toBe('auth;dur=1.0, upstream;dur=2.0, upstream-1;dur=3.0')
+  })
+
+  it('should not include a Server-Timing header by default', async () => {
+    const ctx = createExecutionContext()
+    const request = new Request<unknown, IncomingRequestCfProperties>('https://example.com/test/gpt-5', {
+      method: 'POST',
+      headers: { Authorization: 'healthy' },
+      body: JSON.stringify({ model: 'gpt-5', messages: [{ role: 'user', content: 'Hello' }] }),
+    })
+
+    const response = await gatewayFetch(request, new URL(request.url), ctx, buildGatewayEnv(env, [], fetch))
+    await waitOnExecutionContext(ctx)
+
+    expect(response.status).toBe(200)
+    expect(response.headers.get('server-timing')).toBeNull()
+  })
+})
+
+describe('compression', () => {
+  test('accepts gzip compressed request bodies', async ({ gateway }) => {
+    const body = JSON.stringify({ model: 'gpt-5', messages: [{ role: 'user', content: 'Hello' }] })
+    const compressedStream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'))
+    const compressed = await new Response(compressedStream).arrayBuffer()
+
+    const response = await gateway.fetch('https://example.com/test/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'content-encoding': 'gzip' },
+      body: compressed,
+    })
+    const text = await response.text()
+    expect(response.status, `got ${response.status} response: ${text}`).toBe(200)
+    expect(response.headers.get('vary')).toContain('Accept-Encoding')
+  })
+
+  test('rejects request bodies too large once decompressed', async ({ gateway }) => {
+    const body = new Uint8Array(MAX_DECOMPRESSED_SIZE + 1).fill(0x20)
+    const compressedStream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'))
+    const compressed = await new Response(compressedStream).arrayBuffer()
+
+    const response = await gateway.fetch('https://example.com/test/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'content-encoding': 'gzip' },
+      body: compressed,
+    })
+    expect(response.status).toBe(413)
+    expect(await response.text()).toBe(`decompressed request body exceeds ${MAX_DECOMPRESSED_SIZE} bytes`)
+  })
+
+  test('rejects unsupported request encodings', async ({ gateway }) => {
+    const response = await gateway.fetch('https://example.com/test/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'content-encoding': 'zstd' },
+      body: 'not really zstd',
+    })
+    expect(response.status).toBe(400)
+    expect(await response.text()).toMatchInlineSnapshot(`"unsupported request content-encoding \`zstd\`"`)
+  })
+
+  it('negotiates response encoding', () => {
+    expect(responseEncoding('gzip, deflate, br, zstd', 2000)).toBe('br')
+    expect(responseEncoding('gzip, br;q=0.5', 2000)).toBe('gzip')
+    expect(responseEncoding('*', 2000)).toBe('br')
+    expect(responseEncoding('identity', 2000)).toBeNull()
+    expect(responseEncoding('gzip', 100)).toBeNull()
+    expect(responseEncoding(null, 2000)).toBeNull()
+  })
+})
+
 describe('routing group fallback', () => {
   test('should fallback to next provider on retryable error', async () => {
     let attemptCount = 0
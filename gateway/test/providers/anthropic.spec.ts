@@ -1,6 +1,8 @@
+import { env, waitOnExecutionContext } from 'cloudflare:test'
 import Anthropic from '@anthropic-ai/sdk'
 import OpenAI from 'openai'
 import { describe, expect } from 'vitest'
+import { LimitDbD1 } from '../db'
 import { deserializeRequest } from '../otel'
 import { test } from '../setup'
 
@@ -81,6 +83,34 @@ describe('anthropic', () => {
     expect(deserializeRequest(otelBatch[0]!)).toMatchSnapshot('span')
   })
 
+  test('should record the spend of a batch once it has ended', async ({ gateway }) => {
+    const limitDb = new LimitDbD1(env.limitsDB)
+    const keySpend = async () => (await limitDb.spendStatus('key')).find((s) => s.scope === 'daily')?.spend ?? 0
+
+    // the spend is recorded from the results when the ended batch is retrieved
+    const response = await gateway.fetch('https://example.com/anthropic/v1/messages/batches/msgbatch_abc123', {
+      headers: { Authorization: 'healthy', 'x-vcr-filename': 'batch-retrieve' },
+    })
+    expect(response.status).toBe(200)
+    expect((await response.json<{ processing_status: string }>()).processing_status).toBe('ended')
+    await waitOnExecutionContext(gateway.ctx)
+    const spend = await keySpend()
+    expect(spend).toBeGreaterThan(0)
+
+    // downloading the results is free
+    const results = await gateway.fetch('https://example.com/anthropic/v1/messages/batches/msgbatch_abc123/results', {
+      headers: { Authorization: 'healthy', 'x-vcr-filename': 'batch-results' },
+    })
+    expect(results.status).toBe(200)
+    const lines = (await results.text())
+      .trim()
+      .split('\n')
+      .map((line) => JSON.parse(line) as { result: { type: string } })
+    expect(lines.map(({ result }) => result.type)).toEqual(['succeeded', 'succeeded', 'errored'])
+    await waitOnExecutionContext(gateway.ctx)
+    expect(await keySpend()).toBe(spend)
+  })
+
   test('should return 404 for unsupported model', async ({ gateway }) => {
     const { fetch } = gateway
 
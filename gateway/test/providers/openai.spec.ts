@@ -1,4 +1,5 @@
-import { env } from 'cloudflare:test'
+import { env, waitOnExecutionContext } from 'cloudflare:test'
+import { currentScopeIntervals, type SpendScope } from '@pydantic/ai-gateway'
 import OpenAI from 'openai'
 import { describe, expect } from 'vitest'
 import { LimitDbD1 } from '../db'
@@ -198,6 +199,36 @@ describe('openai', () => {
     expect(deserializeRequest(otelBatch[0]!)).toMatchSnapshot('span')
   })
 
+  test('stream usage is recorded when the client disconnects early', async ({ gateway }) => {
+    const { fetch, ctx } = gateway
+
+    const response = await fetch('https://example.com/openai/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'x-vcr-filename': 'stream-options' },
+      body: JSON.stringify({
+        stream: true,
+        model: 'gpt-5',
+        messages: [
+          { role: 'developer', content: 'You are a helpful assistant.' },
+          { role: 'user', content: 'What is the capital of France?' },
+        ],
+        max_completion_tokens: 1024,
+      }),
+    })
+    expect(response.status).toBe(200)
+
+    const reader = response.body!.getReader()
+    const { done } = await reader.read()
+    expect(done).toBe(false)
+    await reader.cancel()
+    await waitOnExecutionContext(ctx)
+
+    const limitDb = new LimitDbD1(env.limitsDB)
+    const keyStatus = await limitDb.spendStatus('key')
+    expect(keyStatus).not.toHaveLength(0)
+    expect(keyStatus.every(({ spend }) => spend > 0)).toBe(true)
+  })
+
   test('stream injects stream_options with user-defined stream_options', async ({ gateway }) => {
     const { fetch } = gateway
 
@@ -314,4 +345,151 @@ describe('openai', () => {
     expect(otelBatch, 'otelBatch length not 1').toHaveLength(1)
     expect(deserializeRequest(otelBatch[0]!)).toMatchSnapshot('span')
   })
+
+  test('openai upstream rate limit from fault injection', async ({ gateway }) => {
+    const response = await gateway.fetch('https://example.com/openai/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'x-vcr-fault': 'rate-limited' },
+      body: JSON.stringify({ model: 'gpt-5', messages: [{ role: 'user', content: 'Hello' }] }),
+    })
+
+    expect(response.status).toBe(429)
+    const body = (await response.json()) as { error: { type: string } }
+    expect(body.error.type).toBe('proxy_vcr_fault')
+  })
+
+  async function streamWithFault(
+    gateway: { fetch: (url: string, init: RequestInit) => Promise<Response> },
+    fault: object,
+  ): Promise<string[]> {
+    const response = await gateway.fetch('https://example.com/openai/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'x-vcr-filename': 'stream-options', 'x-vcr-fault': JSON.stringify(fault) },
+      body: JSON.stringify({
+        stream: true,
+        model: 'gpt-5',
+        messages: [
+          { role: 'developer', content: 'You are a helpful assistant.' },
+          { role: 'user', content: 'What is the capital of France?' },
+        ],
+        max_completion_tokens: 1024,
+      }),
+    })
+    expect(response.status).toBe(200)
+    const decoder = new TextDecoder()
+    const chunks: string[] = []
+    try {
+      for await (const chunk of response.body!) {
+        chunks.push(decoder.decode(chunk, { stream: true }))
+      }
+    } catch {
+      // a truncated stream errors after the chunks received before the cut
+    }
+    return chunks
+  }
+
+  test('openai stream paced by fault injection', async ({ gateway }) => {
+    const chunks = await streamWithFault(gateway, { chunk_delay_ms: 20 })
+
+    expect(chunks.length).toBeGreaterThan(1)
+    expect(chunks.join('')).toContain('data: [DONE]')
+  })
+
+  test('openai stream truncated by fault injection', async ({ gateway }) => {
+    const early = (await streamWithFault(gateway, { truncate_rate: 1, truncate_fraction: 0.25 })).join('')
+    const late = (await streamWithFault(gateway, { truncate_rate: 1, truncate_fraction: 0.75 })).join('')
+
+    expect(early).not.toContain('data: [DONE]')
+    expect(late).not.toContain('data: [DONE]')
+    expect(early.length).toBeGreaterThan(0)
+    expect(late.length).toBeGreaterThan(early.length)
+  })
+
+  test('connection reset by fault injection', async () => {
+    // straight to proxy-vcr, accepting gzip, so the reset passes through its compression middleware
+    const response = await fetch('http://localhost:8005/openai/chat/completions', {
+      method: 'POST',
+      headers: { 'accept-encoding': 'gzip', 'x-vcr-filename': 'stream-options', 'x-vcr-fault': 'reset' },
+      body: '{}',
+    })
+    // the connection is dropped after the headers, rather than answered with a 500
+    expect(response.status).toBe(200)
+    await expect(response.text()).rejects.toThrow()
+  })
+
+  test('openai batch', async ({ gateway }) => {
+    const client = new OpenAI({ apiKey: 'healthy', baseURL: 'https://example.com/openai', fetch: gateway.fetch })
+    const limitDb = new LimitDbD1(env.limitsDB)
+    const keySpend = async () => (await limitDb.spendStatus('key')).find((s) => s.scope === 'daily')?.spend ?? 0
+
+    const batch = await client.batches.create(
+      { input_file_id: 'file-batch-input', endpoint: '/v1/chat/completions', completion_window: '24h' },
+      { headers: { 'x-vcr-filename': 'batch-create' } },
+    )
+    expect(batch.status).toBe('validating')
+    // submitting a batch is free
+    expect(await keySpend()).toBe(0)
+
+    // the spend is recorded from the results once the batch is retrieved after it has ended
+    const retrieveHeaders = { 'x-vcr-filename': 'batch-retrieve' }
+    const completed = await client.batches.retrieve(batch.id, { headers: retrieveHeaders })
+    expect(completed.output_file_id).toBe('file-batch-output')
+    await waitOnExecutionContext(gateway.ctx)
+    const spend = await keySpend()
+    expect(spend).toBeGreaterThan(0)
+
+    // retrieving the batch again doesn't download the results or record the spend again
+    await client.batches.retrieve(batch.id, { headers: retrieveHeaders })
+    await waitOnExecutionContext(gateway.ctx)
+    expect(await keySpend()).toBe(spend)
+
+    // downloading the results is free
+    const results = await client.files.content('file-batch-output', { headers: { 'x-vcr-filename': 'batch-results' } })
+    expect((await results.text()).trim().split('\n')).toHaveLength(3)
+    await waitOnExecutionContext(gateway.ctx)
+    expect(await keySpend()).toBe(spend)
+  })
+
+  test('openai batch creation checks spending limits', async ({ gateway }) => {
+    const client = new OpenAI({ apiKey: 'healthy', baseURL: 'https://example.com/openai', fetch: gateway.fetch })
+    const limitDb = new LimitDbD1(env.limitsDB)
+    // the key's daily limit is 1, its spend was recorded elsewhere, so its status is still active
+    const daily: SpendScope = {
+      entityType: 'key',
+      entityId: IDS.keyHealthy,
+      scope: 'daily',
+      scopeInterval: currentScopeIntervals().day,
+      limit: 1,
+    }
+    await limitDb.incrementSpend([daily], 2)
+
+    await expect(
+      client.batches.create(
+        { input_file_id: 'file-batch-input', endpoint: '/v1/chat/completions', completion_window: '24h' },
+        { headers: { 'x-vcr-filename': 'batch-create' } },
+      ),
+    ).rejects.toThrow('Unauthorized - Key limit-exceeded')
+  })
+
+  test('repeated requests replay the first recording', async ({ gateway }) => {
+    const client = new OpenAI({ apiKey: 'healthy', baseURL: 'https://example.com/openai', fetch: gateway.fetch })
+    const headers = { 'x-vcr-filename': 'batch-poll' }
+
+    // proxy-vcr serves the first matching interaction every time, in single and multi-worker mode
+    for (let i = 0; i < 2; i++) {
+      const batch = await client.batches.retrieve('batch_poll', { headers })
+      expect(batch.status).toBe('in_progress')
+    }
+  })
+
+  test('openai file content is not billed', async ({ gateway }) => {
+    const client = new OpenAI({ apiKey: 'healthy', baseURL: 'https://example.com/openai', fetch: gateway.fetch })
+    const limitDb = new LimitDbD1(env.limitsDB)
+
+    // file content is never billed, even if it looks like usage
+    const content = await client.files.content('file-user-data', { headers: { 'x-vcr-filename': 'file-content' } })
+    expect(await content.text()).toContain('"usage"')
+    await waitOnExecutionContext(gateway.ctx)
+    expect(await limitDb.spendStatus('key')).toEqual([])
+  })
 })
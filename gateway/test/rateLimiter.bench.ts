@@ -0,0 +1,79 @@
+import { type ApiKeyInfo, RateLimitLocalCache, RedisRateLimiter, type RedisScriptClient } from '@pydantic/ai-gateway'
+import { bench, describe } from 'vitest'
+
+/**
+ * In-memory stand-in for Redis that admits every request after a simulated round-trip, so the benchmark compares
+ * requests served from local leases with requests that wait for Redis. Run with `npm run bench --workspace=gateway`.
+ */
+class AdmitAllRedis implements RedisScriptClient {
+  constructor(private readonly latencyMs: number) {}
+
+  get(): Promise<string | null> {
+    return Promise.resolve(null)
+  }
+
+  set(): Promise<string | null> {
+    return Promise.resolve('OK')
+  }
+
+  del(): Promise<number> {
+    return Promise.resolve(0)
+  }
+
+  async eval(_script: string, keys: string[], args: (string | number)[]): Promise<unknown> {
+    await new Promise((resolve) => setTimeout(resolve, this.latencyMs))
+    // admit every check, granting the full lease requested by rate checks
+    const results = keys.map((_, i) => (args[i * 4] === 'rate' ? Number(args[i * 4 + 2]) : 1))
+    return [1, ...results]
+  }
+}
+
+// each benchmark uses its own keys and local cache, so none is served from leases another one took
+let nextId = 1
+function newKeyInfo(): ApiKeyInfo {
+  const id = nextId++
+  return { id, project: id, org: 'org', key: `key-${id}`, status: 'active', providers: [], routingGroups: {} }
+}
+
+const redis = new AdmitAllRedis(1)
+
+describe('RedisRateLimiter overhead per request', () => {
+  const rateLimits = { keyRequestsPerMinute: 1_000_000_000, projectRequestsPerMinute: 1_000_000_000 }
+
+  const leasingKey = newKeyInfo()
+  const leasing = new RedisRateLimiter({ redis, limits: rateLimits, localCache: new RateLimitLocalCache() })
+  bench('request rate, served from local leases', async () => {
+    await leasing.requestStart(leasingKey)
+    await leasing.requestFinish(leasingKey)
+  })
+
+  const roundTripKey = newKeyInfo()
+  const roundTrip = new RedisRateLimiter({
+    redis,
+    limits: rateLimits,
+    localCache: new RateLimitLocalCache(),
+    localLeaseFraction: 0,
+  })
+  bench('request rate, Redis round-trip every request', async () => {
+    await roundTrip.requestStart(roundTripKey)
+    await roundTrip.requestFinish(roundTripKey)
+  })
+
+  const allLimitsKey = newKeyInfo()
+  const allLimits = new RedisRateLimiter({
+    redis,
+    limits: {
+      ...rateLimits,
+      keyConcurrentRequests: 100,
+      projectConcurrentRequests: 100,
+      keyTokensPerMinute: 1_000_000_000,
+      projectTokensPerMinute: 1_000_000_000,
+    },
+    localCache: new RateLimitLocalCache(),
+  })
+  bench('all limits', async () => {
+    await allLimits.requestStart(allLimitsKey)
+    await allLimits.requestFinish(allLimitsKey)
+    await allLimits.recordUsage(allLimitsKey, 1000)
+  })
+})
@@ -45,6 +45,36 @@ describe('rate limiter', () => {
     expect(rateLimiter.requestEndCount).toEqual(1)
   })
 
+  test('should call requestFinish once a streamed response has been sent', async () => {
+    const rateLimiter = new TestRateLimiter()
+    const ctx = createExecutionContext()
+
+    const request = new Request<unknown, IncomingRequestCfProperties>('https://example.com/openai/chat/completions', {
+      method: 'POST',
+      headers: { Authorization: 'healthy', 'x-vcr-filename': 'stream-options' },
+      body: JSON.stringify({
+        stream: true,
+        model: 'gpt-5',
+        messages: [
+          { role: 'developer', content: 'You are a helpful assistant.' },
+          { role: 'user', content: 'What is the capital of France?' },
+        ],
+        max_completion_tokens: 1024,
+      }),
+    })
+
+    const gatewayEnv = buildGatewayEnv(env, [], fetch, undefined, undefined, rateLimiter)
+    const response = await gatewayFetch(request, new URL(request.url), ctx, gatewayEnv)
+    expect(response.status).toBe(200)
+    // the slots are still held while the response streams
+    expect(rateLimiter.requestEndCount).toBe(0)
+
+    await response.text()
+    await waitOnExecutionContext(ctx)
+    expect(rateLimiter.requestStartCount).toBe(1)
+    expect(rateLimiter.requestEndCount).toBe(1)
+  })
+
   test('should call requestStart and requestFinish on failed request', async () => {
     const rateLimiter = new TestRateLimiter()
 
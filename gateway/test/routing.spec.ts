@@ -1,4 +1,5 @@
 import { describe, expect, it } from 'vitest'
+import { affinitySample, routingAffinity } from '../src/affinity'
 import { getProviderProxies, weightedRandomSample } from '../src/gateway'
 import type { ProviderProxy } from '../src/types'
 
@@ -101,6 +102,92 @@ describe('weightedRandomSample', () => {
   })
 })
 
+describe('affinitySample', () => {
+  const items = [
+    { key: 'a', weight: 3 },
+    { key: 'b', weight: 1 },
+    { key: 'c', weight: 0 },
+  ]
+
+  it('should return the same order for the same key', () => {
+    const first = affinitySample(items, 'conversation-1')
+    for (let i = 0; i < 10; i++) {
+      expect(affinitySample(items, 'conversation-1')).toEqual(first)
+    }
+    expect(first).toHaveLength(3)
+    expect(first[2]!.key).toBe('c')
+  })
+
+  it('should respect weight distribution across keys (statistical test)', () => {
+    const firstPositionCounts: Record<string, number> = { a: 0, b: 0, c: 0 }
+    const iterations = 10000
+    for (let i = 0; i < iterations; i++) {
+      const firstKey = affinitySample(items, `conversation-${i}`)[0]!.key
+      firstPositionCounts[firstKey] = (firstPositionCounts[firstKey] ?? 0) + 1
+    }
+    const aRatio = (firstPositionCounts.a ?? 0) / iterations
+    expect(aRatio).toBeGreaterThan(0.7)
+    expect(aRatio).toBeLessThan(0.8)
+    expect(firstPositionCounts.c).toBe(0)
+  })
+})
+
+describe('routingAffinity', () => {
+  const messages = [
+    { role: 'system', content: 'You are a helpful assistant.' },
+    { role: 'user', content: 'What is the capital of France?' },
+  ]
+  const prompt = JSON.stringify({ model: 'gpt-5', messages })
+
+  it('should prefer the affinity header', async () => {
+    const request = new Request('https://example.com', {
+      method: 'POST',
+      headers: { 'x-affinity-key': 'session-1' },
+      body: prompt,
+    })
+    expect(await routingAffinity(request, '1')).toEqual({ key: '1:session-1', source: 'header' })
+  })
+
+  it('should hash the start of the conversation and leave the body readable', async () => {
+    const turn1 = new Request('https://example.com', { method: 'POST', body: prompt })
+    const turn2 = new Request('https://example.com', {
+      method: 'POST',
+      body: JSON.stringify({
+        model: 'gpt-5',
+        messages: [...messages, { role: 'assistant', content: 'Paris.' }, { role: 'user', content: 'And Spain?' }],
+      }),
+    })
+    const affinity1 = await routingAffinity(turn1, '1')
+    expect(affinity1?.source).toBe('prompt')
+    expect(await routingAffinity(turn2, '1')).toEqual(affinity1)
+    expect(await turn1.text()).toBe(prompt)
+  })
+
+  it('should decode compressed bodies', async () => {
+    const compressed = new Blob([prompt]).stream().pipeThrough(new CompressionStream('gzip'))
+    const request = new Request('https://example.com', {
+      method: 'POST',
+      headers: { 'content-encoding': 'gzip' },
+      body: await new Response(compressed).arrayBuffer(),
+    })
+    const plain = new Request('https://example.com', { method: 'POST', body: prompt })
+    expect(await routingAffinity(request, '1')).toEqual(await routingAffinity(plain, '1'))
+  })
+
+  it('should separate conversations sharing a system prompt, and callers', async () => {
+    const post = (body: string) => new Request('https://example.com', { method: 'POST', body })
+    const other = JSON.stringify({ model: 'gpt-5', messages: [messages[0], { role: 'user', content: 'Hello' }] })
+    const affinity = await routingAffinity(post(prompt), '1')
+    expect((await routingAffinity(post(other), '1'))?.key).not.toBe(affinity?.key)
+    expect((await routingAffinity(post(prompt), '2'))?.key).not.toBe(affinity?.key)
+  })
+
+  it('should ignore bodies without messages', async () => {
+    const request = new Request('https://example.com', { method: 'POST', body: '{"model": "gpt-5"}' })
+    expect(await routingAffinity(request, '1')).toBeNull()
+  })
+})
+
 describe('getProviderProxies', () => {
   const mockProvider1: ProviderProxy & { key: string } = {
     key: 'provider1',
@@ -302,4 +389,44 @@ describe('getProviderProxies', () => {
     expect(providers[1]!.baseUrl).toBe('https://provider1.example.com')
     expect(providers[2]!.baseUrl).toBe('https://provider3.example.com')
   })
+
+  it('should route the same affinity key to the same provider', () => {
+    const providerMapping = { provider1: mockProvider1, provider2: mockProvider2, provider3: mockProvider3 }
+    const routingGroups = {
+      test: [
+        { key: 'provider1' as const, priority: 1 },
+        { key: 'provider2' as const, priority: 1 },
+        { key: 'provider3' as const, priority: 0 },
+      ],
+    }
+
+    const first = getProviderProxies('test', providerMapping, routingGroups, 'conversation-1') as ProviderProxy[]
+    for (let i = 0; i < 10; i++) {
+      expect(getProviderProxies('test', providerMapping, routingGroups, 'conversation-1')).toEqual(first)
+    }
+    // priorities still apply
+    expect(first[2]!.baseUrl).toBe('https://provider3.example.com')
+  })
+
+  it('should only pin the first provider with an affinity key', () => {
+    const providerMapping = { provider1: mockProvider1, provider2: mockProvider2, provider3: mockProvider3 }
+    const routingGroups = {
+      test: [
+        { key: 'provider1' as const, priority: 1 },
+        { key: 'provider2' as const, priority: 1 },
+        { key: 'provider3' as const, priority: 1 },
+      ],
+    }
+
+    const firsts = new Set<string>()
+    const fallbacks = new Set<string>()
+    for (let i = 0; i < 100; i++) {
+      const providers = getProviderProxies('test', providerMapping, routingGroups, 'conversation-1') as ProviderProxy[]
+      firsts.add(providers[0]!.baseUrl)
+      fallbacks.add(providers[1]!.baseUrl)
+    }
+    expect(firsts.size).toBe(1)
+    // the fallbacks are in weighted random order
+    expect(fallbacks.size).toBe(2)
+  })
 })
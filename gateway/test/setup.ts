@@ -24,6 +24,7 @@ beforeAll(async () => {
 const RESET_SQL = `\
 DROP TABLE IF EXISTS spend;
 DROP TABLE IF EXISTS keyStatus;
+DROP TABLE IF EXISTS batchSpend;
 
 ${SQL}`
 
@@ -71,12 +72,31 @@ function testGateway(): TestGateway {
     )
     const url_ = new URL(url instanceof Request ? url.url : url)
     const response = await gatewayFetch(request, url_, ctx, buildGatewayEnv(env, disableEvents, subFetch))
+    if (response.body && isStreaming(response)) {
+      // usage extraction only finishes once a stream has been read, so wait on `ctx` once the body is exhausted
+      const body = response.body.pipeThrough(
+        new TransformStream({
+          async flush() {
+            await waitOnExecutionContext(ctx)
+          },
+        }),
+      )
+      return new Response(body, response)
+    }
     await waitOnExecutionContext(ctx)
     return response
   }
   return { fetch: mockFetch, subFetch, ctx, otelBatch, disableEvents }
 }
 
+function isStreaming(response: Response): boolean {
+  const contentType = response.headers.get('content-type')?.toLowerCase() ?? ''
+  return (
+    contentType.startsWith('text/event-stream') ||
+    contentType.startsWith('application/vnd.amazon.eventstream')
+  )
+}
+
 export const test = baseTest.extend<{ gateway: TestGateway }>({
   // biome-ignore lint/correctness/noEmptyPattern: required
   gateway: async ({}, use) => {
@@ -2,6 +2,8 @@ import {
   type ApiKeyInfo,
   type GatewayOptions,
   gatewayFetch,
+  hashApiKey,
+  hexDigest,
   type KeyStatus,
   KVCacheAdapter,
   type Middleware,
@@ -139,127 +141,126 @@ class TestKeysDB extends KeysDbD1 {
     ]
   }
 
+  // keys are stored without the paig_ prefix, clients may send either
+  private readonly keys: Record<string, (key: string) => ApiKeyInfo | Promise<ApiKeyInfo>> = {
+    healthy: async (key) => ({
+      id: IDS.keyHealthy,
+      user: IDS.userDefault,
+      project: IDS.projectDefault,
+      org: IDS.orgDefault,
+      key,
+      status: (await this.getDbKeyStatus(IDS.keyHealthy)) ?? 'active',
+      // key limits
+      keySpendingLimitDaily: 1,
+      keySpendingLimitTotal: 2,
+      // user limits
+      userSpendingLimitWeekly: 3,
+      // project limits
+      projectSpendingLimitMonthly: 4,
+      providers: this.allProviders,
+      routingGroups: {
+        test: [{ key: 'test' }],
+        openai: [{ key: 'openai' }],
+        groq: [{ key: 'groq' }],
+        anthropic: [{ key: 'anthropic' }, { key: 'google-vertex' }],
+        converse: [{ key: 'bedrock' }],
+        gemini: [{ key: 'google-vertex' }],
+        'google-vertex': [{ key: 'google-vertex' }],
+        huggingface: [{ key: 'huggingface' }],
+        ovhcloud: [{ key: 'ovhcloud' }],
+      },
+      otelSettings: {
+        writeToken: 'write-token',
+        baseUrl: 'https://logfire.pydantic.dev',
+        exporterProtocol: 'http/json',
+      },
+    }),
+    disabled: (key) => ({
+      id: IDS.keyDisabled,
+      project: IDS.projectDefault,
+      org: IDS.orgDefault,
+      key,
+      status: 'disabled',
+      providers: this.allProviders,
+      routingGroups: {
+        test: [{ key: 'test' }],
+        openai: [{ key: 'openai' }],
+        groq: [{ key: 'groq' }],
+        anthropic: [{ key: 'anthropic' }],
+        converse: [{ key: 'bedrock' }],
+        gemini: [{ key: 'google-vertex' }],
+        ovhcloud: [{ key: 'ovhcloud' }],
+      },
+    }),
+    'tiny-limit': async (key) => ({
+      id: IDS.keyTinyLimit,
+      project: IDS.projectDefault,
+      org: IDS.orgDefault,
+      key,
+      status: (await this.getDbKeyStatus(IDS.keyTinyLimit)) ?? 'active',
+      keySpendingLimitDaily: 0.01,
+      projectSpendingLimitMonthly: 4,
+      providers: [this.allProviders[0]!],
+      routingGroups: { test: [{ key: 'test' }] },
+    }),
+    'fallback-test': (key) => ({
+      id: IDS.keyFallbackTest,
+      project: IDS.projectDefault,
+      org: IDS.orgDefault,
+      key,
+      status: 'active',
+      providers: [
+        {
+          key: 'test1',
+          baseUrl: 'http://test.example.com/provider1',
+          providerId: 'test',
+          injectCost: true,
+          credentials: 'test1',
+        },
+        {
+          key: 'test2',
+          baseUrl: 'http://test.example.com/provider2',
+          providerId: 'test',
+          injectCost: true,
+          credentials: 'test2',
+        },
+      ],
+      routingGroups: { test: [{ key: 'test1' }, { key: 'test2' }] },
+    }),
+    'fallback-anthropic-google-vertex': (key) => ({
+      id: IDS.keyFallbackAnthropicGoogleVertex,
+      project: IDS.projectDefault,
+      org: IDS.orgDefault,
+      key,
+      status: 'active',
+      providers: [
+        {
+          key: 'anthropic',
+          baseUrl: 'http://localhost:8005/anthropic',
+          providerId: 'anthropic',
+          injectCost: true,
+          credentials: this.allProviders[4]!.credentials,
+        },
+        {
+          key: 'google-vertex',
+          baseUrl: 'http://localhost:8005/google-vertex',
+          providerId: 'google-vertex',
+          injectCost: true,
+          credentials: this.allProviders[6]!.credentials,
+        },
+      ],
+      routingGroups: { anthropic: [{ key: 'anthropic' }, { key: 'google-vertex' }] },
+    }),
+  }
+
   async getApiKey(key: string): Promise<ApiKeyInfo | null> {
-    // Strip paig_ prefix if present (keys are stored without prefix in DB)
     const normalizedKey = key.startsWith('paig_') ? key.substring(5) : key
+    return Object.hasOwn(this.keys, normalizedKey) ? await this.keys[normalizedKey]!(key) : null
+  }
 
-    switch (normalizedKey) {
-      case 'healthy':
-        return {
-          id: IDS.keyHealthy,
-          user: IDS.userDefault,
-          project: IDS.projectDefault,
-          org: IDS.orgDefault,
-          key,
-          status: (await this.getDbKeyStatus(IDS.keyHealthy)) ?? 'active',
-          // key limits
-          keySpendingLimitDaily: 1,
-          keySpendingLimitTotal: 2,
-          // user limits
-          userSpendingLimitWeekly: 3,
-          // project limits
-          projectSpendingLimitMonthly: 4,
-          providers: this.allProviders,
-          routingGroups: {
-            test: [{ key: 'test' }],
-            openai: [{ key: 'openai' }],
-            groq: [{ key: 'groq' }],
-            anthropic: [{ key: 'anthropic' }, { key: 'google-vertex' }],
-            converse: [{ key: 'bedrock' }],
-            gemini: [{ key: 'google-vertex' }],
-            'google-vertex': [{ key: 'google-vertex' }],
-            huggingface: [{ key: 'huggingface' }],
-            ovhcloud: [{ key: 'ovhcloud' }],
-          },
-          otelSettings: {
-            writeToken: 'write-token',
-            baseUrl: 'https://logfire.pydantic.dev',
-            exporterProtocol: 'http/json',
-          },
-        }
-      case 'disabled':
-        return {
-          id: IDS.keyDisabled,
-          project: IDS.projectDefault,
-          org: IDS.orgDefault,
-          key,
-          status: 'disabled',
-          providers: this.allProviders,
-          routingGroups: {
-            test: [{ key: 'test' }],
-            openai: [{ key: 'openai' }],
-            groq: [{ key: 'groq' }],
-            anthropic: [{ key: 'anthropic' }],
-            converse: [{ key: 'bedrock' }],
-            gemini: [{ key: 'google-vertex' }],
-            ovhcloud: [{ key: 'ovhcloud' }],
-          },
-        }
-      case 'tiny-limit':
-        return {
-          id: IDS.keyTinyLimit,
-          project: IDS.projectDefault,
-          org: IDS.orgDefault,
-          key,
-          status: (await this.getDbKeyStatus(IDS.keyTinyLimit)) ?? 'active',
-          keySpendingLimitDaily: 0.01,
-          projectSpendingLimitMonthly: 4,
-          providers: [this.allProviders[0]!],
-          routingGroups: { test: [{ key: 'test' }] },
-        }
-      case 'fallback-test':
-        return {
-          id: IDS.keyFallbackTest,
-          project: IDS.projectDefault,
-          org: IDS.orgDefault,
-          key,
-          status: 'active',
-          providers: [
-            {
-              key: 'test1',
-              baseUrl: 'http://test.example.com/provider1',
-              providerId: 'test',
-              injectCost: true,
-              credentials: 'test1',
-            },
-            {
-              key: 'test2',
-              baseUrl: 'http://test.example.com/provider2',
-              providerId: 'test',
-              injectCost: true,
-              credentials: 'test2',
-            },
-          ],
-          routingGroups: { test: [{ key: 'test1' }, { key: 'test2' }] },
-        }
-      case 'fallback-anthropic-google-vertex':
-        return {
-          id: IDS.keyFallbackAnthropicGoogleVertex,
-          project: IDS.projectDefault,
-          org: IDS.orgDefault,
-          key,
-          status: 'active',
-          providers: [
-            {
-              key: 'anthropic',
-              baseUrl: 'http://localhost:8005/anthropic',
-              providerId: 'anthropic',
-              injectCost: true,
-              credentials: this.allProviders[4]!.credentials,
-            },
-            {
-              key: 'google-vertex',
-              baseUrl: 'http://localhost:8005/google-vertex',
-              providerId: 'google-vertex',
-              injectCost: true,
-              credentials: this.allProviders[6]!.credentials,
-            },
-          ],
-          routingGroups: { anthropic: [{ key: 'anthropic' }, { key: 'google-vertex' }] },
-        }
-      default:
-        return null
-    }
+  listApiKeyDigests(): Promise<string[]> {
+    const keys = Object.keys(this.keys).flatMap((key) => [key, `paig_${key}`])
+    return Promise.all(keys.map(async (key) => hexDigest(await hashApiKey(key))))
   }
 
   async disableKey(id: number, reason: string, newStatus: KeyStatus, expirationTtl?: number): Promise<void> {
@@ -0,0 +1,258 @@
+"""Content-addressed storage for cassette bodies.
+
+Request and response bodies larger than `MIN_BLOB_SIZE` are stored once in `cassettes/blobs/{sha256}` and cassettes
+reference them as `body: {blob: <sha256>}`, so identical prompts and responses recorded in several cassettes are
+stored once. Smaller bodies stay inline to keep cassettes readable, and cassettes without blobs load as before.
+
+Run `uv run --package proxy-vcr -m proxy_vcr.blobs migrate` to move the bodies of existing cassettes into the blob
+store, and `... -m proxy_vcr.blobs gc` to delete blobs no cassette references. Blobs written or reused in the last
+`GC_GRACE_PERIOD` are kept, as a recording may have written its blobs but not yet its cassette.
+
+Within the proxy, cassettes are written by `cassette_writer` in a worker thread, so serializing and writing a recording
+never blocks the event loop. Writes within `WRITE_DELAY` of each other are batched, and cassettes waiting to be
+written are loaded from memory.
+"""
+
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from collections.abc import Callable
+from types import ModuleType
+from typing import IO, Any, cast
+
+from vcr.persisters.filesystem import CassetteNotFoundError  # type: ignore[reportMissingTypeStubs]
+from vcr.request import Request  # type: ignore[reportMissingTypeStubs]
+from vcr.serialize import CASSETTE_FORMAT_VERSION  # type: ignore[reportMissingTypeStubs]
+from vcr.serializers import yamlserializer  # type: ignore[reportMissingTypeStubs]
+
+from .store import blob_dir, load_interactions, read_blob, response_body
+
+__all__ = (
+    'BlobPersister',
+    'CassetteWriter',
+    'MIN_BLOB_SIZE',
+    'StoredBlob',
+    'blob_dir',
+    'cassette_writer',
+    'load_interactions',
+    'write_blob_file',
+)
+
+MIN_BLOB_SIZE = 1024
+# seconds a blob is kept after it was last written or reused, even if no cassette references it yet
+GC_GRACE_PERIOD = 3600
+# blobs are written to temporary files with this prefix, then renamed
+TMP_PREFIX = '.tmp-'
+# seconds to wait for more recordings before writing a batch
+WRITE_DELAY = 0.05
+
+
+class StoredBlob:
+    """A request body already in the blob store, e.g. a streamed upload, recorded as a reference to the blob."""
+
+    def __init__(self, digest: str):
+        self.digest = digest
+
+
+class BlobPersister:
+    """vcr persister that stores large bodies in the blob store, see the module docstring."""
+
+    @classmethod
+    def load_cassette(cls, cassette_path: str | pathlib.Path, serializer: ModuleType) -> tuple[list[Any], list[Any]]:
+        cassette_path = pathlib.Path(cassette_path)
+        if pending := cassette_writer.pending.get(cassette_path):
+            cassette_dict = pending[0]
+            return list(cassette_dict['requests']), list(cassette_dict['responses'])
+        if not cassette_path.is_file():
+            raise CassetteNotFoundError()
+        data = cast(dict[str, Any], serializer.deserialize(cassette_path.read_text()))
+
+        requests: list[Any] = []
+        responses: list[Any] = []
+        for interaction in data['interactions']:
+            request, response = interaction['request'], interaction['response']
+            if isinstance(request['body'], dict):
+                request['body'] = read_blob(cassette_path.parent, request['body']['blob'])
+            if 'blob' in response['body']:
+                response['body'] = {'string': read_blob(cassette_path.parent, response['body']['blob'])}
+            requests.append(Request._from_dict(request))  # type: ignore[reportPrivateUsage]
+            responses.append({**response, 'body': {'string': response_body(response)}})
+        return requests, responses
+
+    @staticmethod
+    def save_cassette(cassette_path: str | pathlib.Path, cassette_dict: dict[str, Any], serializer: ModuleType) -> None:
+        cassette_writer.save(pathlib.Path(cassette_path), cassette_dict, serializer)
+
+
+class CassetteWriter:
+    """Writes cassettes in a worker thread, in batches, see the module docstring.
+
+    Outside an event loop, e.g. in `migrate`, cassettes are written immediately.
+    """
+
+    def __init__(self, delay: float = WRITE_DELAY):
+        self.delay = delay
+        # the latest recording of each cassette not yet written
+        self.pending: dict[pathlib.Path, tuple[dict[str, Any], ModuleType]] = {}
+        self._scheduled: asyncio.Task[None] | None = None
+        self._lock: asyncio.Lock | None = None
+
+    def save(self, cassette_path: pathlib.Path, cassette_dict: dict[str, Any], serializer: ModuleType) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            write_cassette(cassette_path, cassette_dict, serializer)
+            return
+        self.pending[cassette_path] = (cassette_dict, serializer)
+        if self._scheduled is None:
+            self._scheduled = loop.create_task(self._flush_later())
+
+    def exists(self, cassette_path: pathlib.Path) -> bool:
+        return cassette_path in self.pending or cassette_path.exists()
+
+    async def flush(self) -> None:
+        """Write all pending cassettes, including those saved while writing."""
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            while self.pending:
+                batch = self.pending.copy()
+                await asyncio.to_thread(write_cassettes, batch)
+                for path, pending in batch.items():
+                    # unless it was recorded again while writing
+                    if self.pending.get(path) is pending:
+                        del self.pending[path]
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.delay)
+        self._scheduled = None
+        await self.flush()
+
+
+cassette_writer = CassetteWriter()
+
+
+def write_cassettes(batch: dict[pathlib.Path, tuple[dict[str, Any], ModuleType]]) -> None:
+    for cassette_path, (cassette_dict, serializer) in batch.items():
+        write_cassette(cassette_path, cassette_dict, serializer)
+
+
+def write_cassette(cassette_path: pathlib.Path, cassette_dict: dict[str, Any], serializer: ModuleType) -> None:
+    cassette_path.parent.mkdir(parents=True, exist_ok=True)
+    interactions: list[dict[str, Any]] = []
+    for request, response in zip(cassette_dict['requests'], cassette_dict['responses']):
+        request_dict = cast(dict[str, Any], request._to_dict())
+        body = cast(StoredBlob | str | bytes | None, request_dict['body'])
+        if isinstance(body, StoredBlob):
+            request_dict['body'] = {'blob': body.digest}
+        else:
+            blob = write_blob(cassette_path.parent, body)
+            request_dict['body'] = {'blob': blob} if blob else decode_body(body)
+        # copied rather than updated, as the recording may still be replayed from `pending`
+        body = cast(str | bytes | None, response['body'].get('string'))
+        if blob := write_blob(cassette_path.parent, body):
+            response_dict = {**response, 'body': {'blob': blob}}
+        else:
+            response_dict = {**response, 'body': {**response['body'], 'string': decode_body(body)}}
+        interactions.append({'request': request_dict, 'response': response_dict})
+
+    data = {'version': CASSETTE_FORMAT_VERSION, 'interactions': interactions}
+    cassette_path.write_text(serializer.serialize(data))
+
+
+def decode_body(body: str | bytes | None) -> str | bytes | None:
+    """Bodies are stored as text where they're valid UTF-8, like vcr does, and as `!!binary` otherwise."""
+    if isinstance(body, bytes):
+        try:
+            return body.decode()
+        except UnicodeDecodeError:
+            return body
+    return body
+
+
+def write_blob(cassette_dir: pathlib.Path, body: str | bytes | None) -> str | None:
+    """Store `body` in the blob store if it's large enough, returning its digest."""
+    if body is None:
+        return None
+    content = body.encode() if isinstance(body, str) else body
+    if len(content) < MIN_BLOB_SIZE:
+        return None
+
+    digest = hashlib.sha256(content).hexdigest()
+    store_blob(cassette_dir, digest, lambda f: f.write(content))
+    return digest
+
+
+def write_blob_file(cassette_dir: pathlib.Path, file: IO[bytes], digest: str) -> None:
+    """Store the content of `file`, whose SHA-256 is `digest`, in the blob store without reading it into memory."""
+    file.seek(0)
+    store_blob(cassette_dir, digest, lambda f: shutil.copyfileobj(file, f))
+
+
+def store_blob(cassette_dir: pathlib.Path, digest: str, write: Callable[[IO[bytes]], object]) -> None:
+    path = blob_dir(cassette_dir) / digest
+    if path.exists():
+        # mark it as in use, so `gc` doesn't delete it before the cassette referencing it is written
+        path.touch()
+    else:
+        path.parent.mkdir(exist_ok=True)
+        # write atomically, so concurrent recordings of the same body never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=TMP_PREFIX)
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+
+def migrate(cassette_dir: pathlib.Path) -> None:
+    """Rewrite all cassettes so large bodies are stored in the blob store."""
+    for path in sorted(cassette_dir.glob('*.yaml')):
+        requests, responses = BlobPersister.load_cassette(path, yamlserializer)
+        BlobPersister.save_cassette(path, {'requests': requests, 'responses': responses}, yamlserializer)
+
+
+def gc(cassette_dir: pathlib.Path, grace_period: float = GC_GRACE_PERIOD) -> list[str]:
+    """Delete blobs that no cassette references, returning their digests.
+
+    Temporary files and blobs written or reused within `grace_period` seconds are kept, they may belong to a recording
+    in progress.
+    """
+    referenced: set[str] = set()
+    for path in cassette_dir.glob('*.yaml'):
+        for interaction in load_interactions(path):
+            for body in (interaction['request']['body'], interaction['response']['body']):
+                if isinstance(body, dict) and 'blob' in body:
+                    referenced.add(cast(str, body['blob']))
+
+    deleted: list[str] = []
+    directory = blob_dir(cassette_dir)
+    if directory.is_dir():
+        cutoff = time.time() - grace_period
+        for blob in directory.iterdir():
+            if blob.name.startswith(TMP_PREFIX):
+                continue
+            if blob.name not in referenced and blob.stat().st_mtime < cutoff:
+                blob.unlink()
+                deleted.append(blob.name)
+    return deleted
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['migrate', 'gc'])
+    parser.add_argument('--cassette-dir', type=pathlib.Path, default=pathlib.Path(__file__).parent / 'cassettes')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate(args.cassette_dir)
+    deleted = gc(args.cassette_dir)
+    print(f'deleted {len(deleted)} unreferenced blobs')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Fault injection, used to exercise the gateway's provider fallback and partial stream handling offline.
+
+A fault profile is chosen per request with the `x-vcr-fault` header, either the name of a profile or an inline
+JSON profile, e.g. `x-vcr-fault: {"errors": {"429": 0.5}}`. A default profile per provider can be set with the
+`PROXY_VCR_FAULTS` environment variable, e.g. `PROXY_VCR_FAULTS=openai=flaky,anthropic=slow`.
+
+Set `PROXY_VCR_FAULT_SEED` to make the injected faults reproducible.
+
+Recorded responses are replayed as a single chunk, so streamed responses are split into events, on blank lines for
+server-sent events and on message frames for `application/vnd.amazon.eventstream`, before they are paced or cut.
+"""
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import json
+import math
+import os
+import random
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from typing import Any, cast
+
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+__all__ = ('FaultProfile', 'PROFILES', 'select_fault')
+
+rng = random.Random(os.getenv('PROXY_VCR_FAULT_SEED'))
+
+
+@dataclass
+class FaultProfile:
+    """Rates are probabilities between 0 and 1, applied independently to each request."""
+
+    latency_ms: float = 0
+    """Median latency added before the response, the latency is log-normally distributed."""
+    latency_sigma: float = 0.5
+    """Shape of the latency distribution, larger values give a longer tail."""
+    errors: dict[int, float] = field(default_factory=dict[int, float])
+    """Rate at which each status code is returned instead of the recorded response."""
+    reset_rate: float = 0
+    """Rate at which the connection is dropped after the response headers, without a body."""
+    stall_rate: float = 0
+    """Rate at which the response stalls for `stall_ms` before the first byte."""
+    stall_ms: float = 30_000
+    truncate_rate: float = 0
+    """Rate at which a streamed response is cut off in the middle of an event."""
+    truncate_fraction: float | None = None
+    """Fraction of a truncated response's bytes sent before the cut, random if not set."""
+    chunk_delay_ms: float = 0
+    """Delay between events of a streamed response."""
+
+    @classmethod
+    def from_json(cls, value: str) -> FaultProfile:
+        """Parse an inline profile, a malformed one is the client's mistake so it's a 400, not an injected fault."""
+        try:
+            # only called for values starting with `{`, which parse as an object
+            data = cast(dict[str, Any], json.loads(value))
+            errors = {int(status): float(rate) for status, rate in data.pop('errors', {}).items()}
+            return cls(errors=errors, **data)
+        except (TypeError, ValueError, AttributeError) as e:
+            raise HTTPException(status_code=400, detail=f'Invalid fault profile: {e}')
+
+    async def before_response(self) -> Response | None:
+        """Sleep for the injected latency, then return a response to send instead of the recorded one, if any."""
+        delay = 0.0
+        if self.latency_ms:
+            delay += rng.lognormvariate(math.log(self.latency_ms), self.latency_sigma)
+        if self.stall_rate and rng.random() < self.stall_rate:
+            delay += self.stall_ms
+        if delay:
+            await asyncio.sleep(delay / 1000)
+
+        for status, rate in self.errors.items():
+            if rng.random() < rate:
+                headers = {'retry-after': '1'} if status == 429 else None
+                error = {'message': f'Fault injected by proxy_vcr: {status}', 'type': 'proxy_vcr_fault'}
+                return JSONResponse({'error': error}, status_code=status, headers=headers)
+
+        if self.reset_rate and rng.random() < self.reset_rate:
+            # with an encoding set, `GZipMiddleware` sends the headers with the first body chunk rather than holding
+            # them back to compress the body
+            headers = {'content-type': 'application/json', 'content-encoding': 'identity'}
+            return StreamingResponse(_reset(), headers=headers)
+        return None
+
+    def wrap_stream(self, chunks: AsyncIterator[bytes], content_type: str, size: int) -> AsyncIterator[bytes]:
+        """Inject the stream faults into a streamed response of `size` bytes, event by event."""
+        events = _split_events(chunks, content_type)
+        if self.truncate_rate and rng.random() < self.truncate_rate:
+            fraction = rng.random() if self.truncate_fraction is None else self.truncate_fraction
+            events = _truncate(events, int(size * fraction))
+        if self.chunk_delay_ms:
+            events = _delay(events, self.chunk_delay_ms)
+        return events
+
+
+PROFILES: dict[str, FaultProfile] = {
+    'none': FaultProfile(),
+    'slow': FaultProfile(latency_ms=2_000, chunk_delay_ms=50),
+    'flaky': FaultProfile(latency_ms=200, latency_sigma=1, errors={429: 0.1, 500: 0.05, 503: 0.05}, reset_rate=0.02),
+    'rate-limited': FaultProfile(errors={429: 1}),
+    'down': FaultProfile(errors={503: 1}),
+    'reset': FaultProfile(reset_rate=1),
+    'stall': FaultProfile(stall_rate=1),
+    'truncate': FaultProfile(truncate_rate=1),
+}
+
+
+def _provider_defaults() -> dict[str, str]:
+    defaults: dict[str, str] = {}
+    for item in filter(None, os.getenv('PROXY_VCR_FAULTS', '').split(',')):
+        provider, _, profile = item.partition('=')
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown fault profile {profile!r} in PROXY_VCR_FAULTS')
+        defaults[provider.strip()] = profile
+    return defaults
+
+
+provider_defaults = _provider_defaults()
+
+
+def select_fault(request: Request, provider: str) -> FaultProfile | None:
+    """Find the fault profile for a request, from the `x-vcr-fault` header or the provider's default."""
+    value = request.headers.get('x-vcr-fault') or provider_defaults.get(provider)
+    if not value:
+        return None
+    if value.startswith('{'):
+        return FaultProfile.from_json(value)
+    try:
+        return PROFILES[value]
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f'Unknown fault profile {value!r}')
+
+
+async def _reset() -> AsyncIterator[bytes]:
+    # an empty chunk sends the headers, raising once they're sent makes the server abort the connection rather than
+    # answer with a 500
+    yield b''
+    raise ConnectionResetError('Fault injected by proxy_vcr: connection reset')
+
+
+async def _split_events(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[bytes]:
+    """Re-chunk a stream so each chunk is one whole event, any trailing partial event is sent last."""
+    split = _split_eventstream if content_type.startswith('application/vnd.amazon.eventstream') else _split_sse
+    buffer = b''
+    async for chunk in chunks:
+        events, buffer = split(buffer + chunk)
+        for event in events:
+            yield event
+    if buffer:
+        yield buffer
+
+
+def _split_sse(buffer: bytes) -> tuple[list[bytes], bytes]:
+    *events, rest = buffer.split(b'\n\n')
+    return [event + b'\n\n' for event in events], rest
+
+
+def _split_eventstream(buffer: bytes) -> tuple[list[bytes], bytes]:
+    # each message starts with its total length as a 4 byte big-endian integer, which includes the length itself
+    events: list[bytes] = []
+    while len(buffer) >= 4 and 4 <= (length := int.from_bytes(buffer[:4])) <= len(buffer):
+        events.append(buffer[:length])
+        buffer = buffer[length:]
+    return events, buffer
+
+
+async def _delay(events: AsyncIterator[bytes], delay_ms: float) -> AsyncIterator[bytes]:
+    async for event in events:
+        yield event
+        await asyncio.sleep(delay_ms / 1000)
+
+
+async def _truncate(events: AsyncIterator[bytes], cut_at: int) -> AsyncIterator[bytes]:
+    """Stream `events` until `cut_at` bytes are sent, then abort in the middle of the event that byte falls in."""
+    sent = 0
+    async for event in events:
+        if sent + len(event) > cut_at:
+            yield event[: max(1, cut_at - sent)]
+            break
+        yield event
+        sent += len(event)
+    raise ConnectionResetError('Fault injected by proxy_vcr: stream truncated')
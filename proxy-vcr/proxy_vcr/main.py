@@ -1,20 +1,35 @@
 from __future__ import annotations as _annotations
 
+import argparse
+import asyncio
+import functools
 import hashlib
+import os
 import pathlib
+import tempfile
+from collections import defaultdict
+from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
-from typing import cast
+from typing import TYPE_CHECKING, cast
 
-import httpx
 import uvicorn
 from starlette.applications import Starlette
 from starlette.datastructures import MutableHeaders
 from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
 from starlette.requests import Request
 from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.routing import Route
-from vcr import VCR  # type: ignore[reportMissingTypeStubs]
-from vcr.record_mode import RecordMode  # type: ignore[reportMissingTypeStubs]
+
+from .faults import select_fault
+from .store import CassetteStore, ReplayCassettes, ReplayedResponse
+
+if TYPE_CHECKING:
+    import httpx
+    from vcr import VCR  # type: ignore[reportMissingTypeStubs]
+
+    from .upstream import UpstreamClients
 
 OPENAI_BASE_URL = 'https://api.openai.com/v1'
 GROQ_BASE_URL = 'https://api.groq.com'
@@ -25,90 +40,263 @@ GOOGLE_BASE_URL = 'https://aiplatform.googleapis.com'
 AZURE_BASE_URL = 'https://marcelo-0665-resource.openai.azure.com/openai/v1'
 HF_BASE_URL = 'https://router.huggingface.co/v1'
 OVHCLOUD_BASE_URL = 'https://oai.endpoints.kepler.ai.cloud.ovh.net/v1'
+# each provider has its own connection pool when recording, see `upstream.py`
+BASE_URLS = {
+    'openai': OPENAI_BASE_URL,
+    'groq': GROQ_BASE_URL,
+    'anthropic': ANTHROPIC_BASE_URL,
+    'bedrock': BEDROCK_BASE_URL,
+    'google-vertex': GOOGLE_BASE_URL,
+    'azure': AZURE_BASE_URL,
+    'huggingface': HF_BASE_URL,
+    'ovhcloud': OVHCLOUD_BASE_URL,
+}
 
 current_file_dir = pathlib.Path(__file__).parent
+cassette_dir = current_file_dir / 'cassettes'
+
+# request bodies larger than this are spooled to disk rather than held in memory
+SPOOL_MAX_SIZE = 1024 * 1024
+# size of the chunks a spooled body is streamed upstream in
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# credentials aren't recorded in cassettes
+FILTER_HEADERS = ('Authorization', 'x-api-key', 'x-amz-security-token', 'cookie')
 
 # TODO(Marcelo): We should create different cassette directories: PydanticAI and Gateway test suites.
 
-vcr = VCR(
-    serializer='yaml',
-    cassette_library_dir=(current_file_dir / 'cassettes').as_posix(),
-    record_mode=RecordMode.ONCE,
-    match_on=['uri', 'method', 'query'],
-    filter_headers=['Authorization', 'x-api-key', 'x-amz-security-token', 'cookie'],
-)
+
+@functools.cache
+def get_vcr() -> VCR:
+    """vcr and the recording dependencies are imported on first use, so replay-only mode never loads them."""
+    from vcr import VCR  # type: ignore[reportMissingTypeStubs]
+    from vcr.record_mode import RecordMode  # type: ignore[reportMissingTypeStubs]
+
+    from .blobs import BlobPersister
+
+    vcr = VCR(
+        serializer='yaml',
+        cassette_library_dir=cassette_dir.as_posix(),
+        record_mode=RecordMode.ONCE,
+        match_on=['uri', 'method', 'query'],
+        filter_headers=list(FILTER_HEADERS),
+    )
+    # store large bodies once in a content-addressed blob store, see `blobs.py`
+    vcr.register_persister(BlobPersister)  # type: ignore[reportUnknownMemberType]
+    return vcr
 
 
 @asynccontextmanager
 async def lifespan(_: Starlette):
-    async with httpx.AsyncClient(timeout=600) as client:
-        yield {'httpx_client': client}
+    store_dir = os.getenv('PROXY_VCR_STORE')
+    replay_only = os.getenv('PROXY_VCR_REPLAY') == '1'
+    cassette_store: CassetteStore | ReplayCassettes | None = None
+    if store_dir:
+        cassette_store = CassetteStore(pathlib.Path(store_dir))
+    elif replay_only:
+        cassette_store = ReplayCassettes(cassette_dir)
+
+    if replay_only:
+        # without clients, requests that aren't recorded fail rather than reaching the provider
+        yield {'upstream_clients': None, 'cassette_store': cassette_store}
+    else:
+        from .blobs import cassette_writer
+        from .upstream import UpstreamClients
+
+        async with UpstreamClients.from_env(BASE_URLS) as clients:
+            # before serving, so warmup requests can't be recorded in a cassette
+            await clients.warmup()
+            try:
+                yield {'upstream_clients': clients, 'cassette_store': cassette_store}
+            finally:
+                await cassette_writer.flush()
+
+
+class SpooledBody:
+    """A request body read as a stream, hashed as the bytes arrive and spooled to disk once it's large.
+
+    The digest names the cassette without buffering the body, and replaying never reads it, so memory stays flat
+    however big an upload is. Recording streams large bodies upstream and into the blob store, see `record_upload`,
+    only small bodies are read into memory for vcr.
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.size = 0
+        self.digest = ''
+
+    @classmethod
+    async def read(cls, request: Request) -> SpooledBody:
+        body = cls()
+        sha256 = hashlib.sha256()
+        try:
+            async for chunk in request.stream():
+                sha256.update(chunk)
+                body.file.write(chunk)
+                body.size += len(chunk)
+        except BaseException:
+            body.close()
+            raise
+        body.digest = sha256.hexdigest()
+        body.file.seek(0)
+        return body
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        self.file.seek(0)
+        # the file may have been spooled to disk, so it's read off the event loop
+        while chunk := await asyncio.to_thread(self.file.read, UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+    def close(self) -> None:
+        self.file.close()
+
+
+async def forward(
+    client: httpx.AsyncClient, method: str, cassette: str, url: str, body: SpooledBody, headers: dict[str, str]
+) -> httpx.Response | ReplayedResponse:
+    from .blobs import MIN_BLOB_SIZE, cassette_writer
+
+    if method != 'GET' and body.size >= MIN_BLOB_SIZE and not cassette_writer.exists(cassette_dir / cassette):
+        return await record_upload(client, method, cassette_dir / cassette, url, body, headers)
+    with get_vcr().use_cassette(cassette):  # type: ignore[reportUnknownReturnType]
+        if method == 'GET' or cassette_writer.exists(cassette_dir / cassette):
+            # vcr matches on the URL, not the body, so replaying doesn't need to read the body
+            return await client.request(method, url, headers=headers)
+        # vcr reads the body synchronously to store it in the cassette, which is fine for small bodies
+        return await client.request(method, url, content=body.file.read(), headers=headers)
+
+
+async def record_upload(
+    client: httpx.AsyncClient,
+    method: str,
+    cassette_path: pathlib.Path,
+    url: str,
+    body: SpooledBody,
+    headers: dict[str, str],
+) -> ReplayedResponse:
+    """Record a large upload without vcr, as vcr's httpx stub reads the whole body into memory to store it.
+
+    The body is streamed from the spool file to the provider, then copied into the blob store, where it's named by the
+    digest computed while it was spooled, and the interaction is written as vcr would write it.
+    """
+    from vcr.request import Request as VcrRequest  # type: ignore[reportMissingTypeStubs]
+    from vcr.serializers import yamlserializer  # type: ignore[reportMissingTypeStubs]
+
+    from .blobs import BlobPersister, StoredBlob, write_blob_file
+
+    upload_headers = {**headers, 'content-length': str(body.size)}
+    async with client.stream(method, url, content=body.chunks(), headers=upload_headers) as response:
+        # as sent, e.g. gzipped, like vcr records it
+        content = b''.join([chunk async for chunk in response.aiter_raw()])
+    await asyncio.to_thread(write_blob_file, cassette_path.parent, body.file, body.digest)
+
+    filtered = {name.lower() for name in FILTER_HEADERS}
+    recorded_headers = {name: value for name, value in upload_headers.items() if name.lower() not in filtered}
+    response_headers: defaultdict[str, list[str]] = defaultdict(list)
+    for name, value in response.headers.multi_items():
+        response_headers[name].append(value)
+    recorded_response = {
+        'status': {'code': response.status_code, 'message': response.reason_phrase},
+        'headers': dict(response_headers),
+        'body': {'string': content},
+    }
+    request = VcrRequest(method, url, StoredBlob(body.digest), recorded_headers)
+    BlobPersister.save_cassette(
+        cassette_path, {'requests': [request], 'responses': [recorded_response]}, yamlserializer
+    )
+    return ReplayedResponse(response.status_code, response.headers.multi_items(), content)
+
+
+async def send(
+    request: Request, cassette: str, url: str, body: SpooledBody, headers: dict[str, str]
+) -> httpx.Response | ReplayedResponse:
+    """Replay the response from the cassette store if possible, otherwise replay or record it with vcr."""
+    clients = cast('UpstreamClients | None', request.scope['state']['upstream_clients'])
+    store = cast(CassetteStore | ReplayCassettes | None, request.scope['state']['cassette_store'])
+    if store is not None and (response := store.find(cassette, request.method, url)):
+        return response
+    if clients is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{request.method} {url} is not recorded in {cassette}, run proxy_vcr without --replay to record it',
+        )
+    client = clients.get(url)
+    if not isinstance(store, CassetteStore):
+        return await forward(client, request.method, cassette, url, body, headers)
+
+    from .blobs import cassette_writer
+
+    # the cassette is new since the store was built, or still has to be recorded
+    async with store.lock(cassette):
+        response = await forward(client, request.method, cassette, url, body, headers)
+        # other workers read the cassette from disk once they hold the lock
+        await cassette_writer.flush()
+        return response
 
 
 async def proxy(request: Request) -> Response:
+    body = await SpooledBody.read(request)
+    try:
+        return await proxy_body(request, body)
+    finally:
+        # the response has been read or replayed by now, whichever path it took
+        body.close()
+
+
+async def proxy_body(request: Request, body: SpooledBody) -> Response:
     auth_header = request.headers.get('authorization', '')
-    body: bytes = await request.body()
 
-    # We should cache based on request body content, so we should make a hash of the request body.
-    vcr_suffix = request.headers.get('x-vcr-filename', hashlib.sha256(body).hexdigest())
+    # We should cache based on request body content, so we name the cassette after the digest of the streamed body.
+    vcr_suffix = request.headers.get('x-vcr-filename', body.digest)
 
     provider = select_provider(request)
+    fault = select_fault(request, provider)
+    if fault and (fault_response := await fault.before_response()):
+        return fault_response
 
     extra_headers = MutableHeaders()
     if provider == 'openai':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = OPENAI_BASE_URL + request.url.path[len('/openai') :]
-        with vcr.use_cassette(cassette_name('openai', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            headers = {'Authorization': auth_header, 'content-type': 'application/json'}
-            response = await client.post(url, content=body, headers=headers)
+        headers = {'Authorization': auth_header, 'content-type': 'application/json'}
+        response = await send(request, cassette_name('openai', vcr_suffix), url, body, headers)
     elif provider == 'azure':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = AZURE_BASE_URL + request.url.path[len('/azure') :]
-        with vcr.use_cassette(cassette_name('azure', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            headers = {'Authorization': auth_header, 'content-type': 'application/json'}
-            response = await client.post(url, content=body, headers=headers)
+        headers = {'Authorization': auth_header, 'content-type': 'application/json'}
+        response = await send(request, cassette_name('azure', vcr_suffix), url, body, headers)
     elif provider == 'huggingface':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = HF_BASE_URL + request.url.path[len('/huggingface') :]
-        with vcr.use_cassette(cassette_name('huggingface', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            headers = {'Authorization': auth_header, 'content-type': 'application/json'}
-            response = await client.post(url, content=body, headers=headers)
-            extra_headers['x-inference-provider'] = response.headers.get('x-inference-provider', '')
+        headers = {'Authorization': auth_header, 'content-type': 'application/json'}
+        response = await send(request, cassette_name('huggingface', vcr_suffix), url, body, headers)
+        extra_headers['x-inference-provider'] = response.headers.get('x-inference-provider', '')
     elif provider == 'groq':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = GROQ_BASE_URL + request.url.path[len('/groq') :]
-        with vcr.use_cassette(cassette_name('groq', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            headers = {'Authorization': auth_header, 'content-type': 'application/json'}
-            response = await client.post(url, content=body, headers=headers)
+        headers = {'Authorization': auth_header, 'content-type': 'application/json'}
+        response = await send(request, cassette_name('groq', vcr_suffix), url, body, headers)
     elif provider == 'bedrock':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = BEDROCK_BASE_URL + request.url.path[len('/bedrock') :]
-        with vcr.use_cassette(cassette_name('bedrock', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            headers = {
-                'Authorization': auth_header,
-                'content-type': 'application/json',
-                'x-amz-security-token': auth_header.replace('Bearer ', ''),
-            }
-            response = await client.post(url, content=body, headers=headers)
+        headers = {
+            'Authorization': auth_header,
+            'content-type': 'application/json',
+            'x-amz-security-token': auth_header.replace('Bearer ', ''),
+        }
+        response = await send(request, cassette_name('bedrock', vcr_suffix), url, body, headers)
     elif provider == 'anthropic':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = ANTHROPIC_BASE_URL + request.url.path[len('/anthropic') :]
         api_key = request.headers.get('x-api-key', '')
-        with vcr.use_cassette(cassette_name('anthropic', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            anthropic_beta_headers = {}
-            if anthropic_beta := request.headers.get('anthropic-beta'):
-                anthropic_beta_headers = {'anthropic-beta': anthropic_beta}
-
-            headers = {
-                'content-type': 'application/json' if not url.endswith('files') else 'multipart/form-data',
-                'anthropic-version': request.headers.get('anthropic-version', '2023-06-01'),
-                'accept-encoding': request.headers.get('accept-encoding', 'deflate'),
-                **anthropic_beta_headers,
-                **({'authorization': auth_header} if url.endswith('chat/completions') else {'x-api-key': api_key}),
-            }
-            response = await client.post(url, content=body, headers=headers)
+        anthropic_beta_headers = {}
+        if anthropic_beta := request.headers.get('anthropic-beta'):
+            anthropic_beta_headers = {'anthropic-beta': anthropic_beta}
+
+        headers = {
+            # uploads keep the client's content type, which carries the multipart boundary
+            'content-type': 'application/json'
+            if not url.endswith('files')
+            else request.headers.get('content-type', 'multipart/form-data'),
+            'anthropic-version': request.headers.get('anthropic-version', '2023-06-01'),
+            **anthropic_beta_headers,
+            **({'authorization': auth_header} if url.endswith('chat/completions') else {'x-api-key': api_key}),
+        }
+        response = await send(request, cassette_name('anthropic', vcr_suffix), url, body, headers)
     elif provider == 'google-vertex':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = (
             GOOGLE_BASE_URL
             + request.url.path[len('/google-vertex') :]
@@ -120,14 +308,11 @@ async def proxy(request: Request) -> Response:
             'host': 'aiplatform.googleapis.com',
             'anthropic-version': request.headers.get('anthropic-version', 'vertex-2023-10-16'),
         }
-        with vcr.use_cassette(cassette_name('google-vertex', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            response = await client.post(url, content=body, headers=headers)
+        response = await send(request, cassette_name('google-vertex', vcr_suffix), url, body, headers)
     elif provider == 'ovhcloud':
-        client = cast(httpx.AsyncClient, request.scope['state']['httpx_client'])
         url = OVHCLOUD_BASE_URL + request.url.path[len('/ovhcloud') :]
-        with vcr.use_cassette(cassette_name('ovhcloud', vcr_suffix)):  # type: ignore[reportUnknownReturnType]
-            headers = {'Authorization': auth_header, 'content-type': 'application/json'}
-            response = await client.post(url, content=body, headers=headers)
+        headers = {'Authorization': auth_header, 'content-type': 'application/json'}
+        response = await send(request, cassette_name('ovhcloud', vcr_suffix), url, body, headers)
     else:
         raise HTTPException(status_code=404, detail=f'Path {request.url.path} not supported')
     content_type = cast(str, response.headers.get('content-type'))
@@ -138,8 +323,14 @@ async def proxy(request: Request) -> Response:
             async for chunk in response.aiter_bytes():
                 yield chunk
 
-        return StreamingResponse(generator(), status_code=response.status_code, headers=headers)
-    return JSONResponse(response.json(), status_code=response.status_code, headers=headers)
+        chunks = fault.wrap_stream(generator(), content_type, len(response.content)) if fault else generator()
+        # `GZipMiddleware` passes responses with an encoding through, so events aren't held back in the compressor
+        headers['content-encoding'] = 'identity'
+        return StreamingResponse(chunks, status_code=response.status_code, headers=headers)
+    if content_type.startswith('application/json'):
+        return JSONResponse(response.json(), status_code=response.status_code, headers=headers)
+    # e.g. JSONL batch results
+    return Response(response.content, status_code=response.status_code, headers=headers)
 
 
 async def health_check(_: Request) -> Response:
@@ -148,23 +339,15 @@ async def health_check(_: Request) -> Response:
 
 app = Starlette(
     lifespan=lifespan,
+    # compress responses for clients that accept it, event streams are sent with `content-encoding: identity` to
+    # exclude them, as the middleware only skips `text/event-stream` by itself
+    middleware=[Middleware(GZipMiddleware, minimum_size=1000)],
     routes=[
-        Route('/{path:path}', proxy, methods=['POST']),
         Route('/', health_check, methods=['GET']),
+        Route('/{path:path}', proxy, methods=['POST', 'GET']),
     ],
 )
 
-if __name__ == '__main__':
-    this_dir = pathlib.Path(__file__).parent
-    uvicorn.run(
-        'proxy_vcr.main:app',
-        host='0.0.0.0',
-        port=8005,
-        reload=True,
-        reload_dirs=[str(this_dir)],
-        date_header=False,
-    )
-
 
 def cassette_name(provider: str, vcr_suffix: str) -> str:
     return f'{provider}-{vcr_suffix}.yaml'
@@ -194,3 +377,56 @@ def select_provider(request: Request) -> str:
         return 'ovhcloud'
     else:
         raise HTTPException(status_code=404, detail=f'Path {request.url.path} not supported')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Record and replay LLM provider requests.')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of worker processes, with more than one, cassettes are served from a shared read-only store',
+    )
+    parser.add_argument('--port', type=int, default=8005)
+    parser.add_argument(
+        '--replay',
+        action='store_true',
+        help='only replay existing cassettes, without loading vcr, for a fast start e.g. in CI',
+    )
+    args = parser.parse_args()
+
+    this_dir = pathlib.Path(__file__).parent
+    if args.replay:
+        # read by `lifespan`, including in worker processes
+        os.environ['PROXY_VCR_REPLAY'] = '1'
+
+    if args.workers == 1 and args.replay:
+        # no hot reloading, it's only needed while recording and its file watcher delays the start
+        uvicorn.run(app, host='0.0.0.0', port=args.port, loop='uvloop', http='httptools', date_header=False)
+    elif args.workers == 1:
+        uvicorn.run(
+            'proxy_vcr.main:app',
+            host='0.0.0.0',
+            port=args.port,
+            reload=True,
+            reload_dirs=[str(this_dir)],
+            date_header=False,
+        )
+    else:
+        with tempfile.TemporaryDirectory(prefix='proxy-vcr-') as store_dir:
+            CassetteStore.build(cassette_dir, pathlib.Path(store_dir))
+            # workers are spawned as new processes, so they find the store from the environment
+            os.environ['PROXY_VCR_STORE'] = store_dir
+            uvicorn.run(
+                'proxy_vcr.main:app',
+                host='0.0.0.0',
+                port=args.port,
+                workers=args.workers,
+                loop='uvloop' if args.replay else 'auto',
+                http='httptools' if args.replay else 'auto',
+                date_header=False,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Measure the latency the gateway adds on top of the provider.
+
+Sends the same workload directly to proxy_vcr and through the gateway, and aggregates the gateway's
+`Server-Timing` headers into a per-phase report. The gateway must run with `serverTiming: true`, and its
+providers must point at proxy_vcr (as in the gateway test suite).
+
+Run with `uv run --package proxy-vcr -m proxy_vcr.overhead --api-key <gateway key>`.
+"""
+
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import json
+import pathlib
+import statistics
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any
+
+import httpx
+from rich.console import Console
+from rich.table import Table
+
+from .main import BASE_URLS, cassette_dir
+from .store import load_interactions, response_body
+
+PROXY_VCR_URL = 'http://localhost:8005'
+GATEWAY_URL = 'http://localhost:8787'
+
+
+@dataclass
+class WorkloadRequest:
+    """A request replayed against both targets, `path` is relative to the provider, e.g. `/openai/chat/completions`.
+
+    The default workload is the recorded requests with the largest responses, pass a `--workload` of requests with
+    larger prompts or completions to measure the effect of compression on those.
+    """
+
+    path: str
+    body: dict[str, Any]
+    vcr_filename: str
+
+
+# providers whose gateway route forwards the path unchanged to proxy_vcr, so a recorded request replays through both
+WORKLOAD_PROVIDERS = ('openai', 'anthropic', 'groq', 'huggingface', 'ovhcloud')
+# number of recorded requests in the default workload
+DEFAULT_WORKLOAD_SIZE = 5
+
+
+def cassette_workload(size: int = DEFAULT_WORKLOAD_SIZE) -> list[WorkloadRequest]:
+    """The recorded JSON requests with the largest responses, replayed from their cassettes."""
+    recorded: list[tuple[int, WorkloadRequest]] = []
+    for cassette_path in cassette_dir.glob('*.yaml'):
+        provider = next((p for p in WORKLOAD_PROVIDERS if cassette_path.stem.startswith(f'{p}-')), None)
+        if provider is None:
+            continue
+        for interaction in load_interactions(cassette_path):
+            request = interaction['request']
+            base_url = BASE_URLS[provider]
+            if request['method'] != 'POST' or not request['uri'].startswith(base_url):
+                continue
+            try:
+                body = json.loads(request['body'])
+            except (TypeError, ValueError):
+                # bodies stored as blobs, or not JSON
+                continue
+            workload_request = WorkloadRequest(
+                path=f'/{provider}{request["uri"][len(base_url) :]}',
+                body=body,
+                vcr_filename=cassette_path.stem[len(provider) + 1 :],
+            )
+            recorded.append((len(response_body(interaction['response'])), workload_request))
+    recorded.sort(key=lambda item: item[0], reverse=True)
+    return [request for _, request in recorded[:size]]
+
+
+@dataclass
+class Samples:
+    direct: list[float] = field(default_factory=list[float])
+    gateway: list[float] = field(default_factory=list[float])
+    direct_bytes: list[int] = field(default_factory=list[int])
+    gateway_bytes: list[int] = field(default_factory=list[int])
+    phases: defaultdict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    """Parse a `Server-Timing` header, summing the durations of repeated metrics.
+
+    Provider fallbacks report their phases with the attempt index as a suffix, e.g. `upstream-1`.
+    """
+    durations: dict[str, float] = defaultdict(float)
+    for metric in header.split(','):
+        name, *params = (part.strip() for part in metric.split(';'))
+        for param in params:
+            key, _, value = param.partition('=')
+            if key == 'dur' and name:
+                durations[name] += float(value)
+    return dict(durations)
+
+
+async def timed_post(client: httpx.AsyncClient, url: str, request: WorkloadRequest, headers: dict[str, str]):
+    start = time.perf_counter()
+    response = await client.post(url, json=request.body, headers={'x-vcr-filename': request.vcr_filename, **headers})
+    await response.aread()
+    elapsed = (time.perf_counter() - start) * 1000
+    response.raise_for_status()
+    return elapsed, response
+
+
+async def run(args: argparse.Namespace, workload: list[WorkloadRequest]) -> Samples:
+    samples = Samples()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(timeout=60, headers={'accept-encoding': args.accept_encoding}) as client:
+
+        async def one(request: WorkloadRequest) -> None:
+            async with semaphore:
+                direct, direct_response = await timed_post(client, args.proxy_vcr_url + request.path, request, {})
+                gateway, response = await timed_post(
+                    client, args.gateway_url + request.path, request, {'authorization': args.api_key}
+                )
+            samples.direct.append(direct)
+            samples.gateway.append(gateway)
+            samples.direct_bytes.append(direct_response.num_bytes_downloaded)
+            samples.gateway_bytes.append(response.num_bytes_downloaded)
+            for name, duration in parse_server_timing(response.headers.get('server-timing', '')).items():
+                samples.phases[name].append(duration)
+
+        # warm up connections and caches before measuring
+        for request in workload:
+            await one(request)
+        samples = Samples()
+        await asyncio.gather(*(one(request) for _ in range(args.iterations) for request in workload))
+    return samples
+
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[int(q) - 1]
+
+
+def report(samples: Samples, console: Console) -> None:
+    table = Table(title='Gateway overhead (ms)')
+    for column in ('phase', 'mean', 'p50', 'p95', 'n'):
+        table.add_column(column, justify='left' if column == 'phase' else 'right')
+
+    def add_row(name: str, values: list[float]) -> None:
+        table.add_row(
+            name,
+            f'{statistics.fmean(values):.1f}',
+            f'{percentile(values, 50):.1f}',
+            f'{percentile(values, 95):.1f}',
+            str(len(values)),
+        )
+
+    add_row('direct (proxy_vcr)', samples.direct)
+    add_row('through gateway', samples.gateway)
+    add_row('overhead', [g - d for g, d in zip(samples.gateway, samples.direct)])
+    table.add_section()
+    for name, values in samples.phases.items():
+        add_row(name, values)
+    console.print(table)
+
+    bytes_table = Table(title='Response bytes on the wire')
+    bytes_table.add_column('target')
+    bytes_table.add_column('mean', justify='right')
+    bytes_table.add_row('direct (proxy_vcr)', f'{statistics.fmean(samples.direct_bytes):,.0f}')
+    bytes_table.add_row('through gateway', f'{statistics.fmean(samples.gateway_bytes):,.0f}')
+    console.print(bytes_table)
+
+
+def load_workload(path: pathlib.Path | None) -> list[WorkloadRequest]:
+    if path is None:
+        return cassette_workload()
+    return [WorkloadRequest(**item) for item in json.loads(path.read_text())]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api-key', required=True, help='gateway API key, e.g. `healthy` for the test gateway')
+    parser.add_argument('--gateway-url', default=GATEWAY_URL)
+    parser.add_argument('--proxy-vcr-url', default=PROXY_VCR_URL)
+    parser.add_argument('--iterations', type=int, default=50, help='times each workload request is sent')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument(
+        '--accept-encoding', default='gzip', help='sent to both targets, use `identity` to compare uncompressed'
+    )
+    parser.add_argument(
+        '--workload', type=pathlib.Path, help='JSON list of {"path", "body", "vcr_filename"} objects to replay'
+    )
+    args = parser.parse_args()
+
+    samples = asyncio.run(run(args, load_workload(args.workload)))
+    report(samples, Console())
+
+
+if __name__ == '__main__':
+    main()
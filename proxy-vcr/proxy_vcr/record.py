@@ -0,0 +1,126 @@
+"""Re-record all cassettes of a provider concurrently, refreshing their responses.
+
+The requests of each cassette are sent again as recorded, with the API key added, and the cassette is rewritten with
+the new responses. Cassettes are re-recorded concurrently through the same per-provider connection pools as record
+mode, see `upstream.py`, and written in batches off the event loop. Error responses, e.g. rate limits, are recorded
+like any other, but a cassette is left unchanged if any of its requests fails or gets a different status than was
+recorded, e.g. because the API key is invalid.
+
+Run with `uv run --package proxy-vcr -m proxy_vcr.record openai --api-key $OPENAI_API_KEY`.
+"""
+
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import pathlib
+import time
+from collections import defaultdict
+from typing import Any, Protocol, cast
+
+import httpx
+from vcr.request import Request  # type: ignore[reportMissingTypeStubs]
+from vcr.serializers import yamlserializer  # type: ignore[reportMissingTypeStubs]
+
+from .blobs import BlobPersister, cassette_writer
+from .main import BASE_URLS, cassette_dir
+from .upstream import UpstreamClients
+
+# set by httpx for the request being sent
+SKIP_HEADERS = {'host', 'content-length', 'connection', 'transfer-encoding'}
+
+
+class RecordedRequest(Protocol):
+    """The attributes of a vcr `Request` used here, vcr isn't typed."""
+
+    headers: dict[str, str]
+    method: str
+    uri: str
+    body: bytes | None
+
+
+def auth_headers(provider: str, api_key: str) -> dict[str, str]:
+    """The credentials headers `proxy` forwards for `provider`, vcr filters them from the recorded requests."""
+    if provider == 'anthropic':
+        return {'x-api-key': api_key}
+    if provider == 'bedrock':
+        return {'authorization': f'Bearer {api_key}', 'x-amz-security-token': api_key}
+    return {'authorization': f'Bearer {api_key}'}
+
+
+async def send(client: httpx.AsyncClient, request: Request, auth: dict[str, str]) -> dict[str, Any]:
+    """Send a recorded request, returning the response as vcr records it, with the body as sent, e.g. gzipped."""
+    recorded = cast(RecordedRequest, request)
+    headers = {name: value for name, value in recorded.headers.items() if name.lower() not in SKIP_HEADERS}
+    async with client.stream(
+        recorded.method, recorded.uri, content=recorded.body, headers={**headers, **auth}
+    ) as response:
+        content = b''.join([chunk async for chunk in response.aiter_raw()])
+
+    response_headers: defaultdict[str, list[str]] = defaultdict(list)
+    for name, value in response.headers.multi_items():
+        response_headers[name].append(value)
+    return {
+        'status': {'code': response.status_code, 'message': response.reason_phrase},
+        'headers': dict(response_headers),
+        'body': {'string': content},
+    }
+
+
+class StatusChanged(Exception):
+    pass
+
+
+async def rerecord(cassette_path: pathlib.Path, clients: UpstreamClients, auth: dict[str, str]) -> None:
+    requests, recorded = BlobPersister.load_cassette(cassette_path, yamlserializer)
+    responses: list[dict[str, Any]] = []
+    # in order, as later requests may depend on earlier ones, e.g. a batch is created before it's retrieved
+    for request, recorded_response in zip(requests, recorded):
+        response = await send(clients.get(request.uri), request, auth)
+        status, recorded_status = response['status']['code'], recorded_response['status']['code']
+        if status != recorded_status:
+            raise StatusChanged(f'{request.method} {request.uri} returned {status}, {recorded_status} was recorded')
+        responses.append(response)
+    BlobPersister.save_cassette(cassette_path, {'requests': requests, 'responses': responses}, yamlserializer)
+
+
+async def run(args: argparse.Namespace) -> list[tuple[pathlib.Path, Exception]]:
+    paths = sorted(args.cassette_dir.glob(f'{args.provider}-*.yaml'))
+    auth = auth_headers(args.provider, args.api_key)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failures: list[tuple[pathlib.Path, Exception]] = []
+
+    async def one(path: pathlib.Path) -> None:
+        async with semaphore:
+            try:
+                await rerecord(path, clients, auth)
+            except (httpx.HTTPError, StatusChanged) as e:
+                failures.append((path, e))
+
+    async with UpstreamClients.from_env(BASE_URLS) as clients:
+        await clients.warmup()
+        await asyncio.gather(*(one(path) for path in paths))
+    await cassette_writer.flush()
+    print(f're-recorded {len(paths) - len(failures)} of {len(paths)} {args.provider} cassettes')
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('provider', choices=sorted(BASE_URLS))
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--concurrency', type=int, default=16, help='cassettes re-recorded at once')
+    parser.add_argument('--cassette-dir', type=pathlib.Path, default=cassette_dir)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    failures = asyncio.run(run(args))
+    for path, error in failures:
+        print(f'failed to re-record {path.name}: {error}')
+    print(f'took {time.perf_counter() - start:.1f}s')
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
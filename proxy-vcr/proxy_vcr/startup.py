@@ -0,0 +1,76 @@
+"""Measure how long proxy_vcr takes to become healthy in replay-only mode, to guard against slow startup regressions.
+
+Starts `proxy_vcr.main --replay` several times, polling the health check until it responds, and fails if the median
+time to healthy exceeds the budget. It also fails if importing `proxy_vcr.main` loads vcr or the other recording
+dependencies, which is what keeps replay-only startup fast.
+
+Run with `uv run --package proxy-vcr -m proxy_vcr.startup`.
+"""
+
+from __future__ import annotations as _annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# imported only to record cassettes, replay-only mode must not load them
+RECORDING_MODULES = ('vcr', 'httpx', 'openai', 'google.auth', 'rich')
+POLL_INTERVAL = 0.005
+
+
+def time_to_healthy(port: int, timeout: float) -> float:
+    """Start the replay-only proxy and return the seconds until its health check responds."""
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'proxy_vcr.main', '--replay', '--port', str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f'proxy_vcr exited with code {server.returncode} before becoming healthy')
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=timeout):
+                    return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(POLL_INTERVAL)
+        raise TimeoutError(f'proxy_vcr was not healthy after {timeout}s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def recording_modules_imported() -> list[str]:
+    """The recording dependencies loaded by importing `proxy_vcr.main`, in a fresh interpreter."""
+    check = f'import sys, proxy_vcr.main; print(*(m for m in {RECORDING_MODULES!r} if m in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True).stdout
+    return output.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8006, help='port to start the proxy on, 8005 may be in use')
+    parser.add_argument('--runs', type=int, default=5)
+    # a replay-only start takes ~0.3s locally, the headroom keeps slow, shared CI runners from failing it, and loading
+    # the recording dependencies fails the import check below whatever the timing
+    parser.add_argument('--budget', type=float, default=3.0, help='maximum median seconds to a healthy proxy')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for each start')
+    args = parser.parse_args()
+
+    if imported := recording_modules_imported():
+        sys.exit(f'importing proxy_vcr.main loads recording dependencies: {", ".join(imported)}')
+
+    durations = [time_to_healthy(args.port, args.timeout) for _ in range(args.runs)]
+    median = statistics.median(durations)
+    print(f'time to healthy: median {median * 1000:.0f}ms, min {min(durations) * 1000:.0f}ms over {args.runs} runs')
+    if median > args.budget:
+        sys.exit(f'median time to healthy {median * 1000:.0f}ms exceeds the budget of {args.budget * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
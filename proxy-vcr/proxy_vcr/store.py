@@ -0,0 +1,192 @@
+"""Replaying cassettes without vcr.
+
+`CassetteStore` is a read-only store shared by all worker processes in multi-worker mode. The parent process parses
+every cassette once and writes all inline response bodies to one file, plus a small JSON index. Workers memory-map the
+bodies file, so the bodies are held once in the OS page cache rather than once per worker, and no worker has to parse
+YAML to replay a cassette. Bodies in the blob store are read lazily on replay.
+
+`ReplayCassettes` serves the replay-only mode, where each cassette is parsed the first time it's requested so the
+proxy starts without parsing anything.
+
+Both serve the first interaction matching a request, however often it's repeated, e.g. when polling. That's what
+the single-worker mode replays too, as it opens the cassette with vcr for each request, so vcr's play counts never
+advance past the first match.
+
+Neither imports vcr or httpx, so replay-only startup stays fast.
+"""
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import fcntl
+import json
+import mmap
+import pathlib
+import zlib
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any, TypedDict, cast
+
+import yaml
+from starlette.datastructures import Headers
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+__all__ = ('CassetteStore', 'ReplayCassettes', 'ReplayedResponse', 'blob_dir', 'load_interactions', 'read_blob')
+
+BODIES_FILE = 'bodies.bin'
+INDEX_FILE = 'index.json'
+BLOB_DIR = 'blobs'
+
+
+def blob_dir(cassette_dir: pathlib.Path) -> pathlib.Path:
+    return cassette_dir / BLOB_DIR
+
+
+def read_blob(cassette_dir: pathlib.Path, digest: str) -> bytes:
+    return (blob_dir(cassette_dir) / digest).read_bytes()
+
+
+def load_interactions(cassette_path: pathlib.Path) -> list[dict[str, Any]]:
+    """Load the raw interactions of a cassette, bodies stored as blobs are left as `{'blob': <sha256>}`."""
+    # cassettes only use the `!!binary` tag beyond plain YAML, so the safe loader reads them without vcr
+    data = cast(dict[str, Any], yaml.load(cassette_path.read_text(), Loader=SafeLoader))
+    return data['interactions']
+
+
+class ReplayedResponse:
+    """A recorded response, with the part of the `httpx.Response` API the proxy uses.
+
+    The body is decoded like httpx would, as cassettes hold the body as it was sent, e.g. gzipped.
+    """
+
+    def __init__(self, status_code: int, headers: list[tuple[str, str]], content: bytes):
+        self.status_code = status_code
+        self.headers = Headers(
+            raw=[(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        )
+        encoding = self.headers.get('content-encoding', 'identity').lower()
+        if encoding == 'gzip':
+            content = zlib.decompress(content, wbits=zlib.MAX_WBITS | 16)
+        elif encoding == 'deflate':
+            content = zlib.decompress(content)
+        self.content = bytes(content)
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    async def aiter_bytes(self) -> AsyncIterator[bytes]:
+        yield self.content
+
+
+class Interaction(TypedDict):
+    method: str
+    uri: str
+    status: int
+    headers: list[tuple[str, str]]
+    blob: str | None
+    offset: int
+    length: int
+
+
+class CassetteStore:
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        index = json.loads((directory / INDEX_FILE).read_text())
+        self.cassette_dir = pathlib.Path(index['cassette_dir'])
+        self.cassettes: dict[str, list[Interaction]] = index['cassettes']
+        with (directory / BODIES_FILE).open('rb') as f:
+            # an empty file can't be mapped
+            self.bodies = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b''
+        self._locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    @staticmethod
+    def build(cassette_dir: pathlib.Path, directory: pathlib.Path) -> None:
+        """Parse all cassettes in `cassette_dir` and write the store to `directory`."""
+        cassettes: dict[str, list[Interaction]] = {}
+        offset = 0
+        with (directory / BODIES_FILE).open('wb') as bodies:
+            for path in sorted(cassette_dir.glob('*.yaml')):
+                interactions: list[Interaction] = []
+                for raw in load_interactions(path):
+                    request, response = raw['request'], raw['response']
+                    blob = cast(str | None, response['body'].get('blob'))
+                    body = b'' if blob else response_body(response)
+                    bodies.write(body)
+                    headers = cast(dict[str, list[str]], response['headers'])
+                    interactions.append(
+                        Interaction(
+                            method=request['method'],
+                            uri=request['uri'],
+                            status=response['status']['code'],
+                            headers=[(name, value) for name, values in headers.items() for value in values],
+                            blob=blob,
+                            offset=offset,
+                            length=len(body),
+                        )
+                    )
+                    offset += len(body)
+                cassettes[path.name] = interactions
+        index = {'cassette_dir': str(cassette_dir.resolve()), 'cassettes': cassettes}
+        (directory / INDEX_FILE).write_text(json.dumps(index))
+
+    def find(self, cassette: str, method: str, uri: str) -> ReplayedResponse | None:
+        """Replay the first interaction in `cassette` matching `method` and `uri`, for every repeat of the request."""
+        for interaction in self.cassettes.get(cassette, []):
+            if interaction['method'] == method and interaction['uri'] == uri:
+                if blob := interaction['blob']:
+                    content = read_blob(self.cassette_dir, blob)
+                else:
+                    start = interaction['offset']
+                    content = self.bodies[start : start + interaction['length']]
+                return ReplayedResponse(interaction['status'], interaction['headers'], content)
+        return None
+
+    @asynccontextmanager
+    async def lock(self, cassette: str) -> AsyncIterator[None]:
+        """Lock `cassette` across all workers, so concurrent misses record it only once."""
+        async with self._locks[cassette]:
+            with (self.directory / f'{cassette}.lock').open('a') as f:
+                await asyncio.to_thread(fcntl.flock, f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ReplayCassettes:
+    """Cassettes parsed the first time they're requested, for the replay-only mode."""
+
+    def __init__(self, cassette_dir: pathlib.Path):
+        self.cassette_dir = cassette_dir
+        self._cassettes: dict[str, list[dict[str, Any]]] = {}
+
+    def find(self, cassette: str, method: str, uri: str) -> ReplayedResponse | None:
+        """Replay the first interaction in `cassette` matching `method` and `uri`, for every repeat of the request."""
+        if (interactions := self._cassettes.get(cassette)) is None:
+            path = self.cassette_dir / cassette
+            interactions = self._cassettes[cassette] = load_interactions(path) if path.is_file() else []
+        for interaction in interactions:
+            request, response = interaction['request'], interaction['response']
+            if request['method'] == method and request['uri'] == uri:
+                if blob := response['body'].get('blob'):
+                    content = read_blob(self.cassette_dir, blob)
+                else:
+                    content = response_body(response)
+                headers = cast(dict[str, list[str]], response['headers'])
+                return ReplayedResponse(
+                    response['status']['code'],
+                    [(name, value) for name, values in headers.items() for value in values],
+                    content,
+                )
+        return None
+
+
+def response_body(response: dict[str, Any]) -> bytes:
+    """The inline body of a recorded response, YAML loads it as `str` unless it was recorded as `!!binary`."""
+    body = cast(str | bytes | None, response['body'].get('string'))
+    return body.encode() if isinstance(body, str) else body or b''
@@ -0,0 +1,126 @@
+"""Measure how replay throughput scales with the number of proxy_vcr worker processes.
+
+For each worker count, starts `proxy_vcr.main --replay --workers N`, sends the workload of `overhead.py` from several
+client processes for a fixed duration, and reports the requests replayed per second. With more than one worker,
+cassettes are served from the shared `CassetteStore`, see `store.py`. Clients run in their own processes, so a single
+client's event loop doesn't cap the throughput being measured.
+
+Run with `uv run --package proxy-vcr -m proxy_vcr.throughput --workers 1 2 4`.
+"""
+
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import pathlib
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import httpx
+from rich.console import Console
+from rich.table import Table
+
+from .overhead import WorkloadRequest, load_workload
+
+POLL_INTERVAL = 0.05
+
+
+@contextmanager
+def serve(port: int, workers: int, timeout: float) -> Iterator[str]:
+    """Start the replay-only proxy with `workers` processes, yielding its URL once it's healthy."""
+    url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'proxy_vcr.main', '--replay', '--workers', str(workers), '--port', str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.perf_counter() + timeout
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f'proxy_vcr exited with code {server.returncode} before becoming healthy')
+            try:
+                with urllib.request.urlopen(url, timeout=timeout):
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                if time.perf_counter() > deadline:
+                    raise TimeoutError(f'proxy_vcr was not healthy after {timeout}s')
+                time.sleep(POLL_INTERVAL)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def client_requests(url: str, workload: list[WorkloadRequest], concurrency: int, duration: float) -> int:
+    """Send the workload round-robin on `concurrency` connections until `duration` elapses, return requests sent."""
+    deadline = time.perf_counter() + duration
+    sent = 0
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+
+        async def loop(offset: int) -> None:
+            nonlocal sent
+            index = offset
+            while time.perf_counter() < deadline:
+                request = workload[index % len(workload)]
+                response = await client.post(
+                    url + request.path, json=request.body, headers={'x-vcr-filename': request.vcr_filename}
+                )
+                await response.aread()
+                response.raise_for_status()
+                sent += 1
+                index += 1
+
+        await asyncio.gather(*(loop(offset) for offset in range(concurrency)))
+    return sent
+
+
+def run_client(url: str, workload: list[WorkloadRequest], concurrency: int, duration: float) -> int:
+    return asyncio.run(client_requests(url, workload, concurrency, duration))
+
+
+def throughput(url: str, args: argparse.Namespace, workload: list[WorkloadRequest]) -> float:
+    # warm up, e.g. so replay-only workers have parsed the cassettes
+    run_client(url, workload, 1, 0.5)
+    with ProcessPoolExecutor(args.clients) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(run_client, url, workload, args.concurrency, args.duration) for _ in range(args.clients)]
+        sent = sum(future.result() for future in futures)
+        return sent / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to compare')
+    parser.add_argument('--port', type=int, default=8007, help='port to start the proxy on, 8005 may be in use')
+    parser.add_argument('--clients', type=int, default=4, help='client processes sending requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent requests per client process')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to send requests for each worker count')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for the proxy to start')
+    parser.add_argument(
+        '--workload', type=pathlib.Path, help='JSON list of {"path", "body", "vcr_filename"} objects to replay'
+    )
+    args = parser.parse_args()
+    workload = load_workload(args.workload)
+
+    table = Table(title='proxy_vcr replay throughput')
+    for column in ('workers', 'requests/s', 'vs first'):
+        table.add_column(column, justify='right')
+    baseline: float | None = None
+    for workers in args.workers:
+        with serve(args.port, workers, args.timeout) as url:
+            rate = throughput(url, args, workload)
+        baseline = baseline or rate
+        table.add_row(str(workers), f'{rate:,.0f}', f'{rate / baseline:.2f}x')
+    Console().print(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Upstream HTTP clients for record mode, with a connection pool per provider.
+
+Each provider gets its own `httpx.AsyncClient`, so a slow or saturated provider doesn't hold connections other
+providers need. Clients use HTTP/2, multiplexing concurrent recordings over a few connections, and providers with
+`warmup` enabled get a connection opened at startup, so the first recording doesn't wait for the TLS handshake.
+Requests to other hosts use a default client.
+
+Pools are tuned with the `PROXY_VCR_POOLS` environment variable, a JSON object of per-provider overrides of
+`PoolConfig`, e.g. `PROXY_VCR_POOLS='{"openai": {"max_connections": 50, "warmup": true}, "bedrock": {"http2": false}}'`.
+"""
+
+from __future__ import annotations as _annotations
+
+import asyncio
+import json
+import os
+from dataclasses import dataclass, replace
+from typing import Any, Self, cast
+from urllib.parse import urlsplit
+
+import httpx
+
+__all__ = ('PoolConfig', 'UpstreamClients')
+
+# recordings can wait minutes for long completions
+TIMEOUT = 600
+WARMUP_TIMEOUT = 5
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 120
+    """Seconds an idle connection is kept open, longer than the httpx default of 5s."""
+    http2: bool = True
+    """Providers that don't support HTTP/2 fall back to HTTP/1.1."""
+    warmup: bool = False
+    """Open a connection to the provider at startup, off by default as it reaches the provider on every start."""
+
+
+class UpstreamClients:
+    """One client per provider, chosen by the origin of the request URL."""
+
+    def __init__(self, base_urls: dict[str, str], pools: dict[str, PoolConfig] | None = None):
+        pools = pools or {}
+        self.base_urls = base_urls
+        self.pools = {provider: pools.get(provider, PoolConfig()) for provider in base_urls}
+        self.clients: dict[str, httpx.AsyncClient] = {}
+        for provider, base_url in base_urls.items():
+            pool = self.pools[provider]
+            limits = httpx.Limits(
+                max_connections=pool.max_connections,
+                max_keepalive_connections=pool.max_keepalive_connections,
+                keepalive_expiry=pool.keepalive_expiry,
+            )
+            client = httpx.AsyncClient(timeout=TIMEOUT, limits=limits, http2=pool.http2)
+            self.clients[origin(base_url)] = client
+        self.default = httpx.AsyncClient(timeout=TIMEOUT)
+
+    @classmethod
+    def from_env(cls, base_urls: dict[str, str]) -> UpstreamClients:
+        overrides = cast(dict[str, dict[str, Any]], json.loads(os.getenv('PROXY_VCR_POOLS') or '{}'))
+        unknown = overrides.keys() - base_urls.keys()
+        if unknown:
+            raise ValueError(f'Unknown providers in PROXY_VCR_POOLS: {", ".join(sorted(unknown))}')
+        pools = {provider: pool_config(config) for provider, config in overrides.items()}
+        return cls(base_urls, pools)
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        return self.clients.get(origin(url), self.default)
+
+    async def warmup(self) -> None:
+        """Open a connection to each provider with `warmup` enabled, the response and any error are ignored."""
+
+        async def connect(base_url: str) -> None:
+            try:
+                await self.get(base_url).head(base_url, timeout=WARMUP_TIMEOUT)
+            except httpx.HTTPError:
+                pass
+
+        await asyncio.gather(
+            *(connect(base_url) for provider, base_url in self.base_urls.items() if self.pools[provider].warmup)
+        )
+
+    async def aclose(self) -> None:
+        await asyncio.gather(*(client.aclose() for client in [*self.clients.values(), self.default]))
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.aclose()
+
+
+def pool_config(data: dict[str, Any]) -> PoolConfig:
+    try:
+        return replace(PoolConfig(), **data)
+    except TypeError as e:
+        raise ValueError(f'Invalid pool config {data}: {e}')
+
+
+def origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'